@@ -1,13 +1,62 @@
+import functools
 import os
+import threading
+import time
+import uuid
 import serial
 import octoprint.plugin
 import logging
 from octoprint.filemanager.destinations import FileDestinations
 from octoprint.util.comm import parse_firmware_line, serialList
-from octoprint.util import RepeatedTimer
 import flask
 import sarge
 
+from .jobs import BatchJob, JobQueue, SpoolJob, StreamUploadJob, UploadJob
+from . import listing
+from .connection import (ConnectionManager, DeviceBusy, device_key,
+                         find_remembered, port_identity, probe_ports)
+from .devices import (DEFAULT_DEVICE, Device, DeviceRegistry,
+                      device_attribute, device_id, folder_name)
+from .listing import parse_listing
+from .manifest import Manifest, file_digest
+from .metrics import Metrics, instrumented
+from .minify import GcodeMinifier, is_gcode
+from .portwatch import PortWatcher
+from .shortnames import ShortNameLookup
+from .spool import Spool
+from .stream import (MAX_STREAM_SIZE, StreamBuffer, StreamClosed,
+                     StreamUploadHandler)
+from .transport import NO_TIMEOUT, CommandTimeout, CommandTransport, exchange
+from .transfer import (MODE_ADD, MODE_BINARY, MODE_WINDOW, CODEC_ZLIB,
+                       BINARY_FRAME_SIZE, ZLIB_WBITS, CompressedReader,
+                       ADAPT_MIN_CHUNK, AdaptiveChunk, ChecksumReader,
+                       PrefetchReader, ProgressTracker, VerifyError,
+                       send_binary, send_windowed)
+
+
+def device_route(rule, **options):
+    """
+    Blueprint route of the default device that also answers under
+    /devices/<device_id>, running the view for the addressed device.
+    """
+    route = octoprint.plugin.BlueprintPlugin.route
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(self, *args, device_id=None, **kwargs):
+            device = self.devices.get(device_id)
+            if (device is None):
+                return flask.Response(
+                    "Unknown device",
+                    status=404
+                )
+            with self.devices.use(device):
+                return view(self, *args, **kwargs)
+
+        wrapper = route(rule, **options)(wrapper)
+        return route("/devices/<device_id>" + rule, **dict(options))(wrapper)
+    return decorator
+
 
 class MasterSDPlugin(octoprint.plugin.StartupPlugin,
                      octoprint.plugin.TemplatePlugin,
@@ -16,242 +65,728 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
                      octoprint.plugin.SettingsPlugin,
                      octoprint.plugin.EventHandlerPlugin):
 
-    ser = None
-    control = False
     local = FileDestinations.LOCAL
     ADD_MAX = 64
+    # Seconds the device takes to fall back to its old baud rate after a
+    # switch nothing readable arrived on
+    BAUD_FALLBACK = 1.0
+    # Seconds a rate that failed is skipped for, times the failures in a row
+    BAUD_RETRY_AFTER = 24 * 3600
 
     last_ports = None
     autorefresh = None
 
-    sd_data = None
-    busy = False
-
-    def list_find(self, l, item):
-        if item in l:
-            return l.index(item)
-        else:
-            return -1
+    metrics = None
+    # Autorun waiting for the printer to list the uploaded file
+    short_name_lookup = None
+    # Known MasterSDs, the state below is that of the one the calling
+    # thread works for
+    devices = None
+
+    conn = device_attribute("conn")
+    transport = device_attribute("transport")
+    jobs = device_attribute("jobs")
+    spool = device_attribute("spool")
+    sd_data = device_attribute("sd_data")
+    sd_etag = device_attribute("sd_etag")
+    busy = device_attribute("busy")
+    # Key of the connected device in the `devices` setting
+    device_key = device_attribute("device_key")
+    caps = device_attribute("caps")
+    transfer_mode = device_attribute("transfer_mode")
+
+    @property
+    def device(self):
+        return self.devices.current
+
+    @property
+    def ser(self):
+        return self.conn.ser
+
+    @property
+    def control(self):
+        return bool(self.conn.control)
+
+    @control.setter
+    def control(self, value):
+        self.conn.control = value
+
+    def run_command(self, command, *args, timeout=None):
+        # Runs one of the protocol helpers with exclusive use of the port,
+        # on the transport's I/O thread unless this thread holds the port
+        return self.transport.run(self.devices.bind(self.device, command),
+                                  *args, timeout=timeout)
 
     def get_sd_data(self, raw_data):
-        folders = []
-        files = []
-        free_size = 0
-        taken_size = 0
-        lines = raw_data.splitlines()
-        for i, line in enumerate(lines):
-            if (i < len(lines) - 2):
-                # files & folders part
-                if ("/sdcard" in line and "s: " in lines[i+1]):
-                    # is file
-                    size = lines[i+1].split(" ")[-1]
-                    path_split = line.rsplit("/", 1)
-                    folder = path_split[0]
-                    name = path_split[1]
-                    folder_id = self.list_find(folders, folder)
-                    if (folder_id == -1):
-                        folder_id = len(folders)
-                        folders.append(folder)
-                    file_obj = {
-                        "name": name,
-                        "size": size,
-                        "folder": folder_id
-                    }
-                    files.append(file_obj)
-                else:
-                    # is folder
-                    if ("/sdcard" in line and line not in folders):
-                        folders.append(line)
-            else:
-                # Size data
-                data = line.split(" ")[-1]
-                if ("Free size:" in line):
-                    free_size = data
-                elif ("Taken size:" in line):
-                    taken_size = data
-
-        out_obj = {
-            "folders": folders,
-            "files": files,
-            "free_size": free_size,
-            "taken_size": taken_size
-        }
-        return out_obj
+        return parse_listing(raw_data)
+
+    def update_sd_data(self, update, *args):
+        # Keep the cached listing in sync with a change made on the card
+        if (self.sd_data is not None):
+            update(self.sd_data, *args)
+            self.sd_etag = uuid.uuid4().hex
 
+    def invalidate_sd_data(self):
+        self.sd_data = None
+        self.sd_etag = None
+
+    def sd_data_response(self):
+        if (self.sd_etag in flask.request.if_none_match):
+            response = flask.Response(status=304)
+        else:
+            response = flask.jsonify(self.sd_data)
+        response.set_etag(self.sd_etag)
+        return response
+
+    def heartbeat(self, s):
+        # Same exchange as is_control, without logging every few seconds.
+        # Also used on ports that may not be a MasterSD at all, so the first
+        # read timeout or any unexpected answer ends it.
+        try:
+            res = exchange(s, b'is_control\n', None, max_lines=1)
+        except CommandTimeout:
+            return None
+        if (not res.ok or res.lines not in (['true'], ['false'])):
+            return None
+        return res.lines == ['true']
+
+    @instrumented("is_control")
     def is_control(self, s):
         self._logger.info("Checking control...")
-        s.write(b'is_control\n')
-        ret = None
-        while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("Success!")
-                return ret
-            else:
-                self._logger.info("Received: %s", a.decode('ascii'))
-                if (a == b'true\n'):
-                    ret = True
-                elif (a == b'false\n'):
-                    ret = False
-                else:
-                    return None
+        ret = self.heartbeat(s)
+        self._logger.info("Control: %s", ret)
+        return ret
+
+    @instrumented("get_caps")
+    def get_caps(self, s):
+        # Firmware without capability support answers with something other
+        # than "<key> <value>" lines, in which case no extensions are used
+        self._logger.info("Checking device capabilities...")
+        try:
+            res = exchange(s, b'caps\n', None)
+        except CommandTimeout:
+            res = None
+        if (res is None or not res.ok):
+            self._logger.info("Capabilities not supported")
+            return {}
+        caps = {}
+        for line in res.lines:
+            parts = line.split()
+            if (len(parts) != 2):
+                self._logger.info("Capabilities not supported")
+                return {}
+            caps[parts[0]] = parts[1]
+        self._logger.info(f"Capabilities: {caps}")
+        return caps
+
+    def select_transfer_mode(self, requested):
+        supported = [MODE_ADD]
+        if (int(self.caps.get("window", 0)) > 1):
+            supported.append(MODE_WINDOW)
+        if ("frame" in self.caps):
+            supported.append(MODE_BINARY)
+
+        if (requested in (None, "auto")):
+            return supported[-1]
+        if (requested in supported):
+            return requested
+        self._logger.info(
+            f"Transfer mode {requested} not supported, falling back to add")
+        return MODE_ADD
 
+    @instrumented("take_control")
     def take_control(self, s):
         self._logger.info("Taking control of the SD card!")
-        s.write(b'take_control\n')  # Send data
-        while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("Success!")
-                return True
-            else:
-                self._logger.info("Failed")
-                return False
+        res = exchange(s, b'take_control\n')
+        self._logger.info("Success!" if res.ok else f"Failed: {res.lines}")
+        return res.ok
 
+    @instrumented("return_control")
     def return_control(self, s):
         self._logger.info("Returning control of the SD card!")
-        s.write(b'return_control\n')  # Send data
-        while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("Success!")
-                return True
-            else:
-                self._logger.info("Failed")
-                self._logger.info(a.decode('ascii'))
-                return False
-
+        res = exchange(s, b'return_control\n')
+        self._logger.info("Success!" if res.ok else f"Failed: {res.lines}")
+        return res.ok
+
+    def release_control(self, s):
+        # Returns the card and records it before the port is let go, so the
+        # heartbeat never sees the device and the plugin disagree
+        ret = self.return_control(s)
+        if (ret):
+            self.control = False
+        return ret
+
+    def switch_control(self, s):
+        if (self.control):
+            self._logger.info("Sending command to return control over serial")
+            return self.release_control(s)
+        self._logger.info("Sending command to take control over serial")
+        ret = self.take_control(s)
+        if (ret):
+            self.control = True
+        return ret
+
+    @instrumented("get_info")
     def get_info(self, s):
-        data = '/sdcard\n'
-        s.write(b'get_info\n')  # Send data
-        while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("Success!")
-                return data
-            else:
-                data += a.decode('ascii')
-                self._logger.info(a.decode('ascii'))
+        res = exchange(s, b'get_info\n')
+        if (not res.ok):
+            self._logger.info("Could not read the card")
+            return None
+        self._logger.info(f"Card listing: {len(res.lines)} lines")
+        return '/sdcard\n' + ''.join(line + '\n' for line in res.lines)
+
+    def can_compress(self):
+        # The compressed stream is binary, so it needs a framed mode
+        return (self.transfer_mode != MODE_ADD and
+                self.caps.get("codec") == CODEC_ZLIB)
+
+    def upload_stats(self, start, raw_bytes, wire_bytes):
+        seconds = max(time.monotonic() - start, 1e-6)
+        return {
+            "bytes": raw_bytes,
+            "wire_bytes": wire_bytes,
+            "ratio": round(raw_bytes / wire_bytes, 2) if wire_bytes else 1.0,
+            "seconds": round(seconds, 3),
+            "throughput": round(raw_bytes / seconds),
+            "wire_throughput": round(wire_bytes / seconds),
+        }
+
+    def fire_progress(self, progress, job=None):
+        # progress is a ProgressTracker snapshot
+        self._event_bus.fire(
+            octoprint.events.Events.PLUGIN_MASTERSD_UPLOAD_PROGRESS,
+            payload=dict(progress, device=self.device.id),
+        )
+        if (job is not None):
+            self.jobs.update(job, progress["percentage"], progress)
+
+    @instrumented("list_dir")
+    def list_dir(self, s, path, offset, limit):
+        # One page of a single directory, path is relative to the card root
+        res = exchange(s, b'ls %d %d ' % (offset, limit) +
+                       path.encode('ascii') + b'\n')
+        full_path = ("/sdcard/" + path).rstrip('/')
+        if (not res.ok):
+            self._logger.info("Listing %s failed!", full_path)
+            return None
+
+        entries = []
+        total = 0
+        free_size = 0
+        taken_size = 0
+        for line in res.lines:
+            kind, _, rest = line.partition(' ')
+            if (kind == 'd'):
+                entries.append(('folder', {'name': rest,
+                                           'path': full_path + '/' + rest}))
+            elif (kind == 'f'):
+                size, _, name = rest.partition(' ')
+                entries.append(('file', {'name': name, 'size': size}))
+            elif (kind == 'total'):
+                total = int(rest)
+            elif (kind == 'free'):
+                free_size = rest
+            elif (kind == 'taken'):
+                taken_size = rest
+        return listing.make_page(full_path, offset, limit, total, entries,
+                                 free_size, taken_size)
+
+    @instrumented("file_size")
+    def file_size(self, s, path):
+        # Size in bytes of a file on the card, None if it does not exist
+        res = exchange(s, b'stat ' + path.encode('ascii') + b'\n')
+        if (not res.ok):
+            return None
+        for line in res.lines:
+            if (line.startswith('s: ')):
+                return int(line[3:])
+        return None
+
+    def card_id(self):
+        # Firmware that can read the card's id reports it with its caps,
+        # otherwise the MasterSD itself stands in for the card
+        if ("card" in self.caps):
+            return self.caps["card"]
+        identity = self.conn.identity or {}
+        return identity.get("serial_number") or identity.get("port") or "default"
+
+    def is_present(self, s, card, sd_path, digest, minified=False):
+        entry = self.manifest.lookup(card, sd_path)
+        if (entry is None or entry["sha256"] != digest or
+                entry.get("minified", False) != minified):
+            return False
+        size = entry["size"]
+
+        # The manifest only knows what the plugin wrote, make sure the file
+        # is still on the card
+        if ("stat" in self.caps):
+            short_path = sd_path.replace("/sdcard/", "", 1)
+            return self.file_size(s, short_path) == size
+        if (self.sd_data is not None):
+            file_obj = listing.find_file(self.sd_data, sd_path)
+            return (file_obj is not None and
+                    int(file_obj["size"]) in (size // 1024, round(size / 1024)))
+        return False
+
+    def upload_chunk(self):
+        # Packet/frame size of the current transfer mode, starting where the
+        # last upload to this device ended
+        if (self.transfer_mode == MODE_BINARY):
+            maximum = int(self.caps["frame"])
+            default = min(maximum, BINARY_FRAME_SIZE)
+        elif (self.transfer_mode == MODE_WINDOW):
+            maximum = default = int(self.caps.get("chunk", self.ADD_MAX))
+        else:
+            maximum = int(self.caps.get("buffer", self.ADD_MAX))
+            default = self.ADD_MAX
+        if (not self._settings.get_boolean(["adaptive_chunk"])):
+            return AdaptiveChunk.fixed(default)
+        size = self.device_record().get("chunk", {}).get(
+            self.transfer_mode, default)
+        return AdaptiveChunk(size, ADAPT_MIN_CHUNK, maximum)
+
+    def remember_chunk(self, chunk):
+        sizes = dict(self.device_record().get("chunk", {}))
+        if (sizes.get(self.transfer_mode) != chunk.size):
+            sizes[self.transfer_mode] = chunk.size
+            self.record_device(chunk=sizes)
+
+    def device_record(self):
+        # Link parameters chosen for the connected device earlier
+        devices = self._settings.get(["devices"]) or {}
+        return devices.get(self.device_key) or {}
+
+    def record_device(self, **values):
+        if (self.device_key is None):
+            return
+        devices = dict(self._settings.get(["devices"]) or {})
+        record = dict(devices.get(self.device_key) or {})
+        record.update(values)
+        devices[self.device_key] = record
+        self._settings.set(["devices"], devices)
+        self._settings.save()
+
+    def negotiate_baudrate(self, s, retry=False):
+        # Moves the link to the fastest rate the device offers that this
+        # device and cable did not fail at recently. Failures are forgotten
+        # on `retry` and when the firmware reports different caps.
+        rates = sorted((int(r) for r in self.caps.get("rates", "").split(",")
+                        if r.isdigit()), reverse=True)
+        limit = self._settings.get_int(["max_baudrate"])
+        record = self.device_record()
+        failed = record.get("failed_rates")
+        if (retry or record.get("caps") != self.caps or
+                not isinstance(failed, dict)):
+            failed = {}
+        failed = dict(failed)
+        now = time.time()
+        for rate in rates:
+            if (rate <= s.baudrate):
+                break
+            if (limit and rate > limit):
+                continue
+            entry = failed.get(str(rate))
+            if (entry is not None and
+                    now - entry["at"] < self.BAUD_RETRY_AFTER * entry["count"]):
+                continue
+            if (self.switch_baudrate(s, rate)):
+                failed.pop(str(rate), None)
+                break
+            count = entry["count"] + 1 if entry is not None else 1
+            failed[str(rate)] = {"at": now, "count": count}
+        self._logger.info("Link running at %d baud", s.baudrate)
+        self.record_device(baudrate=s.baudrate, failed_rates=failed,
+                           caps=dict(self.caps))
+        return s.baudrate
+
+    def switch_baudrate(self, s, rate):
+        old = s.baudrate
+        self._logger.info("Switching to %d baud", rate)
+        if (not exchange(s, b'baud %d\n' % rate).ok):
+            return False
+        s.baudrate = rate
+        if (self.heartbeat(s) is not None):
+            return True
 
-    def write_file(self, s, path, name, total_size):
+        self._logger.info("No answer at %d baud, falling back", rate)
+        s.baudrate = old
+        time.sleep(self.BAUD_FALLBACK)
+        if (self.heartbeat(s) is None):
+            raise serial.SerialException("Lost the MasterSD switching baud rate")
+        return False
+
+    @instrumented("write_file")
+    def write_file(self, s, source, name, total_size, compress=False, job=None,
+                   offset=0, minify=False):
+        # Returns the upload stats on success and False on failure. The
+        # source is a local path or a StreamBuffer. With an offset the file
+        # on the card is appended to from that byte on. Minified uploads
+        # count offsets in minified bytes.
         self._logger.info("Writing to the SD card!")
+        start = time.monotonic()
+        compress = compress and self.can_compress()
 
         # 1 -- create file
-        s.write(b'write ' + name.encode('ascii'))
-        code = 0
-        while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("File created!")
-                code = 100
-                break
-            else:
-                self._logger.info("Did not create file!")
-                code = 400
-                return False
+        if (offset > 0):
+            self._logger.info("Resuming from byte %d", offset)
+            command = b'zappend ' if compress else b'append '
+        else:
+            command = b'zwrite ' if compress else b'write '
+        if (not exchange(s, command + name.encode('ascii')).ok):
+            self._logger.info("Did not create file!")
+            return False
+        self._logger.info("File created!")
 
         self._logger.info("Trying to read from file...")
         self._logger.info("Total size: %d", total_size)
-        with open(path, "r") as f:
-            counter = 0
-            while (True):
-                if (counter == 0):
-                    msg = f.read(self.ADD_MAX-4)
-                    if msg:
-                        msg = 'add ' + msg
-                else:
-                    msg = f.read(self.ADD_MAX)
-
-                if not msg:
-                    s.write(b'done\n')
-                    res_c = 0
-                    while (True):
-                        res_c += 1
-                        a = s.readline()
-                        if (a == b'done\n'):
-                            self._logger.info("Writting complete!")
-                            break
-                        elif (res_c > 2):
-                            return False
-                        else:
-                            self._logger.info(a.decode('ascii'))
-                    break
 
-                s.write(msg.encode('ascii'))
-                counter += 1
-                res_c = 0
-                while (True):
-                    res_c += 1
-                    a = s.readline()
-                    if (a == b'done\n'):
-
-                        # Refresh upload progress
-                        if (counter % 4200 == 0):
-                            uploaded = 60 + (counter - 1)*64
-                            perc = (uploaded/total_size)*100
-
-                            if (perc < 100):
-                                self._event_bus.fire(
-                                    octoprint.events.Events.PLUGIN_MASTERSD_UPLOAD_PROGRESS,
-                                    payload={"percentage": int(perc // 1)},
-                                )
-                        break
-                    elif (res_c > 2):
-                        return False
-            return True
+        minifier = None
+        if (minify):
+            # The minified stream is the same every time, skip what a
+            # previous attempt put on the card
+            f = minifier = GcodeMinifier(self.open_source(source))
+            minifier.skip(offset)
+            done = minifier.raw_bytes
+        else:
+            f = self.open_source(source, offset)
+            done = offset
 
-    def delete_file(self, s, path):
-        s.write(b'del ' + path.encode('ascii'))  # Send data
+        checker = None
+        if (self.can_verify()):
+            # Sees what reaches the card, after minifying and before
+            # compression
+            f = checker = ChecksumReader(f)
+
+        progress = ProgressTracker(
+            total_size, lambda p: self.fire_progress(p, job), done)
+
+        chunk = self.upload_chunk()
+        try:
+            with f:
+                if (self.transfer_mode != MODE_ADD):
+                    stats = self.write_file_framed(s, f, total_size, start,
+                                                   compress, job, offset,
+                                                   progress, chunk, minifier)
+                else:
+                    stats = self.write_file_add(s, f, start, job, offset,
+                                                progress, chunk, minifier)
+        finally:
+            self.remember_chunk(chunk)
+
+        if (stats and minifier is not None):
+            stats["card_bytes"] = minifier.out_bytes
+            stats["minify"] = self.minify_stats(minifier, stats)
+        if (stats and checker is not None):
+            stats["verify"] = self.verify_write(s, name, offset, checker)
+        return stats
+
+    def can_verify(self):
+        return ("crc" in self.caps and
+                self._settings.get_boolean(["verify_uploads"]))
+
+    @instrumented("verify_write")
+    def verify_write(self, s, name, offset, checker):
+        # Asks the device for the CRC32 of the file from `offset` on and
+        # compares it with what was sent. A file that does not match is
+        # deleted so a retry writes it from the start.
+        start = time.monotonic()
+        res = exchange(s, b'crc %d ' % offset +
+                       name.lstrip('/').encode('ascii') + b'\n')
+        crc = size = None
+        try:
+            for line in res.lines:
+                if (line.startswith('c: ')):
+                    crc = int(line[3:], 16)
+                elif (line.startswith('s: ')):
+                    size = int(line[3:])
+        except ValueError:
+            # A garbled answer counts as a mismatch
+            crc = size = None
+        seconds = round(time.monotonic() - start, 3)
+
+        if (not res.ok or crc != checker.crc or size != checker.size):
+            self._logger.info(
+                f"Verifying {name} failed: card has crc {crc} of {size} "
+                f"bytes, sent {checker.crc} of {checker.size}")
+            self.delete_file(s, name.lstrip('/'))
+            raise VerifyError(f"{name} does not match on the card")
+        self._logger.info(f"Verified {name} in {seconds}s")
+        return {"crc": "%08x" % crc, "seconds": seconds}
+
+    def open_source(self, source, offset=0):
+        # Local files are read ahead on a thread, request streams arrive
+        # on their own
+        if (isinstance(source, StreamBuffer)):
+            return source
+        return PrefetchReader(source, offset)
+
+    def minify_stats(self, minifier, stats):
+        saved = minifier.raw_bytes - minifier.out_bytes
+        throughput = stats["throughput"]
+        return {
+            "source_bytes": minifier.raw_bytes,
+            "card_bytes": minifier.out_bytes,
+            "saved_bytes": saved,
+            # Wire time the dropped bytes would have taken at this upload's rate
+            "saved_seconds": round(saved / throughput, 3) if throughput else 0,
+        }
+
+    def write_file_add(self, s, f, start, job, offset, progress, chunk,
+                       minifier=None):
+        cancel = job.cancel_event if job is not None else None
+        self._logger.info(f"add transfer: packets of {chunk.size} bytes")
+        counter = 0
+        sent = 0
         while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("Success!")
-                return True
-            elif (a == b'failed\n'):
-                self._logger.info("Wrong filename!")
+            if (cancel is not None and cancel.is_set()):
+                self._logger.info("Upload cancelled!")
                 return False
+
+            if (counter == 0):
+                data = f.read(chunk.size-4)
+                msg = b'add ' + data if data else data
+            else:
+                data = msg = f.read(chunk.size)
+
+            if not msg:
+                if (not exchange(s, b'done\n').ok):
+                    return False
+                self._logger.info("Writting complete!")
+                break
+
+            s.write(msg)
+            counter += 1
+            if (self.metrics is not None):
+                self.metrics.count("frames_sent")
+            res_c = 0
+            while (True):
+                res_c += 1
+                a = s.readline()
+                if (a == b'done\n'):
+                    sent += len(data)
+                    progress.update(minifier.raw_bytes if minifier
+                                    else offset + sent)
+                    chunk.ok()
+                    break
+                chunk.error()
+                if (res_c > 2):
+                    return False
+                if (self.metrics is not None):
+                    self.metrics.count("packets_retried")
+        return self.upload_stats(start, sent, sent)
+
+    def write_file_framed(self, s, f, total_size, start, compress, job, offset,
+                          progress, chunk, minifier=None):
+        window = max(int(self.caps.get("window", 1)), 1)
+        send = send_binary if self.transfer_mode == MODE_BINARY else send_windowed
+        self._logger.info(
+            f"{self.transfer_mode} transfer: {window} frames of {chunk.size} bytes")
+        reader = None
+
+        def on_progress(uploaded):
+            # Acks count bytes on the wire, report source bytes instead
+            if (minifier is not None):
+                progress.update(minifier.raw_bytes)
+            elif (reader is not None):
+                progress.update(offset + reader.raw_bytes)
+            else:
+                progress.update(offset + uploaded)
+
+        if (compress):
+            reader = CompressedReader(
+                f, int(self.caps.get("zwin", ZLIB_WBITS)))
+            f = reader
+        cancel = job.cancel_event if job is not None else None
+        if not send(s, f, chunk, window, on_progress, cancel, self.metrics):
+            return False
+
+        if (reader is not None):
+            stats = self.upload_stats(
+                start, reader.raw_bytes, reader.wire_bytes)
+        else:
+            if (minifier is not None):
+                sent = minifier.out_bytes - offset
             else:
-                self._logger.info(a.decode('ascii'))
+                sent = total_size - offset
+            stats = self.upload_stats(start, sent, sent)
 
+        if (not exchange(s, b'done\n').ok):
+            return False
+        self._logger.info(f"Writting complete! {stats}")
+        return stats
+
+    def close_write(self, s):
+        # Leave write mode after a failed transfer, keeping what was written.
+        # Acks still on their way are read past.
+        try:
+            return exchange(s, b'done\n').ok
+        except CommandTimeout:
+            self._logger.info("No answer closing the file")
+            return False
+
+    def resume_offset(self, s, name, total_size):
+        # Bytes of the file already on the card, 0 when it has to start over
+        if ("stat" not in self.caps or "append" not in self.caps):
+            return 0
+        size = self.file_size(s, name.lstrip('/'))
+        if (size is None or size > total_size):
+            return 0
+        return size
+
+    def abort_write(self, s, name):
+        # Close the half written file and remove it from the card
+        self._logger.info("Aborting write of %s", name)
+        self.close_write(s)
+        return self.delete_file(s, name.lstrip('/'))
+
+    @instrumented("delete_file")
+    def delete_file(self, s, path):
+        res = exchange(s, b'del ' + path.encode('ascii'))
+        self._logger.info("Success!" if res.ok else "Wrong filename!")
+        return res.ok
+
+    @instrumented("make_dir")
     def make_dir(self, s, name):
         self._logger.info("Creating a directory on the SD card")
 
-        s.write(b'mkdir ' + name.encode('ascii'))  # Send data
-        while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("Success!")
-                return True
-            elif (a == b'failed\n'):
-                self._logger.info("Make directory failed!")
-                return False
-            else:
-                self._logger.info(a.decode('ascii'))
+        res = exchange(s, b'mkdir ' + name.encode('ascii'))
+        self._logger.info("Success!" if res.ok else "Make directory failed!")
+        return res.ok
 
+    @instrumented("remove_dir")
     def remove_dir(self, s, path):
         self._logger.info(
             "Removing a directory and subdirectories on the SD card!")
 
-        s.write(b'rmdir ' + path.encode('ascii'))  # Send data
-        while (True):
-            a = s.readline()
-            if (a == b'done\n'):
-                self._logger.info("Success!")
-                return True
-            elif (a == b'failed\n'):
-                self._logger.info("Remove directory failed!")
-                return False
-            else:
-                self._logger.info(a.decode('ascii'))
+        res = exchange(s, b'rmdir ' + path.encode('ascii'))
+        self._logger.info("Success!" if res.ok else "Remove directory failed!")
+        return res.ok
+
+    # Card changes by full /sdcard path, keeping the cached listing and
+    # the manifest in sync
+
+    def sd_delete(self, s, path):
+        res = self.delete_file(s, path.replace("/sdcard/", "", 1))
+        if (res):
+            self.update_sd_data(listing.remove_file, path)
+            self.manifest.remove(self.card_id(), path)
+        return res
+
+    def sd_mkdir(self, s, path):
+        res = self.make_dir(s, path.replace("/sdcard/", "", 1))
+        if (res):
+            self.update_sd_data(listing.add_folder, path)
+        return res
+
+    def sd_rmdir(self, s, path):
+        res = self.remove_dir(s, path.replace("/sdcard/", "", 1))
+        if (res):
+            self.update_sd_data(listing.remove_folder, path)
+            self.manifest.remove_folder(self.card_id(), path)
+        return res
+
+    def initialize(self):
+        # Before the server asks for the blueprint, which reads the device
+        # attributes
+        self.metrics = Metrics()
+        self.devices = DeviceRegistry()
+        device = self.devices.add(self.make_device(DEFAULT_DEVICE, True))
+        device.remembered = self._settings.get(["last_device"])
+        # Units added through the API, connected again on request
+        known = self._settings.get(["known_devices"]) or {}
+        for key, identity in known.items():
+            device = self.devices.add(self.make_device(key))
+            device.remembered = identity
 
     def on_after_startup(self):
         self._logger.info("Master SD backend")
-        self.ser = None
-        self.control = False
+        self.short_name_lookup = None
+        self.connect_lock = threading.Lock()
+        self.manifest = Manifest(
+            os.path.join(self.get_plugin_data_folder(), "manifest.json"))
+
+    def get_blueprint(self):
+        # Routes are found by reading every public attribute, the ones kept
+        # per device included
+        with self.devices.use(self.devices.get()):
+            return super().get_blueprint()
+
+    def make_device(self, key, printer=False):
+        # Every device gets its own port lock, transport and upload worker,
+        # so they all work in parallel
+        conn = ConnectionManager(
+            self.heartbeat, None,
+            self._settings.get_float(["heartbeat_interval"]), self.metrics)
+        device = Device(key, conn, printer=printer)
+        conn.on_state = self.devices.bind(device, self.on_connection_state)
+        device.transport = CommandTransport(conn)
+        device.jobs = JobQueue(self.devices.bind(device, self.run_job),
+                               self.devices.bind(device, self.send_job_update))
+        # The printer's unit keeps the spool folder of single device setups
+        folder = "spool" if printer else "spool-" + folder_name(key)
+        device.spool = Spool(
+            os.path.join(self.get_plugin_data_folder(), folder))
+        return device
+
+    def get_settings_defaults(self):
+        return dict(
+            # Upload mode: auto (best the device supports), add, window or binary
+            transfer_mode="auto",
+            # Compress uploads when the device can inflate them
+            compress_uploads=True,
+            # Entries per page of the folder listing
+            list_page_size=200,
+            # Handshake timeout in seconds when looking for the MasterSD
+            probe_timeout=0.5,
+            # USB identity of the port the MasterSD last answered on
+            last_device=None,
+            # Seconds between link checks while connected
+            heartbeat_interval=5.0,
+            # Skip uploads of files already written to the card unchanged
+            dedupe_uploads=True,
+            # Times a failed upload is resumed before the job fails
+            upload_retries=3,
+            # Baud rate the MasterSD is probed at
+            baudrate=4000000,
+            # Highest rate negotiated with devices offering faster ones, 0
+            # for no limit
+            max_baudrate=0,
+            # Grow the upload chunk size while acks come back clean and
+            # shrink it on errors
+            adaptive_chunk=True,
+            # Negotiated baud rate, failed rates and chunk sizes per device
+            devices={},
+            # USB identity of every MasterSD added next to the default one,
+            # by device id
+            known_devices={},
+            # Seconds an autorun waits for the file in the printer's listing
+            short_name_timeout=60.0,
+            # Strip comments, thumbnails and redundant words from G-code
+            # while uploading
+            minify_gcode=False,
+            # Keep uploads made while the printer owns the card and write
+            # them once the MasterSD has it again
+            spool_uploads=True,
+            # Take the card for spooled uploads on its own between prints
+            spool_auto_drain=True,
+            # Compare the CRC32 of every written file with the device's
+            # when it can compute one, failed checks write the file again
+            verify_uploads=True,
+            # Largest body in bytes /stream_sd accepts, read at server start
+            stream_max_size=MAX_STREAM_SIZE,
+            # Sidebar uploads go straight to the card through /stream_sd
+            # instead of being stored in OctoPrint first
+            stream_uploads=False,
+        )
 
-        self.find_name = ''
-        self.find_path = ''
-        self.is_listing = False
+    def on_connection_state(self, connected, control):
+        # Link dropped, came back or the control state changed on the device
+        self._logger.info(f"Connection state: {connected}, control: {control}")
+        self.invalidate_sd_data()
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            {"type": "connection", "device": self.device.id,
+             "connected": connected, "control": control})
 
     def on_event(self, event, payload):
 
@@ -260,6 +795,12 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
             self.run_autorefresh()
         elif event == octoprint.events.Events.DISCONNECTED:
             self._logger.info("Printer disconnected event triggered!")
+        elif event in (octoprint.events.Events.PRINT_DONE,
+                       octoprint.events.Events.PRINT_FAILED,
+                       octoprint.events.Events.PRINT_CANCELLED):
+            # Between prints, get the spooled uploads onto the card
+            with self.devices.use(self.devices.get()):
+                self.drain_spool(auto=True)
 
     def get_assets(self):
         return dict(
@@ -270,38 +811,170 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
     def is_blueprint_csrf_protected(self):
         return True
 
-    @octoprint.plugin.BlueprintPlugin.route("/connect", methods=["POST"])
+    @octoprint.plugin.BlueprintPlugin.errorhandler(DeviceBusy)
+    def mastersd_busy(self, error):
+        return flask.Response(
+            "Device is busy!",
+            status=400
+        )
+
+    @octoprint.plugin.BlueprintPlugin.errorhandler(CommandTimeout)
+    def mastersd_timeout(self, error):
+        return flask.Response(
+            "MasterSD did not answer in time",
+            status=504
+        )
+
+    @octoprint.plugin.BlueprintPlugin.errorhandler(serial.SerialException)
+    def mastersd_serial_error(self, error):
+        self._logger.info(f"Serial error: {error}")
+        return flask.Response(
+            "Serial communication failed",
+            status=400
+        )
+
+    @device_route("/connect", methods=["POST"])
     def mastersd_connect(self):
         self._logger.info("Attempting to connect to masterSD!")
         data = flask.request.json
-        ports = data.get('ports')
+        mode = data.get('mode', self._settings.get(["transfer_mode"]))
 
-        rate = "4000000"
-        timeout = 2.0  # 2 sec timeout
-        for port in ports:
-            self._logger.info("Attempting to connect to port: %s", port)
-            try:
-                ser = serial.Serial(port, rate, timeout=timeout)
-                ret = self.is_control(ser)
-                if (ret is not None):
-                    self.control = ret
-                    self.ser = ser
-                    return flask.jsonify(self.control)
-                else:
-                    self.ser = None
-                    self._logger.info("Return is None")
-                    pass
-            except:
-                self.ser = None
-                self._logger.info("Could not connect")
-                pass
+        with self.connect_lock:
+            found = self.find_device(data.get('ports'), self.device.remembered,
+                                     exclude=self.device)
+            if (found is not None):
+                self.attach_device(found, mode, data.get('retry_rates', False))
+                return flask.jsonify(self.control)
 
         return flask.Response(
             "Could not connect to masterSD",
             status=400
         )
 
-    @octoprint.plugin.BlueprintPlugin.route("/disconnect", methods=["GET"])
+    @octoprint.plugin.BlueprintPlugin.route("/devices", methods=["GET"])
+    def mastersd_devices(self):
+        return flask.jsonify(
+            [device.as_dict() for device in self.devices.list()])
+
+    @octoprint.plugin.BlueprintPlugin.route("/devices", methods=["POST"])
+    def mastersd_add_device(self):
+        # Connects one more MasterSD on a port no device uses yet, known by
+        # its port or serial number from then on
+        self._logger.info("Attempting to connect another masterSD!")
+        data = flask.request.json
+        mode = data.get('mode', self._settings.get(["transfer_mode"]))
+
+        with self.connect_lock:
+            found = self.find_device(data.get('ports'), None)
+            if (found is not None):
+                key = device_id(port_identity(found[0]))
+                device = self.devices.get(key)
+                if (device is None):
+                    device = self.devices.add(self.make_device(key))
+                with self.devices.use(device):
+                    self.attach_device(found, mode)
+                return flask.jsonify(device.as_dict())
+
+        return flask.Response(
+            "Could not connect to masterSD",
+            status=400
+        )
+
+    @octoprint.plugin.BlueprintPlugin.route("/devices/<device_id>",
+                                            methods=["DELETE"])
+    def mastersd_remove_device(self, device_id):
+        # Disconnects a unit added through the API and forgets it
+        device = self.devices.get(device_id)
+        if (device is None):
+            return flask.Response(
+                "Unknown device",
+                status=404
+            )
+        if (device.id == DEFAULT_DEVICE):
+            return flask.Response(
+                "The default device cannot be removed",
+                status=400
+            )
+        if (device.busy or any(not job.is_finished
+                               for job in device.jobs.list())):
+            return flask.Response(
+                "Device is busy!",
+                status=400
+            )
+        if (len(device.spool)):
+            return flask.Response(
+                "Uploads are still spooled for the device",
+                status=400
+            )
+
+        with self.devices.use(device):
+            if (self.ser is not None and self.control):
+                self.run_command(self.release_control)
+            self.conn.detach()
+        device.transport.close()
+        self.devices.remove(device.id)
+        self.remember_devices()
+        self._logger.info(f"Removed masterSD {device.id}")
+        return flask.jsonify(success=True)
+
+    def remember_devices(self):
+        # Added units come back on the next start
+        self._settings.set(["known_devices"], {
+            device.id: device.remembered for device in self.devices.list()
+            if device.id != DEFAULT_DEVICE})
+        self._settings.save()
+
+    def find_device(self, ports, remembered, exclude=None):
+        # Probes `ports` for a MasterSD, leaving alone the ports of devices
+        # other than `exclude`. Returns (port, ser, control) or None.
+        in_use = self.devices.ports_in_use(exclude)
+        ports = [port for port in ports if port not in in_use]
+        rate = self._settings.get_int(["baudrate"])
+        probe_timeout = self._settings.get_float(["probe_timeout"])
+
+        # Try the port the MasterSD answered on last time on its own first,
+        # then everything else at once
+        remembered = find_remembered(ports, remembered)
+        candidates = [ports]
+        if (remembered is not None):
+            self._logger.info("Trying remembered port first: %s", remembered)
+            candidates = [[remembered], [p for p in ports if p != remembered]]
+
+        for group in candidates:
+            self._logger.info("Attempting to connect to ports: %s", group)
+            found = probe_ports(group, rate, probe_timeout, self.is_control)
+            if (found is not None):
+                return found
+        return None
+
+    def attach_device(self, found, mode, retry_rates=False):
+        # Hands a port find_device answered on to the current device,
+        # `retry_rates` tries baud rates that failed before again
+        port, ser, ret = found
+        timeout = 2.0  # 2 sec timeout
+        self.invalidate_sd_data()
+        self.caps = self.get_caps(ser)
+        self.transfer_mode = self.select_transfer_mode(mode)
+        ser.timeout = timeout
+
+        identity = port_identity(port)
+        self.device_key = device_key(identity)
+        self.device.remembered = identity
+        self.conn.attach(ser, port, identity, ret)
+        if (self.device.printer):
+            self._settings.set(["last_device"], identity)
+            self._settings.save()
+        else:
+            self.remember_devices()
+        # Reconnects probe at the base rate, the switch only lasts for
+        # this connection
+        # Every failed rate costs a read timeout and the fallback wait
+        self.run_command(self.negotiate_baudrate, retry_rates,
+                         timeout=NO_TIMEOUT)
+        self._logger.info(f"Connected to masterSD {self.device.id} on {port}")
+        self.drain_spool(auto=True)
+
+    @device_route("/disconnect", methods=["GET"])
     def mastersd_disconnect(self):
         if self.busy:
             return flask.Response(
@@ -316,14 +989,16 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
                 if (self.control):
                     self._logger.info(
                         "Sending command to return control over serial")
-                    ret = self.return_control(self.ser)
+                    ret = self.run_command(self.release_control)
                     if (ret):
-                        self._printer.init_sd_card()
-                        self.control = not self.control
+                        self.card_returned()
                     else:
                         self._logger.info("Failed to return control")
-                self.ser.close()
-                self.ser = None
+                self.conn.detach()
+                self.device_key = None
+                self.caps = {}
+                self.transfer_mode = MODE_ADD
+                self.invalidate_sd_data()
                 self._logger.info("Disconnected successfully!")
                 return flask.jsonify(success=True)
             else:
@@ -337,24 +1012,11 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
             status=400
         )
 
-    @octoprint.plugin.BlueprintPlugin.route("/write_sd", methods=["POST"])
+    @device_route("/write_sd", methods=["POST"])
     def mastersd_write(self):
-        if self.busy:
-            return flask.Response(
-                "Device is busy!",
-                status=400
-            )
-
         self._logger.info("Attempting to write to SD!")
         data = flask.request.json
         name = data.get('name')
-        path = data.get('path')
-        autorun = data.get('run')
-        path = path.replace("/sdcard", "", 1)
-        if path != "":
-            path = path + '/' + name
-        else:
-            path = name
 
         if (not name):
             return flask.Response(
@@ -362,48 +1024,527 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
                 status=400
             )
 
+        job = self.make_upload_job(name, data.get('path'),
+                                   autorun=data.get('run'),
+                                   compress=data.get('compress'),
+                                   minify=data.get('minify'))
+        self.jobs.submit(job)
+        return flask.jsonify(job.as_dict())
+
+    @device_route("/batch", methods=["POST"])
+    def mastersd_batch(self):
+        # Ordered card operations run as one job, see BatchJob
+        data = flask.request.get_json(silent=True)
+        if (not isinstance(data, dict)):
+            return flask.Response(
+                "Expected a JSON object",
+                status=400
+            )
+        operations = data.get('operations')
+
+        if (not operations or not isinstance(operations, list)):
+            return flask.Response(
+                "No operations",
+                status=400
+            )
+        for op in operations:
+            error = self.check_operation(op)
+            if (error is not None):
+                return flask.Response(
+                    error,
+                    status=400
+                )
+
+        run = data.get('run')
+        if (run and not any(op.get('op') == 'upload' and op.get('name') == run
+                            for op in operations)):
+            return flask.Response(
+                "File to run is not uploaded by the batch",
+                status=400
+            )
+
+        job = BatchJob(operations, data.get('stop_on_error', False), run)
+        self.jobs.submit(job)
+        return flask.jsonify(job.as_dict())
+
+    @device_route("/spool", methods=["GET"])
+    def mastersd_spool(self):
+        return flask.jsonify(self.spool.entries())
+
+    @device_route("/spool/drain", methods=["POST"])
+    def mastersd_spool_drain(self):
+        # Takes the card for it when the printer is idle
+        job = self.drain_spool(auto=not self.control)
+        if (job is None):
+            return flask.Response(
+                "Nothing to drain or the printer is busy",
+                status=400
+            )
+        return flask.jsonify(job.as_dict())
+
+    @device_route("/spool/delete", methods=["POST"])
+    def mastersd_spool_delete(self):
+        data = flask.request.get_json(silent=True)
+        path = data.get('path') if isinstance(data, dict) else None
+        if (not isinstance(path, str)):
+            return flask.Response(
+                "Path is None",
+                status=400
+            )
+        if (not self.spool.remove(path)):
+            return flask.Response(
+                "Not spooled",
+                status=404
+            )
+        self.send_spool_update()
+        return flask.jsonify(success=True)
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def mastersd_metrics(self):
+        # JSON by default, ?format=prometheus for the text exposition format
+        if (flask.request.values.get('format') == 'prometheus'):
+            return flask.Response(
+                self.metrics.prometheus(),
+                mimetype="text/plain; version=0.0.4"
+            )
+        return flask.jsonify(self.metrics.as_dict())
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics/reset", methods=["POST"])
+    def mastersd_metrics_reset(self):
+        self.metrics.reset()
+        return flask.jsonify(success=True)
+
+    @device_route("/jobs", methods=["GET"])
+    def mastersd_jobs(self):
+        return flask.jsonify([job.as_dict() for job in self.jobs.list()])
+
+    @device_route("/jobs/<job_id>", methods=["GET"])
+    def mastersd_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if (job is None):
+            return flask.Response(
+                "Unknown job",
+                status=404
+            )
+        return flask.jsonify(job.as_dict())
+
+    @device_route("/jobs/<job_id>/resume", methods=["POST"])
+    def mastersd_resume_job(self, job_id):
+        job = self.jobs.resume(job_id)
+        if (job is None):
+            return flask.Response(
+                "Job cannot be resumed",
+                status=400
+            )
+        return flask.jsonify(job.as_dict())
+
+    @device_route("/jobs/<job_id>/cancel", methods=["POST"])
+    def mastersd_cancel_job(self, job_id):
+        if (not self.jobs.cancel(job_id)):
+            return flask.Response(
+                "Job not running",
+                status=400
+            )
+        return flask.jsonify(success=True)
+
+    def send_job_update(self, job):
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            {"type": "job", "device": self.device.id, "job": job.as_dict()})
+
+    def upload(self, job, path):
+        # Writes the job's file, resuming from what reached the card when a
+        # transfer fails or the link drops
+        retries = self._settings.get_int(["upload_retries"])
+        if (not job.resumable):
+            retries = 0
+        attempt = 0
+        resume = job.resume
+        while (True):
+            try:
+                with self.conn.session(timeout=None) as s:
+                    offset = 0
+                    if (resume):
+                        offset = self.resume_offset(s, path, job.size)
+                    job.offset = offset
+                    try:
+                        res = self.write_file(s, job.source, path, job.size,
+                                              job.compress, job, offset,
+                                              job.minify)
+                    except StreamClosed:
+                        # The browser went away mid upload
+                        self.abort_write(s, path)
+                        raise
+                    except VerifyError as e:
+                        # Already deleted, retries start over
+                        self._logger.info(str(e))
+                        res = False
+                    else:
+                        if (not res):
+                            if (job.cancel_event.is_set()):
+                                self.abort_write(s, path)
+                            else:
+                                self.close_write(s)
+            except (serial.SerialException, CommandTimeout) as e:
+                self._logger.info(f"Serial error during upload: {e}")
+                res = False
+
+            if (res or job.cancel_event.is_set()):
+                return res
+            attempt += 1
+            if (attempt > retries):
+                return False
+            self._logger.info(
+                f"Upload failed, retrying ({attempt}/{retries})")
+            if (self.metrics is not None):
+                self.metrics.count("upload_retries")
+            resume = True
+            time.sleep(1.0)
+
+    def run_job(self, job):
+        if (isinstance(job, SpoolJob)):
+            return self.run_spool_job(job)
+        if (isinstance(job, BatchJob)):
+            return self.run_batch_job(job)
+        return self.run_upload_job(job)
+
+    def run_upload_job(self, job):
+        if (self.ser is None or not self.control):
+            if (not self._settings.get_boolean(["spool_uploads"])):
+                raise IOError("MasterSD not in control")
+            return self.spool_upload(job)
+
+        self.busy = True
+        try:
+            result = self.store_file(job)
+        finally:
+            self.busy = False
+
+        self._logger.info(f"Autorun state: {job.autorun}")
+        if (job.autorun and self.can_autorun()):
+            self.start_print(job.name, job.path)
+        return result
+
+    def store_file(self, job, keep_source=False):
+        # Puts the job's file on the card, skipping it when the card already
+        # holds the same content, and updates the listing and manifest. The
+        # local file is removed afterwards unless `keep_source` is set.
+        path = job.path
+        sd_path = "/sdcard/" + path.lstrip('/')
+        card = self.card_id()
+        digest = None
+        dedupe = self._settings.get_boolean(["dedupe_uploads"])
+        if (dedupe and job.path_on_disk is not None):
+            digest = file_digest(job.path_on_disk)
+
+        present = False
+        res = None
+        # Queued behind whatever holds the port
+        with self.conn.session(timeout=None) as s:
+            if (digest is not None and
+                    self.is_present(s, card, sd_path, digest, job.minify)):
+                self._logger.info(f"{sd_path} already on the card")
+                present = True
+            else:
+                self.manifest.remove(card, sd_path)
+        if (not present):
+            res = self.upload(job, path)
+
+        if (not res and not present):
+            raise IOError("Could not write to masterSD")
+
+        self._logger.info("Writting successful!")
+        if (job.path_on_disk is not None and not keep_source):
+            self._file_manager.remove_file(self.local, job.path_on_disk)
+        size = job.size
+        if (dedupe and isinstance(job, StreamUploadJob)):
+            # Streams are hashed while they are written
+            digest = job.stream.digest()
+        if (not present):
+            # Minified files are smaller on the card than on disk
+            size = res.get("card_bytes", job.size)
+            if (digest is not None):
+                self.manifest.record(card, sd_path, digest, size, job.minify)
+            self.update_sd_data(listing.add_file, sd_path, round(size / 1024))
+
+        return {'name': job.name, 'size': round(size / 1024),
+                'autorun': job.autorun, 'stats': res,
+                'already_present': present}
+
+    def start_print(self, name, path):
+        self._logger.info("Autorun attempt!")
+        # Switch SD control
+        ret = self.run_command(self.release_control)
+        if (ret):
+            self.invalidate_sd_data()
+            # Init SD card
+            self.card_returned()
+            # self._printer.commands("M21")
+            # Run print once the printer lists the file
+            folder = ''
+            if (path[0] == '/'):
+                folder = path.replace(name, "", 1)
+            self.short_name_lookup = ShortNameLookup(
+                name, folder, self._settings.get_float(["short_name_timeout"]))
+            self._logger.info(f"Finding short name...")
+        return ret
+
+    def run_batch_job(self, job):
+        # All operations share one session, control is taken once up front
+        # and handed back at most once at the end
+        if (self.ser is None):
+            raise IOError("MasterSD not connected")
+
+        self.busy = True
+        try:
+            # Steps open their own sessions inside this one so they pick up
+            # a port reopened after a dropped link
+            with self.conn.session(timeout=None):
+                if (not self.control):
+                    if (not self.run_command(self.take_control)):
+                        raise IOError("Could not take control of the SD")
+                    self.card_taken()
+                    self.control = True
+                    self.invalidate_sd_data()
+
+                for op in job.operations:
+                    if (job.cancel_event.is_set()):
+                        break
+                    result = {'op': op.get('op'), 'path': op.get('path')}
+                    try:
+                        result['result'] = self.run_operation(job, op)
+                        result['success'] = True
+                    except Exception as e:
+                        self._logger.info(f"Batch operation failed: {e}")
+                        result['success'] = False
+                        result['error'] = str(e)
+                    job.results.append(result)
+                    self.jobs.update(job, job.progress(0))
+                    if (not result['success'] and job.stop_on_error):
+                        break
+        finally:
+            self.busy = False
+
+        if (job.cancel_event.is_set()):
+            raise IOError("Batch cancelled")
+
+        failed = len([r for r in job.results if not r['success']])
+        ran = None
+        if (job.run and self.can_autorun() and not failed):
+            run = next(r['result'] for r in job.results
+                       if r['op'] == 'upload' and r['result']['name'] == job.run)
+            ran = self.start_print(run['name'], run['path'])
+
+        return {'results': job.results,
+                'succeeded': len(job.results) - failed,
+                'failed': failed,
+                'skipped': len(job.operations) - len(job.results),
+                'autorun': ran}
+
+    def spool_upload(self, job):
+        # Keeps the upload until the card is back with the MasterSD
+        if (isinstance(job, StreamUploadJob)):
+            progress = ProgressTracker(
+                job.size, lambda p: self.fire_progress(p, job))
+            entry = self.spool.add_stream(job.path, job.name, job.stream,
+                                          job.compress, job.minify,
+                                          progress.update)
+        else:
+            entry = self.spool.add_file(job.path, job.name, job.path_on_disk,
+                                        job.compress, job.minify)
+            self._file_manager.remove_file(self.local, job.path_on_disk)
+        # Written on the next drain, the printer keeps the card until then
+        self.send_spool_update()
+        return {'name': job.name, 'size': round(entry['size'] / 1024),
+                'autorun': False, 'stats': None, 'already_present': False,
+                'spooled': True}
+
+    def printer_busy(self):
+        # A unit not attached to this OctoPrint's printer counts as busy,
+        # there is no telling whether its printer reads the card
+        if (not self.device.printer):
+            return True
+        return self._printer.is_printing() or self._printer.is_paused()
+
+    def can_autorun(self):
+        return self.device.printer and self._printer.is_ready()
+
+    def card_taken(self):
+        # The MasterSD has the card now, the printer reading it lets go
+        if (self.device.printer):
+            self._printer.release_sd_card()
+
+    def card_returned(self):
+        if (self.device.printer):
+            self._printer.init_sd_card()
+
+    def drain_spool(self, auto=False):
+        # Queues a job writing everything spooled. Automatic drains only
+        # happen while the printer is idle.
+        if (self.ser is None or not len(self.spool)):
+            return None
+        if (auto and (not self._settings.get_boolean(["spool_auto_drain"]) or
+                      self.printer_busy())):
+            return None
+        for job in self.jobs.list():
+            # The queued drain picks up whatever is spooled when it starts
+            if (isinstance(job, SpoolJob) and job.state == job.QUEUED):
+                return job
+        self._logger.info(f"Draining {len(self.spool)} spooled uploads")
+        return self.jobs.submit(SpoolJob([], auto))
+
+    def run_spool_job(self, job):
+        # One session for the whole spool, an automatic drain takes the card
+        # only for as long as it needs it
+        if (self.ser is None):
+            raise IOError("MasterSD not connected")
+
+        job.operations = self.spool.entries()
+        took = False
+        self.busy = True
+        try:
+            with self.conn.session(timeout=None):
+                if (not self.control):
+                    if (not job.auto or self.printer_busy()):
+                        raise IOError("MasterSD not in control")
+                    if (not self.run_command(self.take_control)):
+                        raise IOError("Could not take control of the SD")
+                    self.card_taken()
+                    self.control = True
+                    took = True
+                    self.invalidate_sd_data()
+
+                try:
+                    for entry in job.operations:
+                        if (job.cancel_event.is_set()):
+                            break
+                        result = {'op': 'upload', 'path': entry['path']}
+                        try:
+                            upload = UploadJob(
+                                entry['name'],
+                                self.spool.blob_path(entry['sha256']),
+                                entry['path'], entry['size'],
+                                compress=entry['compress'],
+                                minify=entry['minify'], batch=job)
+                            result['result'] = self.store_file(
+                                upload, keep_source=True)
+                            result['success'] = True
+                            self.spool.remove(entry['path'], entry['sha256'])
+                        except Exception as e:
+                            self._logger.info(f"Spooled upload failed: {e}")
+                            result['success'] = False
+                            result['error'] = str(e)
+                        job.results.append(result)
+                        self.jobs.update(job, job.progress(0))
+                finally:
+                    if (took and self.run_command(self.release_control)):
+                        self.invalidate_sd_data()
+                        self.card_returned()
+        finally:
+            self.busy = False
+            self.send_spool_update()
+
+        if (job.cancel_event.is_set()):
+            raise IOError("Spool drain cancelled")
+
+        failed = len([r for r in job.results if not r['success']])
+        return {'results': job.results,
+                'succeeded': len(job.results) - failed,
+                'failed': failed,
+                'remaining': len(self.spool),
+                'returned_control': took and not self.control}
+
+    def send_spool_update(self):
+        self._plugin_manager.send_plugin_message(
+            self._identifier,
+            {"type": "spool", "device": self.device.id,
+             "entries": self.spool.entries()})
+
+    def check_operation(self, op):
+        # Why a batch operation cannot run, None if it looks fine
+        if (not isinstance(op, dict)):
+            return "Operation is not an object"
+        kind = op.get('op')
+        if (kind not in BatchJob.OPERATIONS):
+            return f"Unknown operation {kind}"
+        path = op.get('path')
+        if (kind == 'upload'):
+            # The path is the folder to upload to, the card root if left out
+            if (not op.get('name') or not isinstance(op.get('name'), str)):
+                return "Name is None"
+            if (path is not None and not isinstance(path, str)):
+                return "Path is not a string"
+        elif (not path or not isinstance(path, str)):
+            return "Path is None"
+        return None
+
+    def run_operation(self, batch, op):
+        kind = op.get('op')
+        path = op.get('path')
+        if (kind == 'upload'):
+            upload = self.make_upload_job(
+                op.get('name'), path, compress=op.get('compress'),
+                minify=op.get('minify'), batch=batch)
+            result = self.store_file(upload)
+            result['path'] = upload.path
+            return result
+        if (not path):
+            raise ValueError("Path is None")
+        if (kind == 'delete'):
+            res = self.run_command(self.sd_delete, path)
+        elif (kind == 'mkdir'):
+            res = self.run_command(self.sd_mkdir, path)
+        elif (kind == 'rmdir'):
+            res = self.run_command(self.sd_rmdir, path)
+        else:
+            raise ValueError(f"Unknown operation {kind}")
+        if (not res):
+            raise IOError(f"Could not {kind} {path}")
+        return None
+
+    def make_upload_job(self, name, path, autorun=False, compress=None,
+                        minify=None, batch=None):
+        # Upload of the local file `name` into the card folder `path`
+        if (not name):
+            raise ValueError("Name is None")
+        compress, minify = self.upload_options(name, compress, minify)
+        path = self.card_path(name, path)
+
         self._logger.info("Searching for file %s", name)
         path_on_disk = self._file_manager.path_on_disk(self.local, name)
         file_info = os.stat(path_on_disk)
         file_size_bytes = file_info.st_size
-        size = round(file_size_bytes / 1024)
         self._logger.info(f"Path: {path_on_disk}, Path on SD: {path}")
 
-        self.busy = True
-        res = self.write_file(self.ser, path_on_disk, path, file_size_bytes)
-        self.busy = False
-
-        if (res):
-            self._logger.info("Writting successful!")
-            self._file_manager.remove_file(self.local, path_on_disk)
-
-            self._logger.info(f"Autorun state: {autorun}")
-
-            if (self._printer.is_ready() and autorun):
-                self._logger.info("Autorun attempt!")
-                # Switch SD control
-                ret = self.return_control(self.ser)
-                if (ret):
-                    self.control = not self.control
-                    # Init SD card
-                    self._printer.init_sd_card()
-                    # self._printer.commands("M21")
-                    # Run print
-                    if (path[0] == '/'):
-                        path = path.replace(name, "", 1)
-                        self.find_path = path.upper()
-
-                    self.find_name = name
-                    self._logger.info(f"Finding short name...")
-
-            return flask.jsonify({'name': name, 'size': size, 'autorun': autorun})
-
-        return flask.Response(
-            "Could not connect to masterSD",
-            status=400
-        )
+        return UploadJob(name, path_on_disk, path, file_size_bytes,
+                         autorun=autorun, compress=compress, minify=minify,
+                         batch=batch)
+
+    def make_stream_job(self, name, path, size, autorun=False, compress=None,
+                        minify=None):
+        # Upload of a request body into the card folder `path`, see
+        # StreamUploadHandler
+        compress, minify = self.upload_options(name, compress, minify)
+        path = self.card_path(name, path)
+        self._logger.info(f"Streaming {name} to {path}, {size} bytes")
+        return StreamUploadJob(name, StreamBuffer(), path, size,
+                               autorun=autorun, compress=compress,
+                               minify=minify)
+
+    def upload_options(self, name, compress=None, minify=None):
+        if (compress is None):
+            compress = self._settings.get_boolean(["compress_uploads"])
+        if (minify is None):
+            minify = self._settings.get_boolean(["minify_gcode"])
+        return compress, minify and is_gcode(name)
+
+    def card_path(self, name, path):
+        path = (path or "").replace("/sdcard", "", 1)
+        if path != "":
+            return path + '/' + name
+        return name
 
-    @octoprint.plugin.BlueprintPlugin.route("/switch_control", methods=["GET"])
+    @device_route("/switch_control", methods=["GET"])
     def mastersd_switch_control(self):
         if self.busy:
             return flask.Response(
@@ -419,40 +1560,32 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
                 status=400
             )
 
-        try:
-            if (self.control):
-                self._logger.info(
-                    "Sending command to return control over serial")
-                ret = self.return_control(self.ser)
-                # command = "M21"  # Init SD
-            else:
-                self._logger.info(
-                    "Sending command to take control over serial")
-                ret = self.take_control(self.ser)
-                # command = "M22"  # Release SD
+        # DeviceBusy, CommandTimeout and serial errors go to the errorhandlers
+        ret = self.run_command(self.switch_control)
 
-            if (ret):
-                if (self.control):
-                    self._printer.init_sd_card()
-                else:
-                    self._printer.release_sd_card()
-                self.control = not self.control
-                # self._printer.commands(command)
-                return flask.jsonify(self.control)
+        if (ret):
+            if (self.control):
+                self.card_taken()
+                self.drain_spool()
             else:
-                self._logger.info("Failed to take control")
-                pass
-        except:
-            self._logger.info("Could not connect")
-            pass
+                self.card_returned()
+            self.invalidate_sd_data()
+            return flask.jsonify(self.control)
+        self._logger.info("Failed to switch control")
 
         return flask.Response(
             "Could not switch the state of the SD",
             status=400
         )
 
-    @octoprint.plugin.BlueprintPlugin.route("/get_info", methods=["GET"])
+    @device_route("/get_info", methods=["GET"])
     def mastersd_get_info(self):
+        # The cached listing is kept up to date by every change made through
+        # the plugin, ?refresh=true forces reading it from the card again
+        refresh = flask.request.values.get('refresh', 'false') == 'true'
+        if (self.sd_data is not None and self.control and not refresh):
+            return self.sd_data_response()
+
         if self.busy:
             return flask.Response(
                 "Device is busy!",
@@ -477,24 +1610,87 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
                 status=400
             )
 
-        self._logger.info("Sending command to get_info over serial")
-        data = self.get_info(self.ser)
-        self._logger.info(f"Received: {data}")
-
-        if (data):
-            self.sd_data = self.get_sd_data(data)
+        if (self.load_sd_data()):
             self._logger.info("Sending SD data!")
-            return flask.jsonify(self.sd_data)
-        else:
-            self._logger.info("No response!")
-            pass
+            return self.sd_data_response()
 
         return flask.Response(
             "Could not get info from the SD",
             status=400
         )
 
-    @octoprint.plugin.BlueprintPlugin.route("/delete", methods=["POST"])
+    def load_sd_data(self):
+        self._logger.info("Sending command to get_info over serial")
+        # Big cards take longer than any fixed limit, the reads still fail
+        # once the device stops sending
+        data = self.run_command(self.get_info, timeout=NO_TIMEOUT)
+        self._logger.info(f"Received: {data}")
+
+        if (data):
+            self.sd_data = self.get_sd_data(data)
+            self.sd_etag = uuid.uuid4().hex
+            return True
+
+        self._logger.info("No response!")
+        return False
+
+    @device_route("/list", methods=["GET"])
+    def mastersd_list(self):
+        if (self.ser is None or not self.ser.is_open):
+            return flask.Response(
+                "Serial communication closed",
+                status=400
+            )
+        if (not self.control):
+            return flask.Response(
+                "MasterSD not in control",
+                status=400
+            )
+
+        values = flask.request.values
+        path = values.get('path', '/sdcard').rstrip('/')
+        try:
+            offset = max(int(values.get('offset', 0)), 0)
+            limit = int(values.get(
+                'limit', self._settings.get_int(["list_page_size"])))
+        except ValueError:
+            return flask.Response(
+                "Invalid offset or limit",
+                status=400
+            )
+
+        if ("ls" in self.caps):
+            if self.busy:
+                return flask.Response(
+                    "Device is busy!",
+                    status=400
+                )
+            short_path = path.replace("/sdcard", "", 1).strip('/')
+            page = self.run_command(self.list_dir, short_path, offset, limit)
+        else:
+            # Firmware without paged listing, page the whole card listing
+            refresh = values.get('refresh', 'false') == 'true'
+            if (self.sd_data is None or refresh):
+                if self.busy:
+                    return flask.Response(
+                        "Device is busy!",
+                        status=400
+                    )
+                if (not self.load_sd_data()):
+                    return flask.Response(
+                        "Could not get info from the SD",
+                        status=400
+                    )
+            page = listing.page_folder(self.sd_data, path, offset, limit)
+
+        if (page is None):
+            return flask.Response(
+                "Could not list folder",
+                status=404
+            )
+        return flask.jsonify(page)
+
+    @device_route("/delete", methods=["POST"])
     def mastersd_delete(self):
         if self.busy:
             return flask.Response(
@@ -514,7 +1710,7 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
 
         short_path = path.replace("/sdcard/", "", 1)
         self._logger.info(f"Deleting: {short_path}")
-        res = self.delete_file(self.ser, short_path)
+        res = self.run_command(self.sd_delete, path)
         if (res):
             self._logger.info("Delete successful!")
             return flask.jsonify(success=True)
@@ -524,7 +1720,7 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
             status=400
         )
 
-    @octoprint.plugin.BlueprintPlugin.route("/mkdir", methods=["POST"])
+    @device_route("/mkdir", methods=["POST"])
     def mastersd_mkdir(self):
         if self.busy:
             return flask.Response(
@@ -544,7 +1740,7 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
 
         short_path = path.replace("/sdcard/", "", 1)
         self._logger.info(f"Creating path: {short_path}")
-        res = self.make_dir(self.ser, short_path)
+        res = self.run_command(self.sd_mkdir, path)
         if (res):
             self._logger.info("Folder created successfully!")
             return flask.jsonify(success=True)
@@ -554,7 +1750,7 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
             status=400
         )
 
-    @octoprint.plugin.BlueprintPlugin.route("/rmdir", methods=["POST"])
+    @device_route("/rmdir", methods=["POST"])
     def mastersd_rmdir(self):
         if self.busy:
             return flask.Response(
@@ -574,7 +1770,7 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
 
         short_path = path.replace("/sdcard/", "", 1)
         self._logger.info(f"Deleting path: {short_path}")
-        res = self.remove_dir(self.ser, short_path)
+        res = self.run_command(self.sd_rmdir, path)
         if (res):
             self._logger.info("Folder deleted successfully!")
             return flask.jsonify(success=True)
@@ -586,21 +1782,15 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
 
     # Custom port refreshing
 
-    def refresh_serial_list(self):
-
-        if not self._printer.is_operational():
-            return
-
-        new_ports = sorted(serialList())
-        if new_ports != self.last_ports:
-            self._logger.info(
-                "Custom serial port list was updated, refreshing the port list in the frontend"
-            )
-            self._event_bus.fire(
-                octoprint.events.Events.CONNECTIONS_AUTOREFRESHED,
-                payload={"ports": new_ports},
-            )
+    def ports_changed(self, new_ports):
+        self._logger.info(
+            "Custom serial port list was updated, refreshing the port list in the frontend"
+        )
         self.last_ports = new_ports
+        self._event_bus.fire(
+            octoprint.events.Events.CONNECTIONS_AUTOREFRESHED,
+            payload={"ports": new_ports},
+        )
 
     def autorefresh_active(self):
         # Autorefresh when printer is connected
@@ -617,51 +1807,59 @@ class MasterSDPlugin(octoprint.plugin.StartupPlugin,
             self.autorefresh.cancel()
             self.autorefresh = None
 
-        self.autorefresh = RepeatedTimer(
-            2.0,
-            self.refresh_serial_list,
-            condition=self.autorefresh_active,
-            on_finish=self.autorefresh_stopped,
+        # Wakes up on device nodes appearing or going away in /dev instead
+        # of listing the ports every few seconds
+        self.autorefresh = PortWatcher(
+            serialList,
+            self.ports_changed,
+            self.autorefresh_active,
+            on_stop=self.autorefresh_stopped,
+            ports=self.last_ports,
         )
-        self.autorefresh.name = "Custom serial autorefresh worker"
 
         self._logger.info(
             "Starting custom autorefresh of serial port list")
         self.autorefresh.start()
 
     def get_short_filename(self, comm, line, *args, **kwargs):
-        if self.find_name == '':
+        # Runs for every line the printer sends, only an autorun waiting
+        # for its file's short name looks at them
+        lookup = self.short_name_lookup
+        if lookup is None:
             return line
 
-        if "Begin file list" in line and not self.is_listing:
-            self.is_listing = True
-            return line
-
-        if "End file list" in line and self.is_listing:
-            self.is_listing = False
+        short_name = lookup.feed(line)
+        if (short_name is None):
+            if (not lookup.listing and lookup.expired):
+                self._logger.info(
+                    f"{lookup.name} not found in the SD listing, giving up")
+                self.short_name_lookup = None
             return line
 
-        if self.find_name in line and self.is_listing:
-
-            if self.find_path != '':
-                if self.find_path in line:
-                    short_path = self.find_path.lower()
-                else:
-                    return line
-            else:
-                short_path = ''
+        self._logger.info(f"Short name: {short_name}")
+        self._printer.select_file(
+            path=short_name.lower(), sd=True, printAfterSelect=True)
+        # Don't search anymore
+        self.short_name_lookup = None
+        return line
 
-            self._logger.info(f"Found line with short name: {line}")
-            short_name = line.split(' ', 1)[0]
-            self._logger.info(f"Short name: {short_name}")
+    # Streamed uploads bypass Flask, which would buffer the whole body
+    def get_server_routes(self, server_routes, *args, **kwargs):
+        from octoprint.access.permissions import Permissions
+        from octoprint.server import app
+        from octoprint.server.util.flask import permission_validator
+        from octoprint.server.util.tornado import access_validation_factory
 
-            self._printer.select_file(
-                path=short_name.lower(), sd=True, printAfterSelect=True)
-            # Don't search anymore
-            self.find_name = ''
-            self.find_path = ''
+        return [
+            (r"/stream_sd", StreamUploadHandler, dict(
+                plugin=self,
+                access_validation=access_validation_factory(
+                    app, permission_validator, Permissions.FILES_UPLOAD))),
+        ]
 
-        return line
+    def get_body_sizes(self, current_max_body_sizes, *args, **kwargs):
+        return [("POST", r"/stream_sd",
+                 self._settings.get_int(["stream_max_size"]))]
 
     # Upload progress tracking custom event
     def register_custom_events(*args, **kwargs):
@@ -683,4 +1881,6 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.comm.protocol.gcode.received": plugin.get_short_filename,
         "octoprint.events.register_custom_events": __plugin_implementation__.register_custom_events,
+        "octoprint.server.http.routes": plugin.get_server_routes,
+        "octoprint.server.http.bodysize": plugin.get_body_sizes,
     }
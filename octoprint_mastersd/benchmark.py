@@ -0,0 +1,231 @@
+"""
+Throughput benchmark for the MasterSD serial protocol, run against the
+simulator so no hardware is needed:
+
+    python -m octoprint_mastersd.benchmark --upload-mb 2 --latency 0.001
+
+Reports upload MB/s per transfer mode, per-command latency and the time
+spent fetching and parsing listings of synthetic cards.
+"""
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import octoprint.events
+
+from . import MasterSDPlugin
+from .connection import ConnectionManager
+from .devices import DEFAULT_DEVICE, Device, DeviceRegistry
+from .simulator import LoopbackSerial, MasterSDSimulator, PtySimulator
+from .transfer import MODE_ADD, MODE_BINARY, MODE_WINDOW, VerifyError
+
+LISTING_SIZES = [10, 100, 1000, 10000, 100000]
+
+
+class BenchmarkSettings(object):
+    """Plugin settings backed by the plugin defaults."""
+
+    def __init__(self, defaults):
+        self._values = dict(defaults)
+
+    def get(self, path):
+        return self._values.get(path[0])
+
+    def get_boolean(self, path):
+        return bool(self.get(path))
+
+    def get_int(self, path):
+        return int(self.get(path))
+
+    def get_float(self, path):
+        return float(self.get(path))
+
+    def set(self, path, value):
+        self._values[path[0]] = value
+
+    def save(self):
+        pass
+
+
+class NullEventBus(object):
+
+    def fire(self, event, payload=None):
+        pass
+
+
+def make_plugin():
+    octoprint.events.Events.register_event(
+        "upload_progress", prefix="plugin_mastersd_")
+    plugin = MasterSDPlugin()
+    plugin._logger = logging.getLogger("octoprint.plugins.mastersd")
+    plugin._settings = BenchmarkSettings(plugin.get_settings_defaults())
+    plugin._event_bus = NullEventBus()
+    # Never attached, the benchmark drives the port itself
+    plugin.devices = DeviceRegistry()
+    plugin.devices.add(Device(DEFAULT_DEVICE,
+                              ConnectionManager(plugin.heartbeat)))
+    return plugin
+
+
+def open_serial(sim, args):
+    if not args.pty:
+        return LoopbackSerial(sim, args.baudrate, args.latency, args.timeout), None
+
+    import serial
+
+    server = PtySimulator(sim, args.baudrate, args.latency).start()
+    return serial.Serial(server.port, args.baudrate, timeout=args.timeout), server
+
+
+def make_gcode(path, size):
+    rnd = random.Random(0)
+    with open(path, "w") as f:
+        f.write("; generated by the MasterSD benchmark\n;LAYER:0\n")
+        written = 0
+        while written < size:
+            line = "G1 X%.3f Y%.3f E%.5f\n" % (
+                rnd.uniform(0, 220), rnd.uniform(0, 220), rnd.uniform(0, 2))
+            if rnd.random() < 0.01:
+                line += ";TYPE:WALL-OUTER\n"
+            f.write(line)
+            written += len(line)
+
+
+def connect(plugin, sim, args, mode):
+    ser, server = open_serial(sim, args)
+    plugin.control = plugin.is_control(ser)
+    plugin.caps = plugin.get_caps(ser)
+    plugin.transfer_mode = plugin.select_transfer_mode(mode)
+    return ser, server
+
+
+def close(ser, server):
+    ser.close()
+    if server is not None:
+        server.stop()
+
+
+def bench_upload(plugin, args):
+    fd, path = tempfile.mkstemp(suffix=".gcode")
+    os.close(fd)
+    size = int(args.upload_mb * 1024 * 1024)
+    make_gcode(path, size)
+    size = os.stat(path).st_size
+    with open(path, "rb") as f:
+        content = f.read()
+
+    print("\nUpload of %.2f MB" % (size / 1024.0 / 1024.0))
+    print("%-16s %10s %10s %8s %10s %8s" % (
+        "mode", "seconds", "MB/s", "ratio", "verify ms", "ok"))
+    runs = [(MODE_ADD, False), (MODE_WINDOW, False), (MODE_BINARY, False),
+            (MODE_BINARY, True)]
+    try:
+        for mode, compress in runs:
+            sim = MasterSDSimulator(error_rate=args.error_rate,
+                                    corrupt_rate=args.corrupt_rate, seed=1)
+            ser, server = connect(plugin, sim, args, mode)
+            start = time.monotonic()
+            try:
+                res = plugin.write_file(ser, path, "bench.gcode", size,
+                                        compress)
+            except VerifyError:
+                res = False
+            seconds = time.monotonic() - start
+            close(ser, server)
+
+            ok = bool(res) and bytes(sim.files.get("bench.gcode", b"")) == content
+            ratio = res["ratio"] if res else 0
+            verify = (res["verify"]["seconds"] * 1000
+                      if res and "verify" in res else 0)
+            label = mode + (" + zlib" if compress else "")
+            print("%-16s %10.3f %10.3f %8.2f %10.3f %8s" % (
+                label, seconds, size / seconds / 1024 / 1024, ratio, verify,
+                ok))
+    finally:
+        os.remove(path)
+
+
+def bench_commands(plugin, args):
+    sim = MasterSDSimulator()
+    ser, server = connect(plugin, sim, args, "auto")
+    commands = [
+        ("is_control", lambda i: plugin.is_control(ser)),
+        ("take_control", lambda i: plugin.take_control(ser)),
+        ("mkdir", lambda i: plugin.make_dir(ser, "bench%d" % i)),
+        ("del", lambda i: plugin.delete_file(ser, "missing%d" % i)),
+        ("rmdir", lambda i: plugin.remove_dir(ser, "bench%d" % i)),
+    ]
+
+    print("\nCommand latency over %d rounds (ms)" % args.rounds)
+    print("%-16s %10s %10s %10s" % ("command", "median", "p95", "max"))
+    try:
+        for name, command in commands:
+            samples = []
+            for i in range(args.rounds):
+                start = time.monotonic()
+                command(i)
+                samples.append((time.monotonic() - start) * 1000)
+            samples.sort()
+            print("%-16s %10.3f %10.3f %10.3f" % (
+                name, statistics.median(samples),
+                samples[int(len(samples) * 0.95) - 1], samples[-1]))
+    finally:
+        close(ser, server)
+
+
+def bench_listing(plugin, args):
+    print("\nListing")
+    print("%-16s %12s %12s %12s" % ("files", "get_info s", "parse s",
+                                     "ls page s"))
+    for files in args.files:
+        sim = MasterSDSimulator()
+        sim.add_tree(files)
+        ser, server = connect(plugin, sim, args, "auto")
+        try:
+            start = time.monotonic()
+            raw = plugin.get_info(ser)
+            fetched = time.monotonic()
+            plugin.get_sd_data(raw)
+            parsed = time.monotonic()
+            plugin.list_dir(ser, "jobs0", 0, 200)
+            paged = time.monotonic()
+        finally:
+            close(ser, server)
+        print("%-16d %12.3f %12.3f %12.3f" % (
+            files, fetched - start, parsed - fetched, paged - parsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MasterSD protocol benchmark")
+    parser.add_argument("--baudrate", type=int, default=4000000)
+    parser.add_argument("--latency", type=float, default=0.0005,
+                        help="device response latency in seconds")
+    parser.add_argument("--timeout", type=float, default=0.2,
+                        help="serial read timeout in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0,
+                        help="share of packets stored with a flipped byte")
+    parser.add_argument("--upload-mb", type=float, default=1.0)
+    parser.add_argument("--rounds", type=int, default=100)
+    parser.add_argument("--files", type=int, nargs="+", default=LISTING_SIZES,
+                        help="synthetic card sizes for the listing benchmark")
+    parser.add_argument("--pty", action="store_true",
+                        help="talk to the simulator through a pty with pyserial")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    plugin = make_plugin()
+    with plugin.devices.use(plugin.devices.get()):
+        bench_upload(plugin, args)
+        bench_commands(plugin, args)
+        bench_listing(plugin, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import contextlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+from serial.tools import list_ports
+from octoprint.util import RepeatedTimer
+
+from .metrics import MeteredSerial
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.connection")
+
+# How long a command waits for the port before the device counts as busy
+BUSY_TIMEOUT = 5.0
+RECONNECT_TIMEOUT = 0.5
+HEARTBEAT_INTERVAL = 5.0
+
+
+class DeviceBusy(Exception):
+    pass
+
+
+def port_identity(port):
+    """USB identity of a port, used to find the MasterSD again after the
+    device node changed."""
+    for info in list_ports.comports():
+        if info.device == port:
+            return {
+                "port": port,
+                "serial_number": info.serial_number,
+                "vid": info.vid,
+                "pid": info.pid,
+            }
+    return {"port": port, "serial_number": None, "vid": None, "pid": None}
+
+
+def device_key(identity):
+    """Stable name of a device for per-device settings."""
+    if identity.get("serial_number"):
+        return "sn:%s" % identity["serial_number"]
+    if identity.get("vid") is not None:
+        return "usb:%04x:%04x@%s" % (identity["vid"], identity["pid"],
+                                     identity["port"])
+    return "port:%s" % identity["port"]
+
+
+def find_remembered(ports, remembered):
+    """Returns the port in `ports` that is most likely the remembered device."""
+    if not remembered:
+        return None
+    identities = [port_identity(port) for port in ports]
+
+    if remembered.get("serial_number"):
+        for identity in identities:
+            if identity["serial_number"] == remembered["serial_number"]:
+                return identity["port"]
+    if remembered.get("vid") is not None:
+        matches = [identity["port"] for identity in identities
+                   if (identity["vid"], identity["pid"]) ==
+                   (remembered["vid"], remembered["pid"])]
+        if len(matches) == 1:
+            return matches[0]
+    if remembered.get("port") in ports:
+        return remembered["port"]
+    return None
+
+
+def probe_port(port, rate, timeout, handshake):
+    """
+    Opens `port` and runs `handshake(ser)` on it. Returns (ser, result) if
+    the handshake answered, otherwise closes the port and returns None.
+    """
+    ser = None
+    try:
+        ser = serial.Serial(port, rate, timeout=timeout)
+        ret = handshake(ser)
+    except Exception as e:
+        _logger.info("Could not probe %s: %s", port, e)
+        ret = None
+
+    if ret is None:
+        if ser is not None:
+            ser.close()
+        return None
+    return ser, ret
+
+
+def probe_ports(ports, rate, timeout, handshake):
+    """
+    Probes all ports at once. Returns (port, ser, result) of the first port
+    in `ports` that answered, every other opened port is closed again.
+    """
+    if not ports:
+        return None
+
+    with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+        results = list(executor.map(
+            lambda port: probe_port(port, rate, timeout, handshake), ports))
+
+    found = None
+    for port, result in zip(ports, results):
+        if result is None:
+            continue
+        if found is None:
+            found = (port, result[0], result[1])
+        else:
+            result[0].close()
+    return found
+
+
+class ConnectionManager(object):
+    """
+    Owner of the MasterSD serial port.
+
+    Every command runs inside `session()`, which holds one lock for the
+    whole exchange so requests, upload jobs and the heartbeat never
+    interleave on the wire. A heartbeat checks the link while it is idle
+    and, when the port drops, reopens the same USB device without probing
+    other ports.
+
+    `handshake(ser)` returns the control state or None if the device did
+    not answer, `on_state(connected, control)` is called when the link is
+    lost or restored and when the control state changed behind our back.
+    With `metrics` the port handed out by sessions counts its traffic.
+    """
+
+    def __init__(self, handshake, on_state=None,
+                 heartbeat_interval=HEARTBEAT_INTERVAL, metrics=None):
+        self.handshake = handshake
+        self.on_state = on_state
+        self.heartbeat_interval = heartbeat_interval
+        self.metrics = metrics
+
+        self.ser = None
+        self.port = None
+        self.identity = None
+        self.rate = None
+        self.timeout = None
+        self.control = None
+
+        self._lock = threading.RLock()
+        # Sessions the current thread is in
+        self._held = threading.local()
+        self._heartbeat = None
+
+    @property
+    def connected(self):
+        return self.ser is not None and self.ser.is_open
+
+    def attach(self, ser, port, identity, control):
+        with self._lock:
+            if self.ser is not None and self.ser is not ser:
+                self.ser.close()
+            self.ser = ser
+            self.port = port
+            self.identity = identity
+            self.rate = ser.baudrate
+            self.timeout = ser.timeout
+            self.control = control
+        self._start_heartbeat()
+
+    def detach(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        with self._lock:
+            if self.ser is not None:
+                self.ser.close()
+            self.ser = None
+            self.identity = None
+
+    @contextlib.contextmanager
+    def session(self, timeout=BUSY_TIMEOUT):
+        """
+        Exclusive use of the port, yields the serial object. Waits up to
+        `timeout` seconds for the port (forever if None) and raises
+        DeviceBusy after that.
+        """
+        if timeout is None:
+            acquired = self._lock.acquire()
+        else:
+            acquired = self._lock.acquire(timeout=timeout)
+        if not acquired:
+            raise DeviceBusy()
+
+        self._held.depth = getattr(self._held, "depth", 0) + 1
+        try:
+            if self.ser is None and self.identity is not None:
+                self._reconnect()
+            if self.ser is None:
+                raise serial.SerialException("MasterSD not connected")
+            try:
+                if self.metrics is None:
+                    yield self.ser
+                else:
+                    yield MeteredSerial(self.ser, self.metrics)
+            except (serial.SerialException, OSError):
+                self._lost()
+                raise
+        finally:
+            self._held.depth -= 1
+            self._lock.release()
+
+    def holds_port(self):
+        """True inside a session on the calling thread."""
+        return getattr(self._held, "depth", 0) > 0
+
+    def run(self, command, *args, **kwargs):
+        with self.session() as s:
+            return command(s, *args, **kwargs)
+
+    def _start_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        self._heartbeat = RepeatedTimer(
+            self.heartbeat_interval,
+            self._beat,
+            condition=lambda: self.identity is not None,
+        )
+        self._heartbeat.name = "MasterSD heartbeat"
+        self._heartbeat.start()
+
+    def _beat(self):
+        # Whoever holds the port is talking to the device anyway
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self.ser is None:
+                self._reconnect()
+                return
+            try:
+                control = self.handshake(self.ser)
+            except (serial.SerialException, OSError):
+                control = None
+            if control is None:
+                _logger.info("MasterSD heartbeat failed, reconnecting")
+                self._lost()
+                self._reconnect()
+            elif control != self.control:
+                self.control = control
+                self._notify(True, control)
+        finally:
+            self._lock.release()
+
+    def _lost(self):
+        if self.ser is None:
+            return
+        try:
+            self.ser.close()
+        except Exception:
+            pass
+        self.ser = None
+        self._notify(False, None)
+
+    def _reconnect(self):
+        ports = [info.device for info in list_ports.comports()]
+        if self.port not in ports and os.path.exists(self.port):
+            ports.append(self.port)
+        port = find_remembered(ports, self.identity)
+        if port is None:
+            return False
+
+        result = probe_port(port, self.rate, RECONNECT_TIMEOUT, self.handshake)
+        if result is None:
+            return False
+
+        ser, control = result
+        ser.timeout = self.timeout
+        self.ser = ser
+        self.port = port
+        self.control = control
+        _logger.info("Reconnected to MasterSD on %s", port)
+        self._notify(True, control)
+        return True
+
+    def _notify(self, connected, control):
+        if self.on_state is not None:
+            try:
+                self.on_state(connected, control)
+            except Exception:
+                _logger.exception("Error in connection state callback")
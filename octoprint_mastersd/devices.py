@@ -0,0 +1,151 @@
+import collections
+import contextlib
+import functools
+import logging
+import re
+import threading
+
+from .connection import device_key
+from .transfer import MODE_ADD
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.devices")
+
+# Slot of the MasterSD attached to OctoPrint's printer, also what API
+# calls without a device id address
+DEFAULT_DEVICE = "default"
+
+
+class NoDeviceSelected(RuntimeError):
+    pass
+
+
+class Device(object):
+    """
+    One MasterSD: its ConnectionManager, the CommandTransport and JobQueue
+    working on it, its spool and what the plugin knows about the device
+    and its card. `printer` is set for the unit whose card OctoPrint's
+    printer reads, only that one hands the card to the printer.
+    """
+
+    def __init__(self, id, conn, transport=None, jobs=None, spool=None,
+                 printer=False):
+        self.id = id
+        self.conn = conn
+        self.transport = transport
+        self.jobs = jobs
+        self.spool = spool
+        self.printer = printer
+
+        # USB identity the device was last connected on
+        self.remembered = None
+        # Key of the device in the `devices` setting
+        self.device_key = None
+        self.caps = {}
+        self.transfer_mode = MODE_ADD
+        self.sd_data = None
+        self.sd_etag = None
+        self.busy = False
+
+    @property
+    def port(self):
+        # Kept while a dropped link is being reconnected
+        return self.conn.port if self.conn.identity is not None else None
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "port": self.port,
+            "connected": self.conn.connected,
+            "control": bool(self.conn.control),
+            "busy": self.busy,
+            "printer": self.printer,
+            "transfer_mode": self.transfer_mode,
+            "spooled": len(self.spool) if self.spool is not None else 0,
+        }
+
+
+def device_attribute(name):
+    """Plugin attribute kept on the device the calling thread works for."""
+    def get(self):
+        return getattr(self.device, name)
+
+    def set(self, value):
+        setattr(self.device, name, value)
+
+    return property(get, set)
+
+
+def device_id(identity):
+    """device_key of a port identity usable as one URL path segment."""
+    return device_key(identity).replace("/", "_")
+
+
+def folder_name(device_id):
+    # Device ids carry ports and serial numbers, keep them path safe
+    return re.sub(r"[^\w.-]", "_", device_id)
+
+
+class DeviceRegistry(object):
+    """
+    MasterSDs known to the plugin by id, the default slot first. Threads
+    work for one device at a time: `use(device)` selects it for the
+    calling thread and `bind(device, func)` wraps a callable running on
+    another thread. `current` raises NoDeviceSelected on a thread that
+    did neither.
+    """
+
+    def __init__(self):
+        self._devices = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self, device):
+        with self._lock:
+            self._devices[device.id] = device
+        _logger.info(f"Registered MasterSD {device.id}")
+        return device
+
+    def remove(self, device_id):
+        with self._lock:
+            device = self._devices.pop(device_id, None)
+        if (device is not None):
+            _logger.info(f"Removed MasterSD {device_id}")
+        return device
+
+    def get(self, device_id=None):
+        with self._lock:
+            if (device_id is None):
+                device_id = DEFAULT_DEVICE
+            return self._devices.get(device_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._devices.values())
+
+    def ports_in_use(self, exclude=None):
+        # Ports other devices are attached to, never probed for a new one
+        return {device.port for device in self.list()
+                if device is not exclude and device.port is not None}
+
+    @property
+    def current(self):
+        device = getattr(self._local, "device", None)
+        if (device is None):
+            raise NoDeviceSelected("No MasterSD selected on this thread")
+        return device
+
+    @contextlib.contextmanager
+    def use(self, device):
+        previous = getattr(self._local, "device", None)
+        self._local.device = device
+        try:
+            yield device
+        finally:
+            self._local.device = previous
+
+    def bind(self, device, func):
+        @functools.wraps(func)
+        def bound(*args, **kwargs):
+            with self.use(device):
+                return func(*args, **kwargs)
+        return bound
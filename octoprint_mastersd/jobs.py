@@ -0,0 +1,288 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.jobs")
+
+# Finished jobs kept around so the frontend can still query them
+MAX_FINISHED = 50
+
+
+class Job(object):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.state = self.QUEUED
+        self.percentage = 0
+        # Bytes sent, rate and ETA of the running transfer
+        self.transfer = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self.state in (self.DONE, self.FAILED, self.CANCELLED)
+
+    def release(self):
+        # Called once the job finished, frees what it still holds
+        pass
+
+    def interrupt(self):
+        # Called when the running job is cancelled, wakes it where it waits
+        # on something else than the card
+        pass
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "percentage": self.percentage,
+            "transfer": self.transfer,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class UploadJob(Job):
+    # A failed upload can continue from what reached the card
+    resumable = True
+
+    def __init__(self, name, path_on_disk, path, size, autorun=False,
+                 compress=False, minify=False, batch=None):
+        super().__init__()
+        self.name = name
+        self.path_on_disk = path_on_disk
+        self.path = path
+        self.size = size
+        self.autorun = autorun
+        self.compress = compress
+        self.minify = minify
+
+        # Continue the file already on the card instead of starting over
+        self.resume = False
+        # Byte the last transfer attempt started from
+        self.offset = 0
+        # Batch the upload is a step of, progress is reported on the batch
+        self.batch = batch
+        if batch is not None:
+            self.cancel_event = batch.cancel_event
+
+    @property
+    def source(self):
+        # What write_file reads the upload from
+        return self.path_on_disk
+
+    def as_dict(self):
+        data = super().as_dict()
+        data.update({
+            "type": "upload",
+            "name": self.name,
+            "path": self.path,
+            "size": self.size,
+            "autorun": self.autorun,
+            "minify": self.minify,
+            "offset": self.offset,
+            "resumable": self.resumable,
+        })
+        return data
+
+
+class StreamUploadJob(UploadJob):
+    """
+    Upload read from an HTTP request body through a StreamBuffer instead
+    of a local file. What was read is gone, so it cannot be resumed.
+    """
+
+    resumable = False
+
+    def __init__(self, name, stream, path, size, **kwargs):
+        super().__init__(name, None, path, size, **kwargs)
+        self.stream = stream
+
+    @property
+    def source(self):
+        return self.stream
+
+    def release(self):
+        # Stops the request still sending the body
+        self.stream.close()
+
+    def interrupt(self):
+        # A stalled request would keep the read waiting
+        self.stream.close()
+
+
+class BatchJob(Job):
+    """
+    Ordered list of card operations run in one serial session. Every
+    operation is a dict with `op` (upload, delete, mkdir or rmdir) and
+    `path`, uploads also carry the local file's `name`.
+    """
+
+    OPERATIONS = ("upload", "delete", "mkdir", "rmdir")
+
+    def __init__(self, operations, stop_on_error=False, run=None):
+        super().__init__()
+        self.operations = operations
+        self.stop_on_error = stop_on_error
+        # Upload started as a print once the batch is through
+        self.run = run
+        self.results = []
+
+    def progress(self, step_percentage):
+        count = max(len(self.operations), 1)
+        return round((len(self.results) * 100 + step_percentage) / count)
+
+    def as_dict(self):
+        data = super().as_dict()
+        data.update({
+            "type": "batch",
+            "operations": len(self.operations),
+            "stop_on_error": self.stop_on_error,
+            "results": self.results,
+        })
+        return data
+
+
+class SpoolJob(BatchJob):
+    """
+    Writes the uploads spooled while the printer owned the card in one
+    session. `auto` drains take control for it and hand the card back to
+    the printer afterwards.
+    """
+
+    def __init__(self, entries, auto=False):
+        super().__init__(entries)
+        self.auto = auto
+
+    def as_dict(self):
+        data = super().as_dict()
+        data.update({
+            "type": "spool",
+            "auto": self.auto,
+        })
+        return data
+
+
+class JobQueue(object):
+    """
+    Runs upload and batch jobs one after another on a worker thread, the serial link
+    can only carry one upload at a time.
+
+    `run(job)` does the actual work and returns the job result, raising on
+    failure. `on_change(job)` is called whenever a job changes state.
+    """
+
+    def __init__(self, run, on_change):
+        self._run = run
+        self._on_change = on_change
+        self._jobs = {}
+        self._order = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def submit(self, job):
+        with self._lock:
+            self._jobs[job.id] = job
+            self._order.append(job.id)
+            self._prune()
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._work, name="MasterSD upload worker")
+                self._worker.daemon = True
+                self._worker.start()
+        self._queue.put(job)
+        self._on_change(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return [self._jobs[job_id] for job_id in self._order]
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None or job.is_finished:
+            return False
+        job.cancel_event.set()
+        if job.state == Job.QUEUED:
+            self._finish(job, Job.CANCELLED)
+        else:
+            job.interrupt()
+        return True
+
+    def resume(self, job_id):
+        """Queues a failed or cancelled upload again, continuing its file."""
+        job = self.get(job_id)
+        if not isinstance(job, UploadJob) or not job.resumable:
+            return None
+        if job.state not in (Job.FAILED, Job.CANCELLED):
+            return None
+        job.state = Job.QUEUED
+        job.error = None
+        job.finished = None
+        job.resume = True
+        job.cancel_event.clear()
+        self._queue.put(job)
+        self._on_change(job)
+        return job
+
+    def update(self, job, percentage, transfer=None):
+        job.percentage = percentage
+        job.transfer = transfer
+        if getattr(job, "batch", None) is not None:
+            job = job.batch
+            job.percentage = job.progress(percentage)
+            job.transfer = transfer
+        self._on_change(job)
+
+    def _finish(self, job, state, result=None, error=None):
+        job.state = state
+        job.result = result
+        job.error = error
+        job.finished = time.time()
+        job.release()
+        self._on_change(job)
+
+    def _prune(self):
+        finished = [job_id for job_id in self._order
+                    if self._jobs[job_id].is_finished]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED, 0)]:
+            self._order.remove(job_id)
+            del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job.is_finished:
+                continue
+
+            job.state = Job.RUNNING
+            self._on_change(job)
+            try:
+                result = self._run(job)
+            except Exception as e:
+                if job.cancel_event.is_set():
+                    self._finish(job, Job.CANCELLED)
+                else:
+                    _logger.exception("Upload job %s failed", job.id)
+                    self._finish(job, Job.FAILED, error=str(e))
+            else:
+                job.percentage = 100
+                self._finish(job, Job.DONE, result=result)
@@ -0,0 +1,221 @@
+SD_ROOT = "/sdcard"
+
+
+def new_folder(path):
+    return {
+        "name": path.rsplit("/", 1)[-1],
+        "path": path,
+        "folders": [],
+        "files": [],
+    }
+
+
+def parse_listing(raw_data):
+    """
+    Parses the get_info dump in one pass.
+
+    Returns the flat view the frontend has always used (`folders` as a list
+    of paths, `files` pointing into it by index) together with `tree`, the
+    same content as nested folders starting at /sdcard.
+    """
+    folders = []
+    folder_ids = {}
+    files = []
+    nodes = {}
+    free_size = 0
+    taken_size = 0
+
+    def folder_id(path):
+        fid = folder_ids.get(path)
+        if fid is None:
+            fid = len(folders)
+            folder_ids[path] = fid
+            folders.append(path)
+        return fid
+
+    def folder_node(path):
+        node = nodes.get(path)
+        if node is None:
+            node = new_folder(path)
+            nodes[path] = node
+            parent = path.rsplit("/", 1)[0]
+            if path != SD_ROOT and parent:
+                folder_node(parent)["folders"].append(node)
+        return node
+
+    root = folder_node(SD_ROOT)
+
+    lines = raw_data.splitlines()
+    count = len(lines)
+    for i, line in enumerate(lines):
+        if (i < count - 2):
+            # files & folders part
+            if (SD_ROOT not in line):
+                continue
+            if ("s: " in lines[i+1]):
+                # is file
+                size = lines[i+1].split(" ")[-1]
+                folder, name = line.rsplit("/", 1)
+                files.append({
+                    "name": name,
+                    "size": size,
+                    "folder": folder_id(folder)
+                })
+                folder_node(folder)["files"].append({
+                    "name": name,
+                    "size": size
+                })
+            else:
+                # is folder
+                folder_id(line)
+                folder_node(line)
+        else:
+            # Size data
+            data = line.split(" ")[-1]
+            if ("Free size:" in line):
+                free_size = data
+            elif ("Taken size:" in line):
+                taken_size = data
+
+    return {
+        "folders": folders,
+        "files": files,
+        "free_size": free_size,
+        "taken_size": taken_size,
+        "tree": root
+    }
+
+
+# Write-through updates of a parsed listing, `path` is always the full
+# path starting with /sdcard
+
+def find_folder(sd_data, path, create=False):
+    node = sd_data["tree"]
+    for name in path[len(SD_ROOT):].strip("/").split("/"):
+        if not name:
+            continue
+        child = next((f for f in node["folders"] if f["name"] == name), None)
+        if child is None:
+            if not create:
+                return None
+            child = new_folder(node["path"] + "/" + name)
+            node["folders"].append(child)
+        node = child
+    return node
+
+
+def find_file(sd_data, path):
+    folder_path, name = path.rsplit("/", 1)
+    folder = find_folder(sd_data, folder_path)
+    if folder is None:
+        return None
+    return next((f for f in folder["files"] if f["name"] == name), None)
+
+
+def flatten(sd_data):
+    folders = []
+    files = []
+    stack = [sd_data["tree"]]
+    while stack:
+        node = stack.pop()
+        folder_id = len(folders)
+        folders.append(node["path"])
+        for file_obj in node["files"]:
+            files.append({
+                "name": file_obj["name"],
+                "size": file_obj["size"],
+                "folder": folder_id
+            })
+        stack.extend(reversed(node["folders"]))
+    sd_data["folders"] = folders
+    sd_data["files"] = files
+
+
+def change_taken(sd_data, size):
+    sd_data["free_size"] = str(int(sd_data["free_size"]) - size)
+    sd_data["taken_size"] = str(int(sd_data["taken_size"]) + size)
+
+
+def add_file(sd_data, path, size):
+    folder_path, name = path.rsplit("/", 1)
+    folder = find_folder(sd_data, folder_path, create=True)
+    for file_obj in folder["files"]:
+        if file_obj["name"] == name:
+            # Overwritten
+            folder["files"].remove(file_obj)
+            change_taken(sd_data, -int(file_obj["size"]))
+            break
+    folder["files"].append({"name": name, "size": str(size)})
+    change_taken(sd_data, size)
+    flatten(sd_data)
+
+
+def remove_file(sd_data, path):
+    folder_path, name = path.rsplit("/", 1)
+    folder = find_folder(sd_data, folder_path)
+    if folder is None:
+        return
+    for file_obj in folder["files"]:
+        if file_obj["name"] == name:
+            folder["files"].remove(file_obj)
+            change_taken(sd_data, -int(file_obj["size"]))
+            break
+    flatten(sd_data)
+
+
+def add_folder(sd_data, path):
+    find_folder(sd_data, path, create=True)
+    flatten(sd_data)
+
+
+def folder_size(node):
+    return (sum(int(f["size"]) for f in node["files"]) +
+            sum(folder_size(f) for f in node["folders"]))
+
+
+def remove_folder(sd_data, path):
+    parent_path, name = path.rsplit("/", 1)
+    parent = find_folder(sd_data, parent_path)
+    if parent is None:
+        return
+    for node in parent["folders"]:
+        if node["name"] == name:
+            parent["folders"].remove(node)
+            change_taken(sd_data, -folder_size(node))
+            break
+    flatten(sd_data)
+
+
+def page_folder(sd_data, path, offset, limit):
+    """
+    One page of the content of a folder of a parsed listing, in the same
+    shape as the device's own paged `ls` answer. Folders come first.
+    """
+    node = find_folder(sd_data, path)
+    if node is None:
+        return None
+    entries = ([("folder", f) for f in node["folders"]] +
+               [("file", f) for f in node["files"]])
+    return make_page(node["path"], offset, limit, len(entries),
+                     entries[offset:offset + limit],
+                     sd_data["free_size"], sd_data["taken_size"])
+
+
+def make_page(path, offset, limit, total, entries, free_size, taken_size):
+    folders = []
+    files = []
+    for kind, entry in entries:
+        if kind == "folder":
+            folders.append({"name": entry["name"], "path": entry["path"]})
+        else:
+            files.append({"name": entry["name"], "size": entry["size"]})
+    return {
+        "path": path,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "folders": folders,
+        "files": files,
+        "free_size": free_size,
+        "taken_size": taken_size
+    }
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.manifest")
+
+HASH_BLOCK = 1024 * 1024
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest(object):
+    """
+    Content hashes of the files the plugin wrote, per card, stored as JSON
+    in the plugin data folder:
+
+        {"<card id>": {"<path on card>": {"sha256": ..., "size": ...,
+                                          "minified": ...}}}
+
+    The hash is of the local file, the size that of the file on the card.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._cards = {}
+        try:
+            with open(path) as f:
+                self._cards = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            _logger.exception("Could not read manifest %s, starting empty", path)
+
+    def lookup(self, card, path):
+        with self._lock:
+            return self._cards.get(card, {}).get(path)
+
+    def record(self, card, path, digest, size, minified=False):
+        with self._lock:
+            self._cards.setdefault(card, {})[path] = {
+                "sha256": digest, "size": size, "minified": minified}
+            self._save()
+
+    def remove(self, card, path):
+        with self._lock:
+            if self._cards.get(card, {}).pop(path, None) is not None:
+                self._save()
+
+    def remove_folder(self, card, path):
+        prefix = path.rstrip("/") + "/"
+        with self._lock:
+            files = self._cards.get(card, {})
+            removed = [p for p in files if p.startswith(prefix)]
+            for p in removed:
+                del files[p]
+            if removed:
+                self._save()
+
+    def _save(self):
+        tmp = self._path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._cards, f)
+        os.replace(tmp, self._path)
@@ -0,0 +1,207 @@
+import functools
+import threading
+import time
+
+# Upper bounds in seconds of the command latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+COUNTERS = ("bytes_out", "bytes_in", "timeouts", "frames_sent",
+            "frames_resent", "packets_retried", "upload_retries")
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.failures = 0
+
+    def observe(self, value, ok=True):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        if not ok:
+            self.failures += 1
+
+    def cumulative(self):
+        """(upper bound, count) pairs in Prometheus order, ending with +Inf."""
+        total = 0
+        out = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            out.append((bound, total))
+        return out
+
+
+class Metrics(object):
+    """
+    Counters and per-command latency histograms of the serial protocol,
+    shared by every thread talking to the device.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.commands = {}
+            self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def observe(self, command, seconds, ok=True):
+        with self._lock:
+            histogram = self.commands.get(command)
+            if histogram is None:
+                histogram = self.commands[command] = Histogram()
+            histogram.observe(seconds, ok)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def frames_per_second(self):
+        # Frames over the time spent in uploads
+        upload = self.commands.get("write_file")
+        if upload is None or upload.sum <= 0:
+            return 0.0
+        return self.counters["frames_sent"] / upload.sum
+
+    def as_dict(self):
+        with self._lock:
+            commands = {}
+            for name, h in self.commands.items():
+                commands[name] = {
+                    "count": h.count,
+                    "failures": h.failures,
+                    "sum": round(h.sum, 6),
+                    "mean": round(h.sum / h.count, 6) if h.count else 0,
+                    "buckets": [["+Inf" if bound == float("inf") else bound,
+                                 count] for bound, count in h.cumulative()],
+                }
+            return {
+                "since": self.started,
+                "commands": commands,
+                "counters": dict(self.counters),
+                "frames_per_second": round(self.frames_per_second(), 2),
+            }
+
+    def prometheus(self):
+        """Text exposition format, version 0.0.4."""
+        with self._lock:
+            lines = [
+                "# HELP mastersd_command_seconds Latency of MasterSD serial commands",
+                "# TYPE mastersd_command_seconds histogram",
+            ]
+            for name, h in sorted(self.commands.items()):
+                for bound, count in h.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('mastersd_command_seconds_bucket'
+                                 '{command="%s",le="%s"} %d' % (name, le, count))
+                lines.append('mastersd_command_seconds_sum{command="%s"} %f'
+                             % (name, h.sum))
+                lines.append('mastersd_command_seconds_count{command="%s"} %d'
+                             % (name, h.count))
+
+            lines += [
+                "# HELP mastersd_command_failures_total Commands the device did not confirm",
+                "# TYPE mastersd_command_failures_total counter",
+            ]
+            for name, h in sorted(self.commands.items()):
+                lines.append('mastersd_command_failures_total{command="%s"} %d'
+                             % (name, h.failures))
+
+            lines += [
+                "# HELP mastersd_serial_bytes_total Bytes on the serial link",
+                "# TYPE mastersd_serial_bytes_total counter",
+                'mastersd_serial_bytes_total{direction="out"} %d'
+                % self.counters["bytes_out"],
+                'mastersd_serial_bytes_total{direction="in"} %d'
+                % self.counters["bytes_in"],
+                "# HELP mastersd_serial_timeouts_total Reads that timed out",
+                "# TYPE mastersd_serial_timeouts_total counter",
+                "mastersd_serial_timeouts_total %d" % self.counters["timeouts"],
+                "# HELP mastersd_frames_sent_total Upload frames written",
+                "# TYPE mastersd_frames_sent_total counter",
+                "mastersd_frames_sent_total %d" % self.counters["frames_sent"],
+                "# HELP mastersd_frames_resent_total Upload frames sent again",
+                "# TYPE mastersd_frames_resent_total counter",
+                "mastersd_frames_resent_total %d" % self.counters["frames_resent"],
+                "# HELP mastersd_packets_retried_total Add packets read an answer for again",
+                "# TYPE mastersd_packets_retried_total counter",
+                "mastersd_packets_retried_total %d" % self.counters["packets_retried"],
+                "# HELP mastersd_upload_retries_total Failed uploads tried again",
+                "# TYPE mastersd_upload_retries_total counter",
+                "mastersd_upload_retries_total %d" % self.counters["upload_retries"],
+                "# HELP mastersd_frames_per_second Frames per second while uploading",
+                "# TYPE mastersd_frames_per_second gauge",
+                "mastersd_frames_per_second %f" % self.frames_per_second(),
+            ]
+            return "\n".join(lines) + "\n"
+
+
+class MeteredSerial(object):
+    """Serial port wrapper counting bytes and read timeouts."""
+
+    def __init__(self, ser, metrics):
+        self._ser = ser
+        self._metrics = metrics
+
+    def write(self, data):
+        self._metrics.count("bytes_out", len(data))
+        return self._ser.write(data)
+
+    def read(self, size=1):
+        data = self._ser.read(size)
+        self._metrics.count("bytes_in", len(data))
+        if len(data) < size:
+            self._metrics.count("timeouts")
+        return data
+
+    def readline(self, *args, **kwargs):
+        line = self._ser.readline(*args, **kwargs)
+        self._metrics.count("bytes_in", len(line))
+        if not line.endswith(b"\n"):
+            self._metrics.count("timeouts")
+        return line
+
+    def __getattr__(self, name):
+        return getattr(self._ser, name)
+
+    def __setattr__(self, name, value):
+        # Settings like baudrate go to the port itself
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._ser, name, value)
+
+
+def instrumented(name):
+    """
+    Records the latency of a protocol helper of the plugin in its
+    `metrics`, a falsy result counts as a failure.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = getattr(self, "metrics", None)
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            start = time.monotonic()
+            ok = False
+            try:
+                res = method(self, *args, **kwargs)
+                ok = bool(res)
+                return res
+            finally:
+                metrics.observe(name, time.monotonic() - start, ok)
+        return wrapper
+    return decorator
@@ -0,0 +1,178 @@
+import re
+
+from .transfer import READ_BLOCK
+
+# Files the minifier is applied to, anything else is sent as is
+GCODE_EXTENSIONS = (".gcode", ".gco", ".g")
+
+# Comment lines OctoPrint and the slicers' own tools still look for
+KEEP_COMMENTS = (
+    b";LAYER:", b";LAYER_CHANGE", b";Z:", b";HEIGHT:", b";TYPE:",
+    b";FLAVOR:", b";TIME", b";PRINT.TIME", b";Filament used",
+    b"; filament used", b"; estimated printing time", b";Generated with",
+    b"; generated by", b";MINX", b";MINY", b";MINZ", b";MAXX", b";MAXY",
+    b";MAXZ",
+)
+
+THUMBNAIL_BEGIN = re.compile(rb"^;\s*thumbnail(_\w+)? begin")
+THUMBNAIL_END = re.compile(rb"^;\s*thumbnail(_\w+)? end")
+
+# Commands whose arguments are text, only their comments are stripped
+TEXT_COMMANDS = (b"M23", b"M28", b"M30", b"M32", b"M33", b"M117", b"M118",
+                 b"M550", b"M928")
+
+MOVES = (b"G0", b"G00", b"G1", b"G01")
+AXES = (b"X", b"Y", b"Z")
+
+
+def is_gcode(name):
+    return name.lower().endswith(GCODE_EXTENSIONS)
+
+
+def trim_number(word):
+    """b"X10.500" -> b"X10.5", b"E1.000" -> b"E1", b"Z-0.0" -> b"Z0"."""
+    head, dot, frac = word.partition(b".")
+    if not dot or not frac.isdigit():
+        return word
+    frac = frac.rstrip(b"0")
+    if frac:
+        return head + b"." + frac
+    if head[1:] in (b"", b"-", b"-0"):
+        return head[:1] + b"0"
+    return head
+
+
+def axis_value(word):
+    try:
+        return float(word[1:])
+    except ValueError:
+        return None
+
+
+class GcodeMinifier(object):
+    """
+    File-like wrapper minifying G-code line by line as it is read: drops
+    comments (except KEEP_COMMENTS), thumbnails and blank lines, collapses
+    whitespace, trims trailing zeros and leaves out X/Y/Z/F words of
+    G0/G1 moves that repeat the current value. The output is the same for
+    the same input, so a resumed upload can skip what is on the card.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._buf = bytearray()
+        self._partial = b""
+        self._eof = False
+        self._thumbnail = False
+        self._absolute = True
+        self._position = dict.fromkeys(AXES)
+        self._feedrate = None
+        # Bytes read from the source and bytes handed out
+        self.raw_bytes = 0
+        self.out_bytes = 0
+
+    def read(self, size):
+        while len(self._buf) < size and not self._eof:
+            data = self._f.read(READ_BLOCK)
+            if data:
+                self.raw_bytes += len(data)
+                lines = (self._partial + data).split(b"\n")
+                self._partial = lines.pop()
+            else:
+                lines = [self._partial] if self._partial else []
+                self._eof = True
+            for line in lines:
+                out = self.minify(line)
+                if out:
+                    self._buf += out
+                    self._buf += b"\n"
+        out = bytes(self._buf[:size])
+        del self._buf[:size]
+        self.out_bytes += len(out)
+        return out
+
+    def skip(self, size):
+        # Drops output the card already has
+        while size > 0:
+            data = self.read(min(size, READ_BLOCK))
+            if not data:
+                break
+            size -= len(data)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def minify(self, line):
+        line = line.strip()
+        if self._thumbnail:
+            if THUMBNAIL_END.match(line):
+                self._thumbnail = False
+            return None
+        if not line:
+            return None
+        if line[:1] == b";":
+            if THUMBNAIL_BEGIN.match(line):
+                self._thumbnail = True
+                return None
+            return line if line.startswith(KEEP_COMMENTS) else None
+        if line[:1] in (b"@", b"N"):
+            # OctoPrint @ commands and checksummed lines go out untouched
+            return line
+
+        code = line.split(b";", 1)[0]
+        words = code.split()
+        if not words:
+            return None
+        command = words[0].upper()
+        if command in TEXT_COMMANDS:
+            return code.rstrip()
+
+        words = [words[0]] + [trim_number(w) for w in words[1:]]
+        if command in MOVES:
+            words = self._move(words)
+            if len(words) == 1:
+                return None
+        else:
+            self._track(command, words)
+        return b" ".join(words)
+
+    def _move(self, words):
+        out = [words[0]]
+        for word in words[1:]:
+            letter = word[:1].upper()
+            value = axis_value(word)
+            if letter in AXES and self._absolute:
+                if value is not None and value == self._position[letter]:
+                    continue
+                self._position[letter] = value
+            elif letter in AXES:
+                self._position[letter] = None
+            elif letter == b"F":
+                if value is not None and value == self._feedrate:
+                    continue
+                self._feedrate = value
+            out.append(word)
+        return out
+
+    def _track(self, command, words):
+        if command == b"G90":
+            self._absolute = True
+        elif command == b"G91":
+            self._absolute = False
+            self._position = dict.fromkeys(AXES)
+        elif command == b"G92":
+            for word in words[1:]:
+                letter = word[:1].upper()
+                if letter in AXES:
+                    self._position[letter] = axis_value(word)
+        elif command[:1] in (b"G", b"T") and command not in (b"G4", b"G21"):
+            # Homing, arcs, tool changes and the like move the head
+            # somewhere this does not follow
+            self._position = dict.fromkeys(AXES)
+            self._feedrate = None
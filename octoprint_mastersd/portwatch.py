@@ -0,0 +1,136 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.portwatch")
+
+# Seconds between port scans where /dev cannot be watched
+POLL_INTERVAL = 2.0
+# Seconds to let udev finish a new device node and its links
+SETTLE_TIME = 0.5
+# Seconds between checks whether the watcher should keep running
+IDLE_CHECK = 1.0
+
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+EVENT_HEADER = struct.Struct("iIII")
+
+# Device node names that can be serial ports
+PORT_PREFIXES = ("tty", "rfcomm", "cu.")
+
+
+class Inotify(object):
+    """Minimal inotify binding watching one directory for created and
+    removed entries."""
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed for %s" % path)
+
+    def fileno(self):
+        return self.fd
+
+    def read_names(self):
+        """Names of the entries that changed since the last call."""
+        names = []
+        while True:
+            try:
+                data = os.read(self.fd, 16384)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                names.append(name.decode("utf-8", "replace"))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PortWatcher(object):
+    """
+    Reports serial port changes while `active()` is true. Waits for
+    created or removed device nodes in /dev with inotify and only lists
+    the ports when one of them could be a serial port, polling every
+    `interval` seconds where inotify is not available. `on_change(ports)`
+    is called with the sorted port list when it differs from the last
+    one, `on_stop()` when the watcher ends.
+    """
+
+    def __init__(self, list_ports, on_change, active, on_stop=None,
+                 ports=None, interval=POLL_INTERVAL, path="/dev"):
+        self.list_ports = list_ports
+        self.on_change = on_change
+        self.active = active
+        self.on_stop = on_stop
+        self.ports = ports
+        self.interval = interval
+        self.path = path
+        self.name = "MasterSD port watcher"
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def cancel(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            watch = Inotify(self.path)
+        except (OSError, AttributeError) as e:
+            _logger.info("Cannot watch %s (%s), polling for ports instead",
+                         self.path, e)
+            watch = None
+
+        try:
+            self._check()
+            while not self._stop.is_set() and self.active():
+                if watch is None:
+                    self._stop.wait(self.interval)
+                    self._check()
+                    continue
+
+                ready, _, _ = select.select([watch], [], [], IDLE_CHECK)
+                if not ready:
+                    continue
+                if any(name.startswith(PORT_PREFIXES)
+                       for name in watch.read_names()):
+                    self._stop.wait(SETTLE_TIME)
+                    watch.read_names()
+                    self._check()
+        except Exception:
+            _logger.exception("Port watcher failed")
+        finally:
+            if watch is not None:
+                watch.close()
+            if self.on_stop is not None:
+                self.on_stop()
+
+    def _check(self):
+        ports = sorted(self.list_ports())
+        if ports != self.ports:
+            self.ports = ports
+            self.on_change(ports)
@@ -0,0 +1,98 @@
+import logging
+import re
+import time
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.shortnames")
+
+# Seconds an autorun waits for the uploaded file to show up in the
+# printer's M20 listing
+LOOKUP_TIMEOUT = 60.0
+
+BEGIN_LIST = "Begin file list"
+END_LIST = "End file list"
+
+# Generated 8.3 name of a long one: leading characters, "~" and a number
+SHORT_ALIAS = re.compile(r"([^~]+)~(\d+)")
+
+
+def component_matches(short, name):
+    """True if `short`, one part of an 8.3 path, can stand for `name`."""
+    short = short.upper()
+    name = name.upper()
+    if short == name:
+        return True
+    alias = SHORT_ALIAS.fullmatch(short.split(".", 1)[0])
+    if alias is None:
+        return False
+    # The alias starts with the name before its last dot, without spaces
+    # and dots and with characters 8.3 names cannot hold replaced
+    base = name.rsplit(".", 1)[0] if "." in name[1:] else name
+    base = re.sub(r"[+,;=\[\]]", "_", re.sub(r"[ .]", "", base))
+    return base.startswith(alias.group(1))
+
+
+class ShortNameLookup(object):
+    """
+    Finds the 8.3 path the printer gives an uploaded file. Lines of one M20
+    listing are collected into a short path -> long name map, which is
+    searched once the listing ends. `feed(line)` returns the short path
+    when the file was found, None otherwise.
+    """
+
+    def __init__(self, name, folder="", timeout=LOOKUP_TIMEOUT):
+        self.name = name.lower()
+        # Folder of the file on the card, e.g. "/jobs/", upper case like the
+        # printer reports it
+        self.folder = folder.upper()
+        self.deadline = time.monotonic() + timeout
+        self.listing = False
+        self.entries = {}
+
+    @property
+    def expired(self):
+        return time.monotonic() > self.deadline
+
+    def feed(self, line):
+        if not self.listing:
+            if line.startswith(BEGIN_LIST):
+                self.listing = True
+                self.entries = {}
+            return None
+
+        if line.startswith(END_LIST):
+            self.listing = False
+            return self.match()
+
+        # "<short path> <size> [<long name>]", the long name is missing on
+        # firmware without long filename support
+        parts = line.split(" ", 2)
+        short_path = parts[0]
+        if len(parts) == 3:
+            long_name = parts[2].strip()
+        else:
+            long_name = short_path.rsplit("/", 1)[-1]
+        self.entries[short_path] = long_name.lower()
+        return None
+
+    def in_folder(self, short_path):
+        folders = [part for part in self.folder.split("/") if part]
+        parts = short_path.strip("/").split("/")[:-1]
+        return (len(parts) == len(folders) and
+                all(component_matches(short, name)
+                    for short, name in zip(parts, folders)))
+
+    def match(self):
+        # Only a single file with the name in the right folder is selected,
+        # starting a print of another one is worse than not starting any
+        candidates = [short for short, long_name in self.entries.items()
+                      if long_name == self.name]
+        found = [short for short in candidates if self.in_folder(short)]
+        if len(found) == 1:
+            return found[0]
+        if found:
+            _logger.info(f"{self.name} matches {found} in {self.folder}, "
+                         "not selecting any")
+        elif candidates:
+            _logger.info(f"{self.name} listed as {candidates}, none in "
+                         f"{self.folder or '/'}")
+        return None
@@ -0,0 +1,471 @@
+"""
+Software stand-in for the MasterSD device.
+
+Speaks the same serial protocol as the firmware so the plugin can be
+exercised without hardware, either in-process through LoopbackSerial or
+through a pseudo terminal with PtySimulator:
+
+    python -m octoprint_mastersd.simulator --files 1000 --latency 0.002
+"""
+
+import argparse
+import collections
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+
+from .transfer import BINARY_CRC, BINARY_HEADER, BINARY_MAGIC
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.simulator")
+
+SD_ROOT = "/sdcard"
+SD_CAPACITY = 32 * 1024 * 1024  # KB
+
+
+class MasterSDSimulator(object):
+    """
+    Protocol state machine of the device. `handle(message)` takes one
+    message as the host wrote it (one USB packet on the real device) and
+    returns the response lines.
+
+    window/frame/codec/ls/buffer/rates are the capabilities reported by
+    `caps`, set them to None to emulate firmware without the extension.
+    `buffer` is the largest add packet the device takes, `rates` the baud
+    rates it can switch to and `max_rate` the fastest the cable carries.
+    `error_rate` is the probability a data frame is lost (add/window) or
+    corrupted (binary), `corrupt_rate` the probability an acknowledged
+    packet still reaches the card with a flipped byte. `crc` enables the
+    file checksum command.
+    """
+
+    def __init__(self, control=True, window=8, chunk=64, frame=4096,
+                 codec="zlib", ls=True, buffer=512, rates=None, max_rate=None,
+                 error_rate=0.0, corrupt_rate=0.0, crc=True, seed=None):
+        self.control = control
+        self.crc = crc
+        self.corrupt_rate = corrupt_rate
+        self.buffer = buffer
+        self.rates = rates
+        self.max_rate = max_rate
+        self.baudrate = None
+        self._old_rate = None
+        self.ls = ls
+        self.window = window
+        self.chunk = chunk
+        self.frame = frame
+        self.codec = codec
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        self.files = {}
+        self.dirs = set()
+        self.commands = collections.Counter()
+
+        self._writing = None
+        self._inflate = None
+        self._next_seq = 0
+        self._pending = {}
+        self._first_packet = False
+        self._stream = bytearray()
+
+    # -- card content
+
+    def add_tree(self, files, per_folder=100, size=512):
+        """Fills the card with `files` files of `size` KB spread over folders."""
+        for i in range(files):
+            folder = "jobs%d/batch%d" % (i // (per_folder * 10),
+                                         (i // per_folder) % 10)
+            self.dirs.add(folder.split("/")[0])
+            self.dirs.add(folder)
+            self.files["%s/part_%06d.gcode" % (folder, i)] = size * 1024
+
+    def taken_size(self):
+        return sum(self._size(content) for content in self.files.values()) // 1024
+
+    def listing(self):
+        lines = []
+        for path in sorted(self.dirs | set(self.files)):
+            lines.append("%s/%s" % (SD_ROOT, path))
+            if path in self.files:
+                lines.append("s: %d" % (self._size(self.files[path]) // 1024))
+        taken = self.taken_size()
+        lines.append("Free size: %d" % (SD_CAPACITY - taken))
+        lines.append("Taken size: %d" % taken)
+        return lines
+
+    def list_dir(self, path, offset, limit):
+        prefix = path + "/" if path else ""
+        children = set()
+        for entry in self.dirs | set(self.files):
+            if entry.startswith(prefix):
+                children.add(prefix + entry[len(prefix):].split("/", 1)[0])
+        folders = sorted(c for c in children if c in self.dirs)
+        files = sorted(c for c in children if c in self.files)
+
+        lines = ["total %d" % (len(folders) + len(files))]
+        for entry in (folders + files)[offset:offset + limit]:
+            name = entry[len(prefix):]
+            if entry in self.dirs:
+                lines.append("d " + name)
+            else:
+                lines.append("f %d %s" % (self._size(self.files[entry]) // 1024,
+                                          name))
+        taken = self.taken_size()
+        lines.append("free %d" % (SD_CAPACITY - taken))
+        lines.append("taken %d" % taken)
+        return lines
+
+    def _size(self, content):
+        return content if isinstance(content, int) else len(content)
+
+    # -- protocol
+
+    def handle(self, message):
+        if self._old_rate is not None:
+            # The cable garbled everything at the new rate, fall back
+            self.baudrate = self._old_rate
+            self._old_rate = None
+            return []
+        if self._writing is not None:
+            return self._handle_data(message)
+
+        command, _, arg = message.rstrip(b"\n").partition(b" ")
+        command = command.decode("ascii", "replace")
+        arg = arg.decode("ascii", "replace").strip("/")
+        self.commands[command] += 1
+
+        if command == "is_control":
+            return [b"true" if self.control else b"false", b"done"]
+        elif command == "take_control":
+            self.control = True
+            return [b"done"]
+        elif command == "return_control":
+            self.control = False
+            return [b"done"]
+        elif command == "caps":
+            return self._caps()
+        elif command == "baud":
+            if not self.rates or not arg.isdigit() or int(arg) not in self.rates:
+                return [b"failed"]
+            if self.max_rate is not None and int(arg) > self.max_rate:
+                self._old_rate = self.baudrate
+            self.baudrate = int(arg)
+            return [b"done"]
+
+        if not self.control:
+            return [b"failed"]
+
+        if command == "get_info":
+            return [line.encode("ascii") for line in self.listing()] + [b"done"]
+        elif command == "ls" and self.ls:
+            offset, limit, path = (arg.split(" ", 2) + [""])[:3]
+            path = path.strip("/")
+            if path and path not in self.dirs:
+                return [b"failed"]
+            lines = self.list_dir(path, int(offset), int(limit))
+            return [line.encode("ascii") for line in lines] + [b"done"]
+        elif command in ("write", "zwrite", "append", "zappend"):
+            if command.startswith("z") and self.codec != "zlib":
+                return [b"failed"]
+            self._writing = arg
+            self._inflate = (zlib.decompressobj() if command.startswith("z")
+                             else None)
+            self._next_seq = 0
+            self._pending = {}
+            self._first_packet = True
+            if command.endswith("write") or arg not in self.files:
+                self.files[arg] = bytearray()
+            return [b"done"]
+        elif command == "stat":
+            if arg not in self.files:
+                return [b"failed"]
+            return [b"s: %d" % self._size(self.files[arg]), b"done"]
+        elif command == "crc" and self.crc:
+            offset, _, path = arg.partition(" ")
+            path = path.strip("/")
+            if path not in self.files or isinstance(self.files[path], int):
+                return [b"failed"]
+            data = self.files[path][int(offset):]
+            return [b"c: %08x" % zlib.crc32(data), b"s: %d" % len(data),
+                    b"done"]
+        elif command == "del":
+            if arg not in self.files:
+                return [b"failed"]
+            del self.files[arg]
+            return [b"done"]
+        elif command == "mkdir":
+            self.dirs.add(arg)
+            return [b"done"]
+        elif command == "rmdir":
+            if arg not in self.dirs:
+                return [b"failed"]
+            prefix = arg + "/"
+            self.dirs = {d for d in self.dirs
+                         if d != arg and not d.startswith(prefix)}
+            self.files = {f: c for f, c in self.files.items()
+                          if not f.startswith(prefix)}
+            return [b"done"]
+        return [b"failed"]
+
+    def feed(self, data):
+        """
+        Stream counterpart of handle() for transports that do not keep
+        message boundaries. Pipelined frames are split by their length
+        headers, anything else is taken as one message per read.
+        """
+        self._stream += data
+        responses = []
+        while self._stream:
+            size = self._frame_size()
+            if size is None:
+                size = len(self._stream)
+            elif size > len(self._stream):
+                break
+            message = bytes(self._stream[:size])
+            del self._stream[:size]
+            responses += self.handle(message)
+        return responses
+
+    def _frame_size(self):
+        if self._writing is None:
+            return None
+        if self._stream.startswith(b"wadd "):
+            header, sep, _ = self._stream.partition(b"\n")
+            if not sep:
+                return len(self._stream) + 1
+            return len(header) + 1 + int(header.split(b" ")[2])
+        if self._stream[0] == BINARY_MAGIC:
+            if len(self._stream) < BINARY_HEADER.size:
+                return len(self._stream) + 1
+            length = BINARY_HEADER.unpack_from(self._stream)[2]
+            return BINARY_HEADER.size + length + BINARY_CRC.size
+        return None
+
+    def _caps(self):
+        if self.window is None and self.frame is None:
+            return [b"failed"]
+        lines = []
+        if self.window is not None:
+            lines += [b"window %d" % self.window, b"chunk %d" % self.chunk]
+        if self.frame is not None:
+            lines.append(b"frame %d" % self.frame)
+        if self.codec is not None:
+            lines.append(b"codec " + self.codec.encode("ascii"))
+        if self.ls:
+            lines += [b"ls 1", b"stat 1", b"append 1"]
+        if self.buffer is not None:
+            lines.append(b"buffer %d" % self.buffer)
+        if self.crc:
+            lines.append(b"crc 1")
+        if self.rates:
+            lines.append(b"rates " + b",".join(b"%d" % r for r in self.rates))
+        return lines + [b"done"]
+
+    def _lost(self):
+        return self.error_rate and self.random.random() < self.error_rate
+
+    def _append(self, data):
+        if self._inflate is not None:
+            data = self._inflate.decompress(data)
+        if (data and self.corrupt_rate and
+                self.random.random() < self.corrupt_rate):
+            data = bytearray(data)
+            data[self.random.randrange(len(data))] ^= 0xFF
+        self.files[self._writing] += data
+
+    def _handle_data(self, message):
+        if message == b"done\n":
+            if self._inflate is not None:
+                self.files[self._writing] += self._inflate.flush()
+            self._writing = None
+            self._inflate = None
+            return [b"done"]
+
+        if message.startswith(b"wadd "):
+            header, _, data = message.partition(b"\n")
+            _, seq, length = header.split(b" ")
+            return self._handle_frame(int(seq), data, len(data) == int(length))
+
+        if message[:1] == bytes([BINARY_MAGIC]):
+            crc_at = len(message) - BINARY_CRC.size
+            _, seq, length = BINARY_HEADER.unpack_from(message)
+            data = message[BINARY_HEADER.size:crc_at]
+            if self._lost():
+                message = message[:-1] + bytes([message[-1] ^ 0xFF])
+            valid = (len(data) == length and
+                     BINARY_CRC.unpack_from(message, crc_at)[0] ==
+                     zlib.crc32(message[:crc_at]))
+            return self._handle_frame(seq, data, valid, lost=False,
+                                      selective=True)
+
+        # Plain add mode, the first packet is prefixed with "add "
+        if self._lost() or len(message) > (self.buffer or 64):
+            return []
+        if message.startswith(b"add ") and self._first_packet:
+            message = message[4:]
+        self._first_packet = False
+        self._append(message)
+        return [b"done"]
+
+    def _handle_frame(self, seq, data, valid, lost=None, selective=False):
+        if lost is None:
+            lost = self._lost()
+        if lost:
+            return []
+        if seq < self._next_seq:
+            # Resent after a lost ack
+            return [b"ack %d" % (self._next_seq - 1)]
+        if not valid:
+            return [b"nak %d" % seq]
+        if seq > self._next_seq:
+            # Out of order after a loss, binary mode keeps the frame until
+            # the gap is resent, windowed mode waits for the whole resend
+            if selective:
+                self._pending[seq] = data
+            return []
+        self._append(data)
+        self._next_seq += 1
+        while self._next_seq in self._pending:
+            self._append(self._pending.pop(self._next_seq))
+            self._next_seq += 1
+        return [b"ack %d" % (self._next_seq - 1)]
+
+
+class LoopbackSerial(object):
+    """
+    In-process replacement for serial.Serial talking to a simulator. Each
+    write() is one message. Writes take the time the bytes need on a link
+    of `baudrate` and every response line becomes readable `latency`
+    seconds after the message that caused it.
+    """
+
+    def __init__(self, simulator, baudrate=4000000, latency=0.0005,
+                 timeout=2.0, port="loop://mastersd"):
+        self.simulator = simulator
+        self.baudrate = baudrate
+        self.latency = latency
+        self.timeout = timeout
+        self.port = port
+        self.is_open = True
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self._responses = collections.deque()
+
+    def _wire_time(self, size):
+        # 8N1, 10 bits per byte
+        return size * 10.0 / self.baudrate if self.baudrate else 0.0
+
+    def write(self, data):
+        data = bytes(data)
+        time.sleep(self._wire_time(len(data)))
+        self.bytes_written += len(data)
+        ready = time.monotonic() + self.latency
+        for line in self.simulator.handle(data):
+            line += b"\n"
+            ready += self._wire_time(len(line))
+            self._responses.append((ready, line))
+        return len(data)
+
+    def readline(self):
+        if not self._responses:
+            time.sleep(self.timeout)
+            return b""
+        ready, line = self._responses.popleft()
+        delay = ready - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.bytes_read += len(line)
+        return line
+
+    def reset_input_buffer(self):
+        self._responses.clear()
+
+    def close(self):
+        self.is_open = False
+
+
+class PtySimulator(object):
+    """
+    Serves a simulator on a pseudo terminal, `port` can be opened with
+    serial.Serial like a real MasterSD. Every read from the pty is treated
+    as one message unless it holds pipelined frames, see
+    MasterSDSimulator.feed().
+    """
+
+    def __init__(self, simulator, baudrate=4000000, latency=0.0005):
+        import pty
+        import tty
+
+        self.simulator = simulator
+        self.baudrate = baudrate
+        self.latency = latency
+        self._master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._serve,
+                                        name="MasterSD simulator")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _serve(self):
+        while self._running:
+            try:
+                message = os.read(self._master, 65536)
+            except OSError:
+                return
+            time.sleep(self.latency + len(message) * 10.0 / self.baudrate)
+            response = b"".join(line + b"\n"
+                                for line in self.simulator.feed(message))
+            if response:
+                os.write(self._master, response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MasterSD device simulator")
+    parser.add_argument("--files", type=int, default=100,
+                        help="number of synthetic files on the card")
+    parser.add_argument("--baudrate", type=int, default=4000000)
+    parser.add_argument("--latency", type=float, default=0.0005,
+                        help="response latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--corrupt-rate", type=float, default=0.0,
+                        help="share of packets stored with a flipped byte")
+    parser.add_argument("--legacy", action="store_true",
+                        help="emulate firmware without protocol extensions")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.legacy:
+        sim = MasterSDSimulator(window=None, frame=None, codec=None,
+                                crc=False, error_rate=args.error_rate)
+    else:
+        sim = MasterSDSimulator(error_rate=args.error_rate,
+                                corrupt_rate=args.corrupt_rate)
+    sim.add_tree(args.files)
+
+    server = PtySimulator(sim, args.baudrate, args.latency).start()
+    _logger.info("MasterSD simulator listening on %s", server.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from .manifest import file_digest
+from .transfer import READ_BLOCK
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.spool")
+
+INDEX = "index.json"
+
+
+class Spool(object):
+    """
+    Uploads waiting for the card while the printer owns it, kept in a
+    folder of the plugin data folder with a JSON index:
+
+        {"<path on card>": {"name": ..., "sha256": ..., "size": ...,
+                            "compress": ..., "minify": ..., "queued": ...}}
+
+    Contents are stored once per hash however many paths they are queued
+    for, queuing a path again replaces what was queued for it.
+    """
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._index = os.path.join(folder, INDEX)
+        self._lock = threading.Lock()
+        self._entries = {}
+        os.makedirs(folder, exist_ok=True)
+        try:
+            with open(self._index) as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            _logger.exception("Could not read spool index %s, starting empty",
+                              self._index)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def entries(self):
+        """Queued uploads, oldest first, each with its card `path`."""
+        with self._lock:
+            entries = [dict(entry, path=path)
+                       for path, entry in self._entries.items()]
+        return sorted(entries, key=lambda entry: entry["queued"])
+
+    def blob_path(self, digest):
+        return os.path.join(self._folder, digest)
+
+    def add_file(self, path, name, source, compress=False, minify=False):
+        digest = file_digest(source)
+        with self._lock:
+            blob = self.blob_path(digest)
+            if (not os.path.exists(blob)):
+                tmp = self._tmp_file()
+                shutil.copyfile(source, tmp)
+                os.replace(tmp, blob)
+            return self._add(path, name, digest, os.path.getsize(blob),
+                             compress, minify)
+
+    def add_stream(self, path, name, stream, compress=False, minify=False,
+                   on_read=None):
+        # Stores a StreamBuffer, `on_read(bytes)` follows its progress
+        tmp = self._tmp_file()
+        size = 0
+        try:
+            with open(tmp, "wb") as f, stream:
+                while (True):
+                    data = stream.read(READ_BLOCK)
+                    if (not data):
+                        break
+                    f.write(data)
+                    size += len(data)
+                    if (on_read is not None):
+                        on_read(size)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        digest = stream.digest()
+        with self._lock:
+            blob = self.blob_path(digest)
+            if (os.path.exists(blob)):
+                os.remove(tmp)
+            else:
+                os.replace(tmp, blob)
+            return self._add(path, name, digest, size, compress, minify)
+
+    def remove(self, path, digest=None):
+        # With a digest only an entry still holding that content goes
+        with self._lock:
+            entry = self._entries.get(path)
+            if (entry is None or
+                    (digest is not None and entry["sha256"] != digest)):
+                return False
+            del self._entries[path]
+            self._save()
+            self._drop_blob(entry["sha256"])
+            return True
+
+    def _add(self, path, name, digest, size, compress, minify):
+        old = self._entries.get(path)
+        entry = self._entries[path] = {
+            "name": name, "sha256": digest, "size": size,
+            "compress": compress, "minify": minify, "queued": time.time()}
+        self._save()
+        if (old is not None):
+            self._drop_blob(old["sha256"])
+        _logger.info(f"Spooled {path}, {len(self._entries)} waiting")
+        return dict(entry, path=path)
+
+    def _drop_blob(self, digest):
+        # Removes a stored content no entry refers to anymore
+        if any(e["sha256"] == digest for e in self._entries.values()):
+            return
+        try:
+            os.remove(self.blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _tmp_file(self):
+        fd, tmp = tempfile.mkstemp(dir=self._folder, suffix=".tmp")
+        os.close(fd)
+        return tmp
+
+    def _save(self):
+        tmp = self._index + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self._index)
@@ -15,6 +15,7 @@ $(function() {
 
         self.printer = parameters[0];
         self.connection = parameters[1];
+        self.settings = parameters[2];
 
         self.delete_file_path = '';
         log.info("Master SD frontend");
@@ -64,6 +65,17 @@ $(function() {
         self.uploadProgressText = ko.observable(null);
         self.uploadProgressPercentage = ko.observable(null);
 
+        // Id of the upload job currently running on the backend
+        self.activeJob = ko.observable(null);
+        // Latest update per job, job messages can arrive before the upload request returns
+        self.jobUpdates = {};
+        // Last failed upload job, it can continue where the transfer stopped
+        self.failedJob = ko.observable(null);
+        // Name of the file being streamed to the card, until its request returns
+        self.streamingName = null;
+        // Uploads waiting for the card while the printer has it
+        self.spoolEntries = ko.observableArray([]);
+
 
         self.currentPath = ko.pureComputed(function() {
             var activeFolder = self.activeFolder();
@@ -95,12 +107,89 @@ $(function() {
                 if (folder_path){
                     if (folder_path != self.activeFolder()){
                         log.info("Folder click");
-                        self.activeFolder(folder_path);
+                        if (self.loadedFolders[folder_path]){
+                            self.activeFolder(folder_path);
+                        } else {
+                            self.isBusy(true);
+                            self.loadFolder(folder_path, 0, false, () => {
+                                self.isBusy(false);
+                                self.activeFolder(folder_path);
+                            });
+                        }
                     }
                 }
             }            
         }
 
+        // Folders whose content was already fetched, the card is listed one folder at a time
+        self.loadedFolders = {};
+
+        self.mergeFolderPage = function(page){
+            var sdFiles = Object.assign({folders: [], files: []}, self.sdFiles());
+            sdFiles.folders = sdFiles.folders.slice();
+            sdFiles.files = sdFiles.files.slice();
+
+            var folder_id = sdFiles.folders.indexOf(page.path);
+            if (folder_id < 0){
+                folder_id = sdFiles.folders.length;
+                sdFiles.folders.push(page.path);
+            }
+            page.folders.forEach((folder) => {
+                if (!sdFiles.folders.includes(folder.path)){
+                    sdFiles.folders.push(folder.path);
+                }
+            });
+            page.files.forEach((file) => {
+                var exists = sdFiles.files.some((f) => {
+                    return f.folder == folder_id && f.name == file.name
+                });
+                if (!exists){
+                    sdFiles.files.push({
+                        folder: folder_id,
+                        name: file.name,
+                        size: file.size
+                    });
+                }
+            });
+            sdFiles.free_size = page.free_size;
+            sdFiles.taken_size = page.taken_size;
+            self.sdFiles(sdFiles);
+        }
+
+        self.loadFolder = function(path, offset, refresh, complete){
+            log.info("Listing " + path + " from " + offset);
+            var data = {path: path, offset: offset};
+            if (refresh){
+                data.refresh = true;
+            }
+            $.ajax({
+                url: "plugin/mastersd/list",
+                type: "GET",
+                dataType: "json",
+                data: data,
+                error: (data) => {
+                    log.info("Listing failed!");
+                    log.info(data);
+                    if (complete){
+                        complete();
+                    }
+                },
+                success: (page) => {
+                    self.mergeFolderPage(page);
+                    var received = page.folders.length + page.files.length;
+                    var next = page.offset + received;
+                    if (received > 0 && next < page.total){
+                        self.loadFolder(path, next, false, complete);
+                    } else {
+                        self.loadedFolders[path] = true;
+                        if (complete){
+                            complete();
+                        }
+                    }
+                }
+            });
+        }
+
         self.attemptFileDelete = function(folder, file){
             var path = folder + '/' + file.name;
             log.info("Attempting to delete " + path);
@@ -379,33 +468,26 @@ $(function() {
             return new Promise(resolve => setTimeout(resolve, ms));
         }
 
-        self.getSdInfo = function(){
+        self.getSdInfo = function(refresh){
             log.info("Attempting to get SD data")
             if (self.connected() && self.sd_control()){
                 self.isBusy(true);
                 self.isSwitching(true);
-                $.ajax({
-                    url: "plugin/mastersd/get_info",
-                    type: "GET",
-                    dataType: "json",
-                    error: (data) => {
-                        log.info("Get info failed!");
-                        log.info(data);
-                    },
-                    success: (data) => {
-                        log.info("Get info success!");
-                        log.info(data);
-                        self.sdFiles(Object.assign({},data));
-                        self.activeFolder('/sdcard');
-                    },
-                    complete: (data) => {
-                        self.isBusy(false);
-                        self.isSwitching(false);
-                    }
+                self.loadedFolders = {};
+                self.sdFiles(null);
+                self.activeFolder('/sdcard');
+                self.loadFolder('/sdcard', 0, refresh, () => {
+                    self.isBusy(false);
+                    self.isSwitching(false);
                 });
             }
         }
 
+        // Re-read the listing from the card instead of the cached one
+        self.refreshSdInfo = function(){
+            self.getSdInfo(true);
+        }
+
         self.switchSd = function(){
             log.info("Attempting to switch the SD master")
             if (self.connected()){
@@ -514,11 +596,13 @@ $(function() {
                     files_size += files[0].size
                     
                     var visibleFiles = self.visibleFiles();
+                    var streaming = self.streamUploads();
+                    var max_size = streaming ? self.pluginSettings().stream_max_size() : 250000000;
                     log.info(files[0]);
                     log.info(visibleFiles);
                     log.info("Total file size: " + files_size);
-                    if (files_size > 250000000){
-                        log.info("Max upload limited to 250MB");
+                    if (files_size > max_size){
+                        log.info("Max upload limited to " + max_size + " bytes");
                     } else {
                         let file_id = visibleFiles.findIndex((visibleFile) => {
                             if (visibleFile.name == files[0].name){
@@ -531,6 +615,8 @@ $(function() {
                             self.dialogTitle("File already exists");
                             self.dialogContent("Cannot write two files with the same name");
                             self.showDialog("#sidebar_simpleWarning", null); 
+                        } else if (streaming){
+                            self.streamUpload(files[0]);
                         } else {
                             $.ajax({
                                 url: "/api/files/local",
@@ -553,9 +639,52 @@ $(function() {
             }
         }
 
+        self.pluginSettings = function(){
+            var plugins = self.settings.settings && self.settings.settings.plugins;
+            return plugins ? plugins.mastersd : undefined;
+        }
+
+        // stream_uploads setting, sidebar uploads skip OctoPrint's storage.
+        // Off until the settings have loaded.
+        self.streamUploads = function(){
+            var settings = self.pluginSettings();
+            return Boolean(settings && settings.stream_uploads && settings.stream_uploads());
+        }
+
+        // Sends the file straight to the card, the backend writes the request
+        // body out as it arrives instead of storing it first
+        self.streamUpload = function(file){
+            self._setProgressBar(0, gettext("Uploading ..."), true);
+            self.streamingName = file.name;
+            $.ajax({
+                url: "plugin/mastersd/stream_sd?" + $.param({
+                    name: file.name,
+                    path: self.activeFolder(),
+                    run: self.autoRun()
+                }),
+                type: "POST",
+                processData: false,
+                contentType: "application/octet-stream",
+                dataType: "json",
+                data: file,
+                headers: {
+                    "X-Api-Key": UI_API_KEY,
+                },
+                error: self.uploadFailed,
+                success: (job) => {
+                    self.streamingName = null;
+                    // Usually picked up from its updates while still sending
+                    if (!self.jobUpdates[job.id]){
+                        self.jobQueued(job);
+                    }
+                }
+            });
+        }
+
         self.uploadFailed = function(data){
             log.info("Upload failed!");
             log.info(data);
+            self.streamingName = null;
 
             self.uploadProgress.removeClass("progress-striped").removeClass("active");
             self.uploadProgressBar.css("width", "0");
@@ -566,13 +695,15 @@ $(function() {
         self.writeSuccess = function(data){
             log.info('Write success!');
             log.info(data);
-            if (data.autorun){
+            if (data.spooled){
+                log.info("Spooled until the SD card is back");
+            }else if (data.autorun){
                 log.info("Disconnected!");
                 self.sdFiles(null);
                 self.activeFolder('/sdcard');
                 self.isBusy(false);
                 self.sd_control(false);
-            }else{
+            }else if (!data.already_present && self.sdFiles()){
                 var sdFiles = Object.assign({},self.sdFiles());
                 var file = {
                     folder: sdFiles.folders.indexOf(self.activeFolder()),
@@ -592,6 +723,134 @@ $(function() {
             self.uploadProgressPercentage(0);
         }
 
+        self.jobQueued = function(job){
+            log.info("Upload job queued: " + job.id);
+            self.failedJob(null);
+            self.activeJob(job.id);
+            if (self.jobUpdates[job.id]){
+                self.onJobUpdate(self.jobUpdates[job.id]);
+            }
+        }
+
+        self.cancelUpload = function(){
+            var jobId = self.activeJob();
+            if (!jobId){
+                return
+            }
+            log.info("Cancelling upload job " + jobId);
+            $.ajax({
+                url: "plugin/mastersd/jobs/" + jobId + "/cancel",
+                type: "POST",
+                dataType: "json",
+                headers: {
+                    "X-Api-Key": UI_API_KEY,
+                },
+                error: (data) => {
+                    log.info("Cancel failed!");
+                    log.info(data);
+                }
+            });
+        }
+
+        self.resumeUpload = function(){
+            var jobId = self.failedJob();
+            if (!jobId){
+                return
+            }
+            log.info("Resuming upload job " + jobId);
+            self.failedJob(null);
+            $.ajax({
+                url: "plugin/mastersd/jobs/" + jobId + "/resume",
+                type: "POST",
+                dataType: "json",
+                headers: {
+                    "X-Api-Key": UI_API_KEY,
+                },
+                success: self.jobQueued,
+                error: (data) => {
+                    log.info("Resume failed!");
+                    log.info(data);
+                }
+            });
+        }
+
+        self.progressText = function(job){
+            var text = job.percentage + " %";
+            var transfer = job.transfer;
+            if (transfer && transfer.bytes_per_second > 0){
+                text += " - " + self.getSizeUnit(transfer.bytes_per_second / 1000) + "/s";
+                if (transfer.eta !== null){
+                    text += " - " + Math.ceil(transfer.eta) + " s left";
+                }
+            }
+            return gettext(text);
+        }
+
+        self.onJobUpdate = function(job){
+            self.jobUpdates[job.id] = job;
+            if (!self.activeJob() && !job.resumable && job.name === self.streamingName){
+                // The streamed upload reports progress before its request returns
+                self.activeJob(job.id);
+            }
+            if (job.id !== self.activeJob()){
+                return
+            }
+            switch (job.state){
+                case "running":
+                    self._setProgressBar(
+                        job.percentage,
+                        self.progressText(job),
+                        true
+                    );
+                    break;
+                case "done":
+                    self.activeJob(null);
+                    self.writeSuccess(job.result);
+                    break;
+                case "failed":
+                case "cancelled":
+                    self.activeJob(null);
+                    self.failedJob(job.state == "failed" && job.resumable ? job.id : null);
+                    self.uploadFailed(job);
+                    break;
+            }
+        }
+
+        // Backend lost or restored the link, or the SD owner changed on the device
+        self.onConnectionUpdate = function(data){
+            log.info("Connection update");
+            log.info(data);
+            if (!data.connected){
+                self.setDisconnected();
+                return
+            }
+            self.connected(true);
+            self.sd_control(data.control);
+            if (data.control){
+                self.getSdInfo();
+            } else {
+                self.sdFiles(null);
+                self.activeFolder('/sdcard');
+            }
+        }
+
+        self.onDataUpdaterPluginMessage = function(plugin, data){
+            if (plugin !== "mastersd"){
+                return
+            }
+            // The tab shows the MasterSD attached to the printer
+            if (data.device && data.device !== "default"){
+                return
+            }
+            if (data.type === "job"){
+                self.onJobUpdate(data.job);
+            } else if (data.type === "spool"){
+                self.spoolEntries(data.entries);
+            } else if (data.type === "connection"){
+                self.onConnectionUpdate(data);
+            }
+        }
+
         self._setProgressBar = function (percentage, text, active) {
             self.uploadProgressBar.css("width", percentage + "%");
             self.uploadProgressText(text);
@@ -627,7 +886,7 @@ $(function() {
                         },
                         data: JSON.stringify({name: name, path: self.activeFolder(), run: self.autoRun()}),
                         error: self.uploadFailed,
-                        success: self.writeSuccess
+                        success: self.jobQueued
                     });
                 }
             }            
@@ -768,6 +1027,9 @@ $(function() {
 
         // Change the upload percantage
         self.onEventPluginMastersdUploadProgress = function(payload){
+            if (payload.device && payload.device !== "default"){
+                return
+            }
 
             var progress = parseInt(payload.percentage);
             var uploaded = progress >= 100;
@@ -785,6 +1047,35 @@ $(function() {
             log.info(self.printer);
         }
 
+        self.loadSpool = function(){
+            $.ajax({
+                url: "plugin/mastersd/spool",
+                type: "GET",
+                dataType: "json",
+                headers: {
+                    "X-Api-Key": UI_API_KEY,
+                },
+                success: self.spoolEntries
+            });
+        }
+
+        self.unspool = function(entry){
+            $.ajax({
+                url: "plugin/mastersd/spool/delete",
+                contentType: "application/json; charset=utf-8",
+                type: "POST",
+                dataType: "json",
+                headers: {
+                    "X-Api-Key": UI_API_KEY,
+                },
+                data: JSON.stringify({path: entry.path}),
+                error: (data) => {
+                    log.info("Could not remove spooled upload");
+                    log.info(data);
+                }
+            });
+        }
+
         self.onStartupComplete = function(){
 
             $(document).on('hidden.bs.modal', '#sidebar_newFolder', function() {
@@ -793,6 +1084,7 @@ $(function() {
             });
             self.uploadProgress = $("#mastersd_upload_progress");
             self.uploadProgressBar = $(".bar", self.uploadProgress);
+            self.loadSpool();
         }
 
         self.showDialog = function(dialogId, confirmFunction){
@@ -825,7 +1117,7 @@ $(function() {
     OCTOPRINT_VIEWMODELS.push({
         construct: MastersdViewModel,
         // ViewModels your plugin depends on, e.g. loginStateViewModel, settingsViewModel, ...
-        dependencies: [ "printerStateViewModel", "connectionViewModel"/* "loginStateViewModel", "settingsViewModel" */ ],
+        dependencies: [ "printerStateViewModel", "connectionViewModel", "settingsViewModel"/* "loginStateViewModel" */ ],
         // Elements to bind to, e.g. #settings_plugin_mastersd, #tab_plugin_mastersd, ...
         elements: [ "#tab_plugin_mastersd"/* ... */ ]
     });
@@ -0,0 +1,226 @@
+import collections
+import hashlib
+import threading
+import time
+
+import tornado.ioloop
+import tornado.web
+from tornado.concurrent import Future
+
+# Bytes of request body held for the serial transfer before the browser
+# has to wait
+STREAM_BUFFER = 1024 * 1024
+# Default for the largest streamed upload, the biggest file FAT32 holds
+MAX_STREAM_SIZE = 4 * 1024 * 1024 * 1024 - 1
+# Seconds a read waits for more of the body before the upload fails
+STREAM_IDLE_TIMEOUT = 60.0
+
+TRUE_VALUES = ("1", "true", "yes", "on")
+
+
+class StreamClosed(Exception):
+    # Not an OSError, a serial session would take it for a lost link
+    pass
+
+
+class StreamBuffer(object):
+    """
+    Bounded pipe between an HTTP request body and the upload job writing
+    it to the card. The request side feeds chunks until `limit` bytes are
+    pending and then waits for `when_drained`, the job reads from it like
+    from a file. Reads hand out memoryview slices of the fed chunks where
+    they can, and fail once nothing arrived for `idle_timeout` seconds.
+    """
+
+    def __init__(self, limit=STREAM_BUFFER, idle_timeout=STREAM_IDLE_TIMEOUT):
+        self.limit = limit
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._chunks = collections.deque()
+        self._pending = 0
+        self._eof = False
+        self._failed = False
+        self._on_drained = None
+        self._hash = hashlib.sha256()
+        self.closed = False
+        self.read_bytes = 0
+
+    def feed(self, data):
+        # Returns False once the reader is `limit` bytes behind, the rest
+        # of the body is dropped once it stopped
+        with self._cond:
+            if (self.closed):
+                return True
+            self._chunks.append(memoryview(data))
+            self._pending += len(data)
+            self._cond.notify()
+            return self._pending < self.limit
+
+    def when_drained(self, callback):
+        # Calls `callback` once half the buffer is free again or the reader
+        # stopped, from the reading thread unless that already happened
+        with self._cond:
+            if (self._pending > self.limit // 2 and not self.closed):
+                self._on_drained = callback
+                return
+        callback()
+
+    def finish(self):
+        # The whole body arrived
+        with self._cond:
+            self._eof = True
+            self._cond.notify()
+
+    def fail(self):
+        # The request went away before the body was complete
+        with self._cond:
+            if (not self._eof):
+                self._failed = True
+                self._cond.notify()
+
+    @property
+    def complete(self):
+        return self._eof
+
+    def read(self, size):
+        with self._cond:
+            # Never wait for more than the request side may send ahead
+            pending = self._pending
+            idle_since = time.monotonic()
+            while (self._pending < min(size, self.limit) and
+                   not self._eof and not self._failed and not self.closed):
+                if (self._pending != pending):
+                    pending = self._pending
+                    idle_since = time.monotonic()
+                remaining = idle_since + self.idle_timeout - time.monotonic()
+                if (remaining <= 0):
+                    raise StreamClosed(
+                        f"No upload data for {self.idle_timeout:g} seconds")
+                self._cond.wait(remaining)
+            if (self._failed or self.closed):
+                raise StreamClosed("Upload stream closed")
+
+            parts = []
+            wanted = size
+            while (wanted > 0 and self._chunks):
+                chunk = self._chunks.popleft()
+                if (len(chunk) > wanted):
+                    self._chunks.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                parts.append(chunk)
+                wanted -= len(chunk)
+            data = parts[0] if len(parts) == 1 else b"".join(parts)
+            self._pending -= len(data)
+
+            callback = None
+            if (self._on_drained is not None and
+                    self._pending <= self.limit // 2):
+                callback, self._on_drained = self._on_drained, None
+
+        self._hash.update(data)
+        self.read_bytes += len(data)
+        if (callback is not None):
+            callback()
+        return data
+
+    def digest(self):
+        """sha256 of everything read, like manifest.file_digest."""
+        return self._hash.hexdigest()
+
+    def close(self):
+        # The reader is done or cancelled, wakes a read still waiting and a
+        # request waiting for room
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+            callback, self._on_drained = self._on_drained, None
+        if (callback is not None):
+            callback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def query_flag(handler, name):
+    value = handler.get_query_argument(name, None)
+    if (value is None):
+        return None
+    return value.lower() in TRUE_VALUES
+
+
+@tornado.web.stream_request_body
+class StreamUploadHandler(tornado.web.RequestHandler):
+    """
+    POST /plugin/mastersd/stream_sd?name=<file>&path=<folder>[&run=true]
+    [&compress=..][&minify=..][&device=<id>] with the file as
+    application/octet-stream body. Queues an upload job reading straight
+    from the request, so the file never touches the local disk. Reading
+    the body pauses whenever the serial transfer falls STREAM_BUFFER bytes
+    behind. The response is the job, sent once the whole body was received.
+    """
+
+    def initialize(self, plugin, access_validation=None):
+        self.plugin = plugin
+        self.access_validation = access_validation
+        self.job = None
+        self.jobs = None
+        self.loop = None
+
+    def prepare(self):
+        if (self.access_validation is not None):
+            self.access_validation(self.request)
+
+        # Browsers cannot send this content type cross-site without a
+        # preflight, which keeps cookie sessions from being abused here
+        content_type = self.request.headers.get("Content-Type", "")
+        if (content_type.split(";")[0].strip() != "application/octet-stream"):
+            raise tornado.web.HTTPError(
+                415, reason="Expected application/octet-stream")
+        size = self.request.headers.get("Content-Length", "")
+        if (not size.isdigit()):
+            raise tornado.web.HTTPError(411, reason="No Content-Length")
+        name = self.get_query_argument("name", None)
+        if (not name):
+            raise tornado.web.HTTPError(400, reason="Name is None")
+        device = self.plugin.devices.get(
+            self.get_query_argument("device", None))
+        if (device is None):
+            raise tornado.web.HTTPError(404, reason="Unknown device")
+
+        self.loop = tornado.ioloop.IOLoop.current()
+        with self.plugin.devices.use(device):
+            self.job = self.plugin.make_stream_job(
+                name, self.get_query_argument("path", None), int(size),
+                autorun=bool(query_flag(self, "run")),
+                compress=query_flag(self, "compress"),
+                minify=query_flag(self, "minify"))
+        self.jobs = device.jobs
+        self.jobs.submit(self.job)
+
+    def data_received(self, chunk):
+        if (self.job.is_finished):
+            raise tornado.web.HTTPError(409, reason=f"Upload {self.job.state}")
+        if (self.job.stream.feed(chunk)):
+            return None
+
+        # Tornado reads no more of the body until this resolves
+        future = Future()
+
+        def drained():
+            self.loop.add_callback(
+                lambda: future.done() or future.set_result(None))
+
+        self.job.stream.when_drained(drained)
+        return future
+
+    def post(self):
+        self.job.stream.finish()
+        self.finish(self.job.as_dict())
+
+    def on_connection_close(self):
+        if (self.job is not None and not self.job.stream.complete):
+            self.job.stream.fail()
+            self.jobs.cancel(self.job.id)
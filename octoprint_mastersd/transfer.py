@@ -0,0 +1,384 @@
+import logging
+import queue
+import struct
+import threading
+import time
+import zlib
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.transfer")
+
+# How many times an ack may be missed (readline timeout or garbage)
+# before the upload is given up
+ACK_RETRIES = 3
+
+MODE_ADD = "add"
+MODE_WINDOW = "window"
+MODE_BINARY = "binary"
+
+# Binary frame: magic, sequence number and payload length, little endian
+BINARY_MAGIC = 0xA5
+BINARY_HEADER = struct.Struct("<BII")
+BINARY_CRC = struct.Struct("<I")
+BINARY_FRAME_SIZE = 4096
+
+# Compressed uploads are a zlib stream, the window is kept small so the
+# device can inflate it with a few KB of RAM
+CODEC_ZLIB = "zlib"
+ZLIB_WBITS = 10
+ZLIB_LEVEL = 6
+READ_BLOCK = 16384
+
+# Uploads read the source file ahead in blocks of this size, keeping up to
+# PREFETCH_DEPTH blocks ready so the disk never stalls the serial writer
+PREFETCH_BLOCK = 256 * 1024
+PREFETCH_DEPTH = 2
+
+# Seconds between two progress reports of an upload
+PROGRESS_INTERVAL = 0.25
+
+# Adaptive chunks double after this many clean acks and halve on errors,
+# never going below the minimum
+ADAPT_GROW_AFTER = 16
+ADAPT_MIN_CHUNK = 32
+
+
+class PrefetchReader(object):
+    """
+    File-like reader filling blocks on a background thread while the
+    caller writes to the serial port. read(size) hands out memoryview
+    slices of those blocks and only copies when a read spans two of them.
+    """
+
+    def __init__(self, path, offset=0, block_size=PREFETCH_BLOCK,
+                 depth=PREFETCH_DEPTH):
+        self._f = open(path, "rb")
+        self._f.seek(offset)
+        self._block_size = block_size
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._block = memoryview(b"")
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill,
+                                        name="MasterSD upload reader")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._stop.is_set():
+                data = self._f.read(self._block_size)
+                self._put(data)
+                if not data:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _next_block(self):
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if not item:
+            self._eof = True
+        self._block = memoryview(item)
+        self._pos = 0
+
+    def read(self, size):
+        end = self._pos + size
+        if end <= len(self._block):
+            view = self._block[self._pos:end]
+            self._pos = end
+            return view
+
+        parts = []
+        while size > 0 and not self._eof:
+            if self._pos == len(self._block):
+                self._next_block()
+                continue
+            part = self._block[self._pos:self._pos + size]
+            self._pos += len(part)
+            size -= len(part)
+            parts.append(part)
+        if len(parts) == 1:
+            return parts[0]
+        return b"".join(parts)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CompressedReader(object):
+    """
+    File-like wrapper compressing f as it is read, so an upload never needs
+    a compressed copy of the whole file.
+    """
+
+    def __init__(self, f, wbits=ZLIB_WBITS, level=ZLIB_LEVEL):
+        self._f = f
+        self._z = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        self._buf = bytearray()
+        self._eof = False
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def read(self, size):
+        while len(self._buf) < size and not self._eof:
+            data = self._f.read(READ_BLOCK)
+            if data:
+                self.raw_bytes += len(data)
+                self._buf += self._z.compress(data)
+            else:
+                self._buf += self._z.flush()
+                self._eof = True
+        out = bytes(self._buf[:size])
+        del self._buf[:size]
+        self.wire_bytes += len(out)
+        return out
+
+
+class VerifyError(IOError):
+    pass
+
+
+class ChecksumReader(object):
+    """
+    File-like wrapper keeping the CRC32 and length of everything read
+    through it, the bytes the card should end up holding, so a written
+    file can be checked without reading the source a second time.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.crc = 0
+        self.size = 0
+
+    def read(self, size):
+        data = self._f.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ProgressTracker(object):
+    """
+    Upload progress from the bytes the device acknowledged. `report(progress)`
+    is called with a snapshot at most every `interval` seconds, the first
+    update is always reported so short uploads show progress too.
+    """
+
+    def __init__(self, total, report, offset=0, interval=PROGRESS_INTERVAL,
+                 clock=time.monotonic):
+        self.total = total
+        self.offset = offset
+        self.sent = offset
+        self._report = report
+        self._interval = interval
+        self._clock = clock
+        self._start = clock()
+        self._last = None
+
+    def update(self, sent):
+        self.sent = sent
+        now = self._clock()
+        if self._last is not None and now - self._last < self._interval:
+            return
+        self._last = now
+        self._report(self.snapshot(now))
+
+    def snapshot(self, now=None):
+        if now is None:
+            now = self._clock()
+        elapsed = now - self._start
+        # Bytes resumed from an earlier attempt do not count for the rate
+        rate = (self.sent - self.offset) / elapsed if elapsed > 0 else 0
+        remaining = max(self.total - self.sent, 0)
+        if self.total:
+            percentage = min(int(self.sent * 100 / self.total), 100)
+        else:
+            percentage = 100
+        return {
+            "percentage": percentage,
+            "bytes_sent": self.sent,
+            "bytes_total": self.total,
+            "bytes_per_second": round(rate),
+            "eta": round(remaining / rate, 1) if rate > 0 else None,
+        }
+
+
+class AdaptiveChunk(object):
+    """
+    Chunk size of an upload. Grows up to `maximum` while acks come back
+    clean and shrinks down to `minimum` when packets are lost or
+    rejected. With minimum == maximum the size is fixed.
+    """
+
+    def __init__(self, size, minimum=ADAPT_MIN_CHUNK, maximum=None,
+                 grow_after=ADAPT_GROW_AFTER):
+        self.maximum = size if maximum is None else maximum
+        self.minimum = min(minimum, self.maximum)
+        self.size = max(min(size, self.maximum), self.minimum)
+        self.grow_after = grow_after
+        self._clean = 0
+
+    @classmethod
+    def fixed(cls, size):
+        return cls(size, size, size)
+
+    def ok(self):
+        self._clean += 1
+        if self._clean >= self.grow_after and self.size < self.maximum:
+            self.size = min(self.size * 2, self.maximum)
+            self._clean = 0
+            _logger.debug("Chunk size grown to %d", self.size)
+
+    def error(self):
+        self._clean = 0
+        if self.size > self.minimum:
+            self.size = max(self.size // 2, self.minimum)
+            _logger.info("Chunk size shrunk to %d", self.size)
+
+
+# Frames are assembled in one buffer straight from the reader's slices
+
+def window_frame(seq, data):
+    return b"".join((b'wadd %d %d\n' % (seq, len(data)), data))
+
+
+def binary_frame(seq, data):
+    crc_at = BINARY_HEADER.size + len(data)
+    frame = bytearray(crc_at + BINARY_CRC.size)
+    BINARY_HEADER.pack_into(frame, 0, BINARY_MAGIC, seq, len(data))
+    frame[BINARY_HEADER.size:crc_at] = data
+    BINARY_CRC.pack_into(frame, crc_at, zlib.crc32(memoryview(frame)[:crc_at]))
+    return frame
+
+
+def send_windowed(s, f, chunk, window, on_progress=None, cancel=None,
+                  metrics=None):
+    """
+    Sends the content of f using sequence-numbered frames with up to
+    `window` frames in flight.
+
+    Frame: b'wadd <seq> <length>\\n' followed by <length> bytes of data.
+    The device answers with cumulative b'ack <seq>\\n' (every frame up
+    to and including <seq> is written) or b'nak <seq>\\n' (resend from
+    <seq>). On a missed ack everything unacknowledged is resent.
+    """
+    return send_frames(s, f, chunk, window, window_frame, on_progress,
+                       cancel=cancel, metrics=metrics)
+
+
+def send_binary(s, f, chunk, window, on_progress=None, cancel=None,
+                metrics=None):
+    """
+    Sends the content of f as length-prefixed binary frames:
+
+        0xA5 | seq (u32) | length (u32) | data | crc32 (u32)
+
+    all little endian, with the CRC32 covering everything before it. The
+    device acks frames the same way as in windowed mode and naks a frame
+    whose CRC does not match, so only the bad frames are sent again.
+    """
+    return send_frames(s, f, chunk, window, binary_frame, on_progress,
+                       cancel=cancel, selective=True, metrics=metrics)
+
+
+def send_frames(s, f, chunk, window, make_frame, on_progress=None,
+                cancel=None, selective=False, metrics=None):
+    # `chunk` is a size in bytes or an AdaptiveChunk
+    if not isinstance(chunk, AdaptiveChunk):
+        chunk = AdaptiveChunk.fixed(chunk)
+    frames = {}
+    base = 0
+    next_seq = 0
+    acked = 0
+    misses = 0
+    eof = False
+
+    while True:
+        if cancel is not None and cancel.is_set():
+            _logger.info("Transfer cancelled at frame %d", base)
+            return False
+
+        while not eof and next_seq - base < window:
+            data = f.read(chunk.size)
+            if not data:
+                eof = True
+                break
+            frame = make_frame(next_seq, data)
+            frames[next_seq] = (frame, len(data))
+            s.write(frame)
+            next_seq += 1
+            if metrics is not None:
+                metrics.count("frames_sent")
+
+        if eof and base == next_seq:
+            break
+
+        a = s.readline()
+        if a.startswith(b'ack '):
+            try:
+                seq = int(a[4:])
+            except ValueError:
+                seq = -1
+            if seq >= base:
+                for n in range(base, min(seq + 1, next_seq)):
+                    acked += frames.pop(n)[1]
+                    chunk.ok()
+                base = min(seq + 1, next_seq)
+                misses = 0
+                if on_progress is not None:
+                    on_progress(acked)
+            continue
+
+        misses += 1
+        chunk.error()
+        if misses > ACK_RETRIES:
+            _logger.info("Too many missed acks, giving up at frame %d", base)
+            return False
+
+        resend_from = base
+        if a.startswith(b'nak '):
+            try:
+                resend_from = max(base, int(a[4:]))
+            except ValueError:
+                pass
+            _logger.info("Frame %d rejected, resending", resend_from)
+            if selective and resend_from < next_seq:
+                s.write(frames[resend_from][0])
+                if metrics is not None:
+                    metrics.count("frames_resent")
+                continue
+        else:
+            _logger.info("No ack for frame %d, resending window", base)
+        for n in range(resend_from, next_seq):
+            s.write(frames[n][0])
+        if metrics is not None:
+            metrics.count("frames_resent", next_seq - resend_from)
+
+    return True
@@ -0,0 +1,254 @@
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import math
+import threading
+import time
+
+import serial
+
+_logger = logging.getLogger("octoprint.plugins.mastersd.transport")
+
+# Seconds a command may wait in the queue and then for each line of its
+# response
+COMMAND_TIMEOUT = 10.0
+# Timeout of helpers that take as long as the device keeps answering, like
+# a whole card listing
+NO_TIMEOUT = math.inf
+# Commands written before the first response is read. The firmware takes
+# one command per USB packet, only devices that split lines can go higher.
+PIPELINE_DEPTH = 1
+
+DONE = b"done"
+FAILED = b"failed"
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class Response(object):
+    """Lines a command answered with before `done` (ok) or `failed`."""
+
+    def __init__(self, lines, ok):
+        self.lines = lines
+        self.ok = ok
+
+    def __repr__(self):
+        return "Response(%r, ok=%r)" % (self.lines, self.ok)
+
+
+def read_response(s, deadline=None, max_lines=None, idle=None):
+    """
+    Reads one response off the port: any lines, then `done` or `failed`.
+    Without a deadline the first read that times out ends it, more than
+    `max_lines` lines mean something else is talking on the port. Raises
+    CommandTimeout in both cases. With `idle` every line received moves
+    the deadline to at least `idle` seconds later, so long responses only
+    fail once the device stops sending.
+    """
+    lines = []
+    partial = b""
+    while (True):
+        line = partial + s.readline()
+        if (not line.endswith(b"\n")):
+            partial = line
+            if (deadline is None or time.monotonic() >= deadline):
+                raise CommandTimeout("No response from the MasterSD")
+            continue
+        partial = b""
+        if (deadline is not None and idle is not None):
+            deadline = max(deadline, time.monotonic() + idle)
+
+        line = line.rstrip(b"\r\n")
+        if (line == DONE):
+            return Response(lines, True)
+        if (line == FAILED):
+            return Response(lines, False)
+        lines.append(line.decode("ascii", "replace"))
+        if (max_lines is not None and len(lines) > max_lines):
+            raise CommandTimeout("Unexpected response: %r" % lines)
+
+
+def exchange(s, command, timeout=COMMAND_TIMEOUT, max_lines=None):
+    """
+    Writes `command` and reads its response, on a port already held. The
+    response fails once `timeout` seconds pass without a line.
+    """
+    s.write(command)
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    return read_response(s, deadline, max_lines, idle=timeout)
+
+
+class _Item(object):
+    # A queued command line, or a helper run with the port to itself
+
+    def __init__(self, deadline, line=None, helper=None, args=()):
+        self.future = concurrent.futures.Future()
+        self.deadline = deadline
+        self.line = line
+        self.helper = helper
+        self.args = args
+
+
+class CommandTransport(object):
+    """
+    Carries the MasterSD commands of the plugin. Commands are queued on an
+    asyncio loop running on its own thread and handed in order to one I/O
+    thread, which takes a ConnectionManager session for each burst, writes
+    up to `depth` commands ahead and matches every framed response to the
+    oldest command still waiting for one.
+
+    `submit(line)` returns a future of the Response, `call(helper, *args)`
+    one of what helper(s, *args) returns for exchanges that take several
+    steps, and `request(line)` is the awaitable form of `submit`. Futures
+    that are cancelled before their turn are never written. Each command
+    has `timeout` seconds from being queued to its first response line and
+    then between lines, a timed out one fails with CommandTimeout together
+    with everything written after it, since the responses can no longer
+    be told apart.
+    """
+
+    def __init__(self, conn, depth=PIPELINE_DEPTH, timeout=COMMAND_TIMEOUT):
+        self.conn = conn
+        self.depth = max(depth, 1)
+        self.timeout = timeout
+
+        self._io = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="MasterSD I/O")
+        self._loop = asyncio.new_event_loop()
+        self._queue = None
+        self._pump_task = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name="MasterSD transport")
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+
+    def submit(self, line, timeout=None):
+        return self._put(_Item(self._deadline(timeout), line=line))
+
+    def call(self, helper, *args, timeout=None):
+        return self._put(_Item(self._deadline(timeout), helper=helper,
+                               args=args))
+
+    async def request(self, line, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        future = self.submit(line, timeout)
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future),
+                None if timeout == NO_TIMEOUT else timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise CommandTimeout("Timed out waiting for %r" % line)
+
+    def run(self, helper, *args, timeout=None):
+        """
+        Runs helper(s, *args) and waits for it, up to `timeout` seconds or
+        for as long as it takes with NO_TIMEOUT. Inside a session on this
+        thread the port is already ours, so it runs right here.
+        """
+        if (self.conn.holds_port()):
+            with self.conn.session() as s:
+                return helper(s, *args)
+
+        timeout = self.timeout if timeout is None else timeout
+        future = self.call(helper, *args, timeout=timeout)
+        try:
+            return future.result(None if timeout == NO_TIMEOUT else timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise CommandTimeout(
+                "Timed out waiting for %s" % helper.__name__)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._pump_task.cancel)
+        self._thread.join()
+        self._io.shutdown(wait=False)
+
+    def _deadline(self, timeout):
+        return time.monotonic() + (self.timeout if timeout is None
+                                   else timeout)
+
+    def _put(self, item):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        return item.future
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        self._pump_task = self._loop.create_task(self._pump())
+        self._ready.set()
+        try:
+            self._loop.run_until_complete(self._pump_task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._loop.close()
+
+    async def _pump(self):
+        while (True):
+            burst = [await self._queue.get()]
+            while (not self._queue.empty()):
+                burst.append(self._queue.get_nowait())
+            await self._loop.run_in_executor(self._io, self._process, burst)
+
+    # -- I/O thread
+
+    def _process(self, burst):
+        # Skip what was cancelled while it waited
+        burst = [item for item in burst
+                 if item.future.set_running_or_notify_cancel()]
+        if (not burst):
+            return
+        try:
+            with self.conn.session() as s:
+                pending = collections.deque()
+                for item in burst:
+                    if (time.monotonic() >= item.deadline):
+                        item.future.set_exception(
+                            CommandTimeout("Timed out in the queue"))
+                    elif (item.helper is not None):
+                        self._drain(s, pending)
+                        self._settle(item, item.helper, s, *item.args)
+                    else:
+                        if (len(pending) >= self.depth):
+                            self._read(s, pending)
+                        s.write(item.line)
+                        pending.append(item)
+                self._drain(s, pending)
+        except Exception as e:
+            for item in burst:
+                if (not item.future.done()):
+                    item.future.set_exception(e)
+
+    def _settle(self, item, func, *args):
+        try:
+            item.future.set_result(func(*args))
+        except (serial.SerialException, OSError):
+            # The session has to see these to mark the connection lost
+            # before anyone waiting hears about it
+            raise
+        except Exception as e:
+            item.future.set_exception(e)
+
+    def _drain(self, s, pending):
+        while (pending):
+            self._read(s, pending)
+
+    def _read(self, s, pending):
+        item = pending.popleft()
+        try:
+            item.future.set_result(
+                read_response(s, item.deadline, idle=self.timeout))
+        except CommandTimeout as e:
+            _logger.info(f"{e}, failing {len(pending) + 1} commands")
+            item.future.set_exception(e)
+            while (pending):
+                pending.popleft().future.set_exception(e)
+            reset = getattr(s, "reset_input_buffer", None)
+            if (reset is not None):
+                reset()
@@ -0,0 +1,149 @@
+import logging
+import os
+import time
+
+import flask
+import octoprint.events
+import pytest
+
+import octoprint_mastersd
+from octoprint_mastersd import MasterSDPlugin
+from octoprint_mastersd.benchmark import (BenchmarkSettings, NullEventBus,
+                                          make_gcode)
+from octoprint_mastersd.simulator import LoopbackSerial, MasterSDSimulator
+
+JOB_TIMEOUT = 30.0
+
+
+class FakeFileManager(object):
+    """OctoPrint's local storage, a plain folder here."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path_on_disk(self, destination, name):
+        return os.path.join(self.folder, name)
+
+    def remove_file(self, destination, path):
+        # Sources are kept so tests can upload them again
+        pass
+
+
+class FakePrinter(object):
+
+    def __init__(self):
+        self.calls = []
+        self.printing = False
+
+    def is_printing(self):
+        return self.printing
+
+    def is_paused(self):
+        return False
+
+    def is_ready(self):
+        return not self.printing
+
+    def is_operational(self):
+        return True
+
+    def release_sd_card(self):
+        self.calls.append("release_sd_card")
+
+    def init_sd_card(self):
+        self.calls.append("init_sd_card")
+
+
+class FakePluginManager(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def send_plugin_message(self, identifier, message):
+        self.messages.append(message)
+
+
+def make_plugin(folder, settings=None):
+    octoprint.events.Events.register_event(
+        "upload_progress", prefix="plugin_mastersd_")
+    plugin = MasterSDPlugin()
+    plugin._identifier = "mastersd"
+    plugin._basefolder = os.path.dirname(octoprint_mastersd.__file__)
+    plugin._logger = logging.getLogger("octoprint.plugins.mastersd")
+    if settings is None:
+        settings = BenchmarkSettings(plugin.get_settings_defaults())
+    plugin._settings = settings
+    plugin._event_bus = NullEventBus()
+    plugin._plugin_manager = FakePluginManager()
+    plugin._printer = FakePrinter()
+    plugin._file_manager = FakeFileManager(os.path.join(folder, "uploads"))
+    data = os.path.join(folder, "data")
+    os.makedirs(data, exist_ok=True)
+    plugin.get_plugin_data_folder = lambda: data
+    plugin.initialize()
+    plugin.on_after_startup()
+    return plugin
+
+
+def close_plugin(plugin):
+    for device in plugin.devices.list():
+        device.conn.detach()
+        device.transport.close()
+
+
+def attach(plugin, sim, mode="auto", port="loop://mastersd"):
+    """Connects the selected device to `sim` like /connect would."""
+    ser = LoopbackSerial(sim, latency=0, timeout=0.2, port=port)
+    plugin.attach_device((port, ser, plugin.is_control(ser)), mode)
+    # Missed answers cost a read timeout each, keep them short
+    ser.timeout = 0.2
+    return ser
+
+
+def wait(job, timeout=JOB_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not job.is_finished:
+        assert time.monotonic() < deadline, "job did not finish"
+        time.sleep(0.02)
+    return job
+
+
+def upload(plugin, name, path="/sdcard", **options):
+    """Queues an upload of the local file `name` and waits for it."""
+    job = plugin.make_upload_job(name, path, **options)
+    plugin.jobs.submit(job)
+    return wait(job)
+
+
+@pytest.fixture
+def plugin(tmp_path):
+    os.makedirs(tmp_path / "uploads")
+    plugin = make_plugin(str(tmp_path))
+    # The test thread works for the printer's MasterSD
+    with plugin.devices.use(plugin.devices.get()):
+        yield plugin
+    close_plugin(plugin)
+
+
+@pytest.fixture
+def sim():
+    return MasterSDSimulator(seed=1)
+
+
+@pytest.fixture
+def client(plugin):
+    app = flask.Flask(__name__)
+    app.register_blueprint(plugin.get_blueprint(),
+                           url_prefix="/plugin/mastersd")
+    return app.test_client()
+
+
+@pytest.fixture
+def gcode(plugin):
+    """Writes a G-code file of about `size` bytes to the local storage."""
+    def make(name, size=40000):
+        path = plugin._file_manager.path_on_disk(plugin.local, name)
+        make_gcode(path, size)
+        with open(path, "rb") as f:
+            return f.read()
+    return make
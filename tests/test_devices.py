@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+import octoprint_mastersd
+from octoprint_mastersd.devices import DEFAULT_DEVICE, NoDeviceSelected
+from octoprint_mastersd.jobs import Job
+from octoprint_mastersd.simulator import LoopbackSerial, MasterSDSimulator
+from octoprint_mastersd.transfer import MODE_BINARY
+
+from conftest import attach, close_plugin, make_plugin, wait
+
+
+@pytest.fixture
+def second(plugin):
+    sim = MasterSDSimulator(seed=2)
+    device = plugin.devices.add(plugin.make_device("second"))
+    with plugin.devices.use(device):
+        attach(plugin, sim, MODE_BINARY, port="loop://second")
+    return device, sim
+
+
+def test_routes_address_the_device_by_id(plugin, client, sim, second):
+    attach(plugin, sim, MODE_BINARY)
+    device, other = second
+
+    r = client.post("/plugin/mastersd/devices/second/mkdir",
+                    json={"path": "/sdcard/parts"})
+    assert r.status_code == 200
+    r = client.post("/plugin/mastersd/mkdir", json={"path": "/sdcard/own"})
+    assert r.status_code == 200
+
+    assert other.dirs == {"parts"}
+    assert sim.dirs == {"own"}
+
+
+def test_uploads_run_on_their_device(plugin, client, sim, second, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    device, other = second
+    content = gcode("part.gcode")
+
+    r = client.post("/plugin/mastersd/devices/second/write_sd",
+                    json={"name": "part.gcode", "path": "/sdcard"})
+    assert r.status_code == 200
+    job = wait(device.jobs.get(r.json["id"]))
+
+    assert job.state == Job.DONE, job.error
+    assert bytes(other.files["part.gcode"]) == content
+    assert sim.files == {}
+    assert plugin.jobs.list() == []
+    assert {m["device"] for m in plugin._plugin_manager.messages
+            if m["type"] == "job"} == {"second"}
+
+
+def test_unknown_device(client):
+    assert client.get("/plugin/mastersd/devices/nope/jobs").status_code == 404
+
+
+def test_threads_have_to_select_a_device(plugin):
+    errors = []
+
+    def work():
+        try:
+            plugin.conn
+        except NoDeviceSelected as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+
+    assert len(errors) == 1
+
+
+def test_added_devices_are_remembered(plugin, client, tmp_path, monkeypatch):
+    sim = MasterSDSimulator(seed=2)
+    ser = LoopbackSerial(sim, latency=0, timeout=0.2, port="/dev/ttyMSD")
+    monkeypatch.setattr(
+        octoprint_mastersd, "probe_ports",
+        lambda ports, *args: ("/dev/ttyMSD", ser, True)
+        if "/dev/ttyMSD" in ports else None)
+
+    r = client.post("/plugin/mastersd/devices", json={"ports": ["/dev/ttyMSD"]})
+    assert r.status_code == 200
+    device_id = r.json["id"]
+    assert r.json["connected"]
+
+    restarted = make_plugin(str(tmp_path), plugin._settings)
+    try:
+        device = restarted.devices.get(device_id)
+        assert device is not None
+        assert device.remembered["port"] == "/dev/ttyMSD"
+        assert not device.conn.connected
+    finally:
+        close_plugin(restarted)
+
+    r = client.delete("/plugin/mastersd/devices/" + device_id)
+    assert r.status_code == 200
+    assert plugin.devices.get(device_id) is None
+    assert plugin._settings.get(["known_devices"]) == {}
+    assert not ser.is_open
+
+
+def test_default_device_cannot_be_removed(client):
+    r = client.delete("/plugin/mastersd/devices/" + DEFAULT_DEVICE)
+    assert r.status_code == 400
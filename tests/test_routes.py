@@ -0,0 +1,65 @@
+import pytest
+
+from octoprint_mastersd.jobs import Job
+
+from conftest import attach, wait
+
+
+@pytest.mark.parametrize("body", [
+    [],
+    {"operations": []},
+    {"operations": {"op": "mkdir", "path": "a"}},
+    {"operations": ["mkdir"]},
+    {"operations": [{"op": "format", "path": "a"}]},
+    {"operations": [{"op": "mkdir"}]},
+    {"operations": [{"op": "delete", "path": 3}]},
+    {"operations": [{"op": "upload"}]},
+    {"operations": [{"op": "upload", "name": "a.gcode", "path": ["x"]}]},
+    {"operations": [{"op": "mkdir", "path": "/sdcard/a"}], "run": "a.gcode"},
+])
+def test_batch_rejects_bad_operations(plugin, client, body):
+    r = client.post("/plugin/mastersd/batch", json=body)
+
+    assert r.status_code == 400
+    assert plugin.jobs.list() == []
+
+
+def test_batch_runs_operations_in_order(plugin, client, sim, gcode):
+    attach(plugin, sim)
+    content = gcode("part.gcode")
+    sim.files["old.gcode"] = bytearray(b"G28\n")
+
+    r = client.post("/plugin/mastersd/batch", json={"operations": [
+        {"op": "mkdir", "path": "/sdcard/parts"},
+        {"op": "upload", "name": "part.gcode", "path": "/sdcard/parts"},
+        {"op": "delete", "path": "/sdcard/old.gcode"},
+    ]})
+    assert r.status_code == 200
+    job = wait(plugin.jobs.get(r.json["id"]))
+
+    assert job.state == Job.DONE, job.error
+    assert bytes(sim.files["parts/part.gcode"]) == content
+    assert "old.gcode" not in sim.files
+
+
+def test_switch_control(plugin, client, sim):
+    attach(plugin, sim)
+
+    r = client.get("/plugin/mastersd/switch_control")
+    assert r.status_code == 200
+    assert r.json is False
+    assert plugin._printer.calls == ["init_sd_card"]
+
+    r = client.get("/plugin/mastersd/switch_control")
+    assert r.json is True
+    assert plugin._printer.calls == ["init_sd_card", "release_sd_card"]
+
+
+def test_switch_control_timeout(plugin, client, sim):
+    ser = attach(plugin, sim)
+    plugin.transport.timeout = 0.2
+    ser.latency = 1.0
+
+    r = client.get("/plugin/mastersd/switch_control")
+
+    assert r.status_code == 504
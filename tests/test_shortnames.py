@@ -0,0 +1,81 @@
+import pytest
+
+from octoprint_mastersd.shortnames import ShortNameLookup, component_matches
+
+
+def lookup(name, folder, lines):
+    """Feeds one M20 listing, returns what the lookup found at its end."""
+    lookup = ShortNameLookup(name, folder)
+    assert lookup.feed("Begin file list") is None
+    for line in lines:
+        assert lookup.feed(line) is None
+    return lookup.feed("End file list")
+
+
+def test_lines_outside_a_listing_are_ignored():
+    lookup = ShortNameLookup("part.gcode")
+    assert lookup.feed("PART~1.GCO 100 part.gcode") is None
+    assert lookup.entries == {}
+
+
+def test_root_folder():
+    assert lookup("part.gcode", "", [
+        "JOBS/PART~1.GCO 100 part.gcode",
+        "PART~1.GCO 200 part.gcode",
+    ]) == "PART~1.GCO"
+
+
+def test_root_folder_ignores_subfolders():
+    assert lookup("part.gcode", "", ["JOBS/PART~1.GCO 100 part.gcode"]) is None
+
+
+def test_short_folder():
+    assert lookup("part.gcode", "/jobs/", [
+        "PART~1.GCO 100 part.gcode",
+        "JOBS/PART~1.GCO 200 part.gcode",
+    ]) == "JOBS/PART~1.GCO"
+
+
+def test_long_folder():
+    assert lookup("part.gcode", "/longfoldername/", [
+        "OTHER/PART~1.GCO 100 part.gcode",
+        "LONGFO~1/PART~1.GCO 200 part.gcode",
+    ]) == "LONGFO~1/PART~1.GCO"
+
+
+def test_folder_not_listed():
+    # The file of another folder is never started instead
+    assert lookup("part.gcode", "/longfoldername/", [
+        "OTHER/PART~1.GCO 100 part.gcode",
+    ]) is None
+
+
+def test_duplicate_names_are_not_guessed():
+    assert lookup("part.gcode", "/longfoldername/", [
+        "LONGFO~1/PART~1.GCO 100 part.gcode",
+        "LONGFO~2/PART~1.GCO 200 part.gcode",
+    ]) is None
+
+
+def test_nested_folders():
+    assert lookup("part.gcode", "/jobs/longfoldername/", [
+        "LONGFO~1/PART~1.GCO 100 part.gcode",
+        "JOBS/LONGFO~1/PART~1.GCO 200 part.gcode",
+    ]) == "JOBS/LONGFO~1/PART~1.GCO"
+
+
+def test_firmware_without_long_names():
+    assert lookup("part.gco", "/jobs/", ["JOBS/PART.GCO 100"]) == "JOBS/PART.GCO"
+
+
+@pytest.mark.parametrize("short, name, matches", [
+    ("JOBS", "jobs", True),
+    ("LONGFO~1", "longfoldername", True),
+    ("LONGF~12", "longfoldername", True),
+    ("MYPRIN~1", "my prints", True),
+    ("OTHER", "longfoldername", False),
+    ("LONGFI~1", "longfoldername", False),
+    ("JOBS", "jobs2", False),
+])
+def test_component_matches(short, name, matches):
+    assert component_matches(short, name) == matches
@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from octoprint_mastersd.jobs import Job, SpoolJob
+from octoprint_mastersd.simulator import MasterSDSimulator
+from octoprint_mastersd.transfer import MODE_BINARY
+
+from conftest import attach, upload, wait
+
+
+@pytest.fixture
+def printer_sim():
+    # The printer owns the card
+    return MasterSDSimulator(control=False, seed=1)
+
+
+def test_upload_is_spooled_while_printer_owns_card(plugin, printer_sim, gcode):
+    attach(plugin, printer_sim, MODE_BINARY)
+    gcode("part.gcode")
+
+    job = upload(plugin, "part.gcode")
+
+    assert job.state == Job.DONE, job.error
+    assert job.result["spooled"]
+    assert [e["path"] for e in plugin.spool.entries()] == ["part.gcode"]
+    assert printer_sim.files == {}
+    # The printer keeps the card until a drain is asked for
+    assert not any(isinstance(j, SpoolJob) for j in plugin.jobs.list())
+    assert plugin._printer.calls == []
+
+
+def test_spool_stores_content_once(plugin, printer_sim, gcode):
+    attach(plugin, printer_sim, MODE_BINARY)
+    content = gcode("a.gcode")
+    path = plugin._file_manager.path_on_disk(plugin.local, "b.gcode")
+    with open(path, "wb") as f:
+        f.write(content)
+
+    upload(plugin, "a.gcode")
+    upload(plugin, "b.gcode")
+
+    entries = plugin.spool.entries()
+    assert [e["path"] for e in entries] == ["a.gcode", "b.gcode"]
+    assert entries[0]["sha256"] == entries[1]["sha256"]
+    assert os.path.exists(plugin.spool.blob_path(entries[0]["sha256"]))
+
+    plugin.spool.remove("a.gcode")
+    assert os.path.exists(plugin.spool.blob_path(entries[0]["sha256"]))
+    plugin.spool.remove("b.gcode")
+    assert not os.path.exists(plugin.spool.blob_path(entries[0]["sha256"]))
+
+
+def test_drain_writes_spool_and_returns_card(plugin, printer_sim, gcode):
+    attach(plugin, printer_sim, MODE_BINARY)
+    content = gcode("part.gcode")
+    upload(plugin, "part.gcode")
+
+    job = wait(plugin.drain_spool(auto=True))
+
+    assert job.state == Job.DONE, job.error
+    assert job.result["succeeded"] == 1
+    assert bytes(printer_sim.files["part.gcode"]) == content
+    assert len(plugin.spool) == 0
+    assert not printer_sim.control
+    assert plugin._printer.calls == ["release_sd_card", "init_sd_card"]
+
+
+def test_no_automatic_drain_while_printing(plugin, printer_sim, gcode):
+    attach(plugin, printer_sim, MODE_BINARY)
+    gcode("part.gcode")
+    upload(plugin, "part.gcode")
+    plugin._printer.printing = True
+
+    assert plugin.drain_spool(auto=True) is None
+    assert len(plugin.spool) == 1
+
+
+def test_delete_spooled_upload(plugin, client, printer_sim, gcode):
+    attach(plugin, printer_sim, MODE_BINARY)
+    gcode("part.gcode")
+    upload(plugin, "part.gcode")
+
+    r = client.post("/plugin/mastersd/spool/delete",
+                    json={"path": "part.gcode"})
+    assert r.status_code == 200
+    assert len(plugin.spool) == 0
+
+    r = client.post("/plugin/mastersd/spool/delete",
+                    json={"path": "part.gcode"})
+    assert r.status_code == 404
+
+
+@pytest.mark.parametrize("body", ["not json", [], {}, {"path": 3}])
+def test_delete_spooled_upload_rejects_bad_body(client, body):
+    if isinstance(body, str):
+        r = client.post("/plugin/mastersd/spool/delete", data=body)
+    else:
+        r = client.post("/plugin/mastersd/spool/delete", json=body)
+    assert r.status_code == 400
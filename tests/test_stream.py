@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+
+from octoprint_mastersd.jobs import Job
+from octoprint_mastersd.stream import StreamBuffer, StreamClosed
+from octoprint_mastersd.transfer import MODE_BINARY
+
+from conftest import attach, upload, wait
+
+
+def test_read_returns_what_was_fed():
+    stream = StreamBuffer(limit=16)
+    stream.feed(b"G28\n")
+    stream.feed(b"G1 X10\n")
+    stream.finish()
+
+    assert bytes(stream.read(16)) == b"G28\nG1 X10\n"
+    assert stream.read(16) == b""
+
+
+def test_close_wakes_a_waiting_read():
+    stream = StreamBuffer(limit=16)
+    threading.Timer(0.1, stream.close).start()
+
+    with pytest.raises(StreamClosed):
+        stream.read(16)
+
+
+def test_read_fails_once_the_body_stalls():
+    stream = StreamBuffer(limit=16, idle_timeout=0.2)
+    stream.feed(b"G28\n")
+
+    started = time.monotonic()
+    with pytest.raises(StreamClosed):
+        stream.read(16)
+    assert time.monotonic() - started >= 0.2
+
+
+def test_cancel_stalled_stream_upload(plugin, sim, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    content = gcode("part.gcode")
+    job = plugin.make_stream_job("stalled.gcode", "/sdcard", 1000)
+    # Part of the body arrived, the rest never will
+    job.stream.feed(b"G28\n" * 10)
+    plugin.jobs.submit(job)
+    while job.state == Job.QUEUED:
+        time.sleep(0.02)
+
+    assert plugin.jobs.cancel(job.id)
+    assert wait(job, timeout=2.0).state == Job.CANCELLED
+    assert "stalled.gcode" not in sim.files
+
+    # The queue behind it moves on
+    following = upload(plugin, "part.gcode")
+    assert following.state == Job.DONE, following.error
+    assert bytes(sim.files["part.gcode"]) == content
@@ -0,0 +1,99 @@
+import time
+
+import pytest
+import serial
+
+from octoprint_mastersd.transport import CommandTimeout, CommandTransport
+
+from conftest import attach
+
+
+@pytest.fixture
+def transport(plugin, sim):
+    attach(plugin, sim)
+    transport = CommandTransport(plugin.conn, depth=2, timeout=2.0)
+    yield transport
+    transport.close()
+
+
+def test_pipelined_responses_match_their_commands(transport, sim):
+    for n in range(5):
+        sim.files["f%d" % n] = bytearray(n * 10)
+
+    futures = [transport.submit(b"stat f%d\n" % n) for n in range(5)]
+    futures.append(transport.submit(b"stat missing\n"))
+
+    for n, future in enumerate(futures[:5]):
+        res = future.result(2.0)
+        assert res.ok
+        assert res.lines == ["s: %d" % (n * 10)]
+    assert not futures[5].result(2.0).ok
+
+
+def test_helpers_run_in_order_with_commands(plugin, transport):
+    first = transport.submit(b"mkdir a\n")
+    listing = transport.call(plugin.list_dir, "", 0, 10)
+
+    assert first.result(2.0).ok
+    assert [f["name"] for f in listing.result(2.0)["folders"]] == ["a"]
+
+
+def test_helper_timeout(transport):
+    with pytest.raises(CommandTimeout):
+        transport.run(lambda s: time.sleep(0.5), timeout=0.1)
+
+    assert transport.submit(b"is_control\n").result(2.0).lines == ["true"]
+
+
+def test_port_error_in_helper_drops_the_connection(plugin, transport):
+    def unplugged(s):
+        raise serial.SerialException("device reports readiness to read "
+                                     "but returned no data")
+
+    with pytest.raises(serial.SerialException):
+        transport.run(unplugged)
+
+    assert not plugin.conn.connected
+
+
+def test_unanswered_command_fails_what_was_sent_after_it(transport, sim):
+    handle = sim.handle
+    sim.handle = lambda message: []
+    lost = transport.submit(b"is_control\n", timeout=0.3)
+    behind = transport.submit(b"is_control\n", timeout=0.3)
+
+    with pytest.raises(CommandTimeout):
+        lost.result(2.0)
+    with pytest.raises(CommandTimeout):
+        behind.result(2.0)
+
+    sim.handle = handle
+    assert transport.submit(b"is_control\n").result(2.0).lines == ["true"]
+
+
+def test_cancelled_command_is_never_written(transport, sim):
+    busy = transport.call(lambda s: time.sleep(0.2))
+    skipped = transport.submit(b"mkdir skipped\n")
+    assert skipped.cancel()
+
+    busy.result(2.0)
+    transport.submit(b"is_control\n").result(2.0)
+    assert "skipped" not in sim.dirs
+
+
+def slow_card(sim, ser, files=200):
+    # Streams the listing at about 5 ms per file
+    for n in range(files):
+        sim.files["f%03d.gcode" % n] = bytearray()
+    ser.baudrate = 50000
+
+
+def test_whole_card_listing_outlasts_the_command_timeout(plugin, client, sim):
+    ser = attach(plugin, sim)
+    slow_card(sim, ser)
+    plugin.transport.timeout = 0.3
+
+    r = client.get("/plugin/mastersd/get_info?refresh=true")
+
+    assert r.status_code == 200
+    assert len(plugin.sd_data["files"]) == 200
@@ -0,0 +1,124 @@
+import zlib
+
+import pytest
+
+from octoprint_mastersd.jobs import Job
+from octoprint_mastersd.transfer import (BINARY_MAGIC, MODE_ADD, MODE_BINARY,
+                                         MODE_WINDOW)
+
+from conftest import attach, upload, wait
+
+MODES = [
+    (MODE_ADD, False),
+    (MODE_WINDOW, False),
+    (MODE_BINARY, False),
+    (MODE_BINARY, True),
+]
+
+
+class Outage(object):
+    """
+    Simulator wrapper ignoring every binary frame after the first `after`
+    until the write is closed, like a link that stops answering mid upload.
+    """
+
+    def __init__(self, sim, after):
+        self.sim = sim
+        self.after = after
+        self.frames = 0
+        self.active = True
+        self._handle = sim.handle
+        sim.handle = self.handle
+
+    def handle(self, message):
+        if self.active and message[:1] == bytes([BINARY_MAGIC]):
+            self.frames += 1
+            if self.frames > self.after:
+                return []
+        if self.active and self.frames > self.after and message == b"done\n":
+            self.active = False
+        return self._handle(message)
+
+
+@pytest.mark.parametrize("mode, compress", MODES)
+def test_upload_round_trip(plugin, sim, gcode, mode, compress):
+    attach(plugin, sim, mode)
+    content = gcode("part.gcode")
+
+    job = upload(plugin, "part.gcode", compress=compress)
+
+    assert job.state == Job.DONE, job.error
+    assert bytes(sim.files["part.gcode"]) == content
+    stats = job.result["stats"]
+    assert stats["verify"]["crc"] == "%08x" % zlib.crc32(content)
+    if compress:
+        assert stats["wire_bytes"] < len(content)
+
+
+def test_upload_into_folder(plugin, sim, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    sim.dirs.add("parts")
+    content = gcode("part.gcode")
+
+    job = upload(plugin, "part.gcode", "/sdcard/parts")
+
+    assert job.state == Job.DONE, job.error
+    assert bytes(sim.files["parts/part.gcode"]) == content
+
+
+def test_upload_already_present_is_skipped(plugin, sim, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    gcode("part.gcode")
+    upload(plugin, "part.gcode")
+    writes = sim.commands["write"] + sim.commands["zwrite"]
+
+    job = upload(plugin, "part.gcode")
+
+    assert job.state == Job.DONE, job.error
+    assert job.result["already_present"]
+    assert sim.commands["write"] + sim.commands["zwrite"] == writes
+
+
+def test_upload_resumes_from_card(plugin, sim, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    content = gcode("part.gcode")
+    sim.files["part.gcode"] = bytearray(content[:12345])
+
+    job = plugin.make_upload_job("part.gcode", "/sdcard", compress=False)
+    job.resume = True
+    wait(plugin.jobs.submit(job))
+
+    assert job.state == Job.DONE, job.error
+    assert job.offset == 12345
+    assert bytes(sim.files["part.gcode"]) == content
+
+
+def test_failed_upload_is_retried_from_where_it_stopped(plugin, sim, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    content = gcode("part.gcode", 60000)
+    outage = Outage(sim, after=3)
+
+    job = upload(plugin, "part.gcode", compress=False)
+
+    assert job.state == Job.DONE, job.error
+    assert not outage.active
+    assert job.offset > 0
+    assert bytes(sim.files["part.gcode"]) == content
+    assert plugin.metrics.counters["upload_retries"] == 1
+
+
+def test_failed_upload_can_be_resumed(plugin, sim, gcode):
+    plugin._settings.set(["upload_retries"], 0)
+    attach(plugin, sim, MODE_BINARY)
+    content = gcode("part.gcode", 60000)
+    Outage(sim, after=3)
+
+    job = upload(plugin, "part.gcode", compress=False)
+    assert job.state == Job.FAILED
+
+    assert plugin.jobs.resume(job.id) is job
+    wait(job)
+
+    assert job.state == Job.DONE, job.error
+    assert job.offset > 0
+    assert bytes(sim.files["part.gcode"]) == content
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from octoprint_mastersd.jobs import Job
+from octoprint_mastersd.transfer import MODE_BINARY, VerifyError
+
+from conftest import attach, upload
+
+
+def test_mismatch_is_written_again(plugin, sim, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    content = gcode("part.gcode")
+    # Only the first write reaches the card damaged
+    sim.corrupt_rate = 1.0
+    verify_write = plugin.verify_write
+
+    def verify_once(*args):
+        try:
+            return verify_write(*args)
+        finally:
+            sim.corrupt_rate = 0.0
+
+    plugin.verify_write = verify_once
+
+    job = upload(plugin, "part.gcode", compress=False)
+
+    assert job.state == Job.DONE, job.error
+    assert bytes(sim.files["part.gcode"]) == content
+    assert plugin.metrics.counters["upload_retries"] == 1
+
+
+def test_upload_fails_when_every_write_mismatches(plugin, sim, gcode):
+    plugin._settings.set(["upload_retries"], 1)
+    attach(plugin, sim, MODE_BINARY)
+    gcode("part.gcode")
+    sim.corrupt_rate = 1.0
+
+    job = upload(plugin, "part.gcode", compress=False)
+
+    assert job.state == Job.FAILED
+    assert "part.gcode" not in sim.files
+
+
+def test_malformed_checksum_counts_as_mismatch(plugin, sim, gcode):
+    attach(plugin, sim, MODE_BINARY)
+    gcode("part.gcode")
+    handle = sim.handle
+    sim.handle = lambda message: [b"c: garbage" if line.startswith(b"c: ")
+                                  else line for line in handle(message)]
+    path = plugin._file_manager.path_on_disk(plugin.local, "part.gcode")
+
+    with plugin.conn.session() as s:
+        with pytest.raises(VerifyError):
+            plugin.write_file(s, path, "part.gcode", os.path.getsize(path))
+
+    assert "part.gcode" not in sim.files
+
+
+def test_verify_can_be_turned_off(plugin, sim, gcode):
+    plugin._settings.set(["verify_uploads"], False)
+    attach(plugin, sim, MODE_BINARY)
+    gcode("part.gcode")
+
+    job = upload(plugin, "part.gcode")
+
+    assert job.state == Job.DONE, job.error
+    assert "verify" not in job.result["stats"]
+    assert sim.commands["crc"] == 0